@@ -18,6 +18,8 @@ setup(
     extras_require={
         'scripts': ['flup'], # index.fcgi needs flup
         'mysql': ['mysqlclient'],
+        'redis': ['redis'], # GATE_EVENTS_BROKER = 'redis://...'
+        'analytics': ['pyarrow'], # export_analytics and gate:analytics-export
         'dev': [
             'pylint', 'pylint-django',  # lint
             'mypy', 'django-stubs',     # type checking
@@ -1,9 +1,11 @@
 from django.contrib import admin
+from django.db import transaction
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 
 from reversion.admin import VersionAdmin
 
+import squaresdb.gate.edits as gate_edits
 import squaresdb.gate.models as gate_models
 import squaresdb.money.admin as money_admin
 
@@ -69,8 +71,37 @@ def mail_merge(modeladmin, request, queryset):
 
 
 
+class RefreshSummariesAdmin(VersionAdmin):
+    """Admin that refreshes the dance ledgers and payment cube after edits,
+    deletes, and reverts
+
+    The delete action goes through changelist_view, and reverting (or
+    recovering) a version reverts it before calling changeform_view."""
+
+    def _refreshing(self, view, request, *args, **kwargs):
+        if request.method != 'POST':
+            return view(request, *args, **kwargs)
+        with transaction.atomic(), gate_edits.refresh_after_edits():
+            return view(request, *args, **kwargs)
+
+    def changeform_view(self, request, *args, **kwargs):
+        return self._refreshing(super().changeform_view, request, *args, **kwargs)
+
+    def changelist_view(self, request, *args, **kwargs):
+        return self._refreshing(super().changelist_view, request, *args, **kwargs)
+
+    def delete_view(self, request, *args, **kwargs):
+        return self._refreshing(super().delete_view, request, *args, **kwargs)
+
+    def revision_view(self, request, *args, **kwargs):
+        return self._refreshing(super().revision_view, request, *args, **kwargs)
+
+    def recover_view(self, request, *args, **kwargs):
+        return self._refreshing(super().recover_view, request, *args, **kwargs)
+
+
 @admin.register(gate_models.SubscriptionPayment)
-class Admin_SubscriptionPayment(VersionAdmin):
+class Admin_SubscriptionPayment(RefreshSummariesAdmin):
     actions = [mail_merge]
 
     list_display = ['time', 'person', 'at_dance', 'payment_type', 'get_periods']
@@ -98,7 +129,7 @@ class Admin_SubscriptionPayment(VersionAdmin):
 
 
 @admin.register(gate_models.DancePayment)
-class Admin_DancePayment(VersionAdmin):
+class Admin_DancePayment(RefreshSummariesAdmin):
     actions = [mail_merge]
     list_display = ['time', 'for_dance', 'person', 'at_dance', 'payment_type', ]
     ordering = ['-for_dance__time', 'person']
@@ -109,7 +140,7 @@ class Admin_DancePayment(VersionAdmin):
 
 
 @admin.register(gate_models.Attendee)
-class Admin_Attendee(VersionAdmin):
+class Admin_Attendee(RefreshSummariesAdmin):
     actions = [mail_merge]
     fields = ['person', 'dance', 'payment', 'time']
     list_display = fields
@@ -118,6 +149,15 @@ class Admin_Attendee(VersionAdmin):
     date_hierarchy = 'dance__time'
     ordering = ['-dance__time', 'person']
 
+
+@admin.register(gate_models.SquaresPayImport)
+class Admin_SquaresPayImport(VersionAdmin):
+    # Delete one to let the submission be uploaded again
+    readonly_fields = ['webform_sid', 'person', 'payment', 'time', ]
+    list_display = readonly_fields
+    search_fields = ['webform_sid', 'person__name', ]
+    ordering = ['-time', ]
+
 # Online payments
 
 @admin.register(gate_models.SubscriptionLineItem)
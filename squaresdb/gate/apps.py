@@ -1,6 +1,46 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save, pre_save
 
 
 class GateConfig(AppConfig):
     name = 'squaresdb.gate'
     default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        # pylint:disable=import-outside-toplevel
+        import squaresdb.gate.cube as gate_cube
+        import squaresdb.gate.ledger as gate_ledger
+        import squaresdb.gate.models as gate_models
+        import squaresdb.gate.prices as gate_prices
+        import squaresdb.membership.models as member_models
+
+        # Keep the cached price matrix up to date
+        price_models = [
+            gate_models.DancePrice,
+            gate_models.DancePriceScheme,
+            gate_models.SubscriptionPeriod,
+            gate_models.SubscriptionPeriodPrice,
+            member_models.FeeCategory,  # the matrix includes category names
+        ]
+        for model in price_models:
+            post_save.connect(gate_prices.invalidate, sender=model,
+                              dispatch_uid=f'gate_prices_save_{model.__name__}')
+            post_delete.connect(gate_prices.invalidate, sender=model,
+                                dispatch_uid=f'gate_prices_delete_{model.__name__}')
+
+        # Note what admin edits touch, to refresh the derived tables (see gate.edits)
+        payment_models = [
+            gate_models.Payment,
+            gate_models.DancePayment,
+            gate_models.SubscriptionPayment,
+        ]
+        edited_models = [
+            ('ledger', gate_ledger.edits, [gate_models.Attendee] + payment_models),
+            ('cube', gate_cube.edits, payment_models),
+        ]
+        for name, tracker, models in edited_models:
+            for model in models:
+                uid = f'gate_{name}_%s_{model.__name__}'
+                pre_save.connect(tracker.record, sender=model, dispatch_uid=uid % 'pre_save')
+                post_save.connect(tracker.record, sender=model, dispatch_uid=uid % 'save')
+                post_delete.connect(tracker.record, sender=model, dispatch_uid=uid % 'delete')
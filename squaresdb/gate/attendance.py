@@ -0,0 +1,108 @@
+"""Person-by-dance attendance matrix, for the voting members and paper gate
+tables (and a person's own attendance history)
+
+Rather than building model instances for every attendee and payment, this
+loads (person, dance) pairs with values_list and keeps one bitset (a Python
+int, bit i for the i-th dance) per person for each of present, paid for the
+dance, and covered by a subscription (or a free fee category). The per-dance
+codes then come from a few bitwise operations per person, so a window of a
+whole year costs about as much as a window of a few weeks.
+
+Codes, per person and dance:
+
+- X: present, and paid (or covered)
+- O: present, but didn't pay
+- P: paid for the dance, but wasn't present
+- blank: neither"""
+
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from django.db.models import QuerySet
+
+import squaresdb.gate.models as gate_models
+
+CODE_PRESENT_PAID = 'X'
+CODE_PRESENT_UNPAID = 'O'
+CODE_PAID_ABSENT = 'P'
+CODE_NONE = ''
+
+
+class AttendanceMatrix:
+    """Attendance and payment for some people over a window of dances"""
+
+    def __init__(self, dances: Sequence[gate_models.Dance]):
+        self.dances = list(dances)
+        self.dance_bits = {dance.pk: 1 << index for index, dance in enumerate(self.dances)}
+        self.period_bits: Dict[str, int] = {}
+        for dance in self.dances:
+            if dance.period_id:
+                self.period_bits[dance.period_id] = (self.period_bits.get(dance.period_id, 0)
+                                                     | self.dance_bits[dance.pk])
+        self.all_bits = (1 << len(self.dances)) - 1
+        self.present: Dict[int, int] = {}
+        self.paid: Dict[int, int] = {}
+        self.covered: Dict[int, int] = {}
+
+    def load(self, people: QuerySet,
+             free_people: Iterable[int] = ()) -> 'AttendanceMatrix':
+        """Fill in the matrix for people (a Person queryset)
+
+        People in free_people are covered for every dance. This makes three
+        queries, however many people and dances there are."""
+        dance_ids = list(self.dance_bits)
+        attendees = gate_models.Attendee.objects.filter(person__in=people, dance__in=dance_ids)
+        self._set_bits(self.present, attendees.values_list('person_id', 'dance_id'),
+                       self.dance_bits)
+        dance_pays = gate_models.DancePayment.objects.filter(person__in=people,
+                                                             for_dance__in=dance_ids)
+        self._set_bits(self.paid, dance_pays.values_list('person_id', 'for_dance_id'),
+                       self.dance_bits)
+        sub_periods = gate_models.SubscriptionPayment.periods.through.objects.filter(
+            subscriptionpayment__person__in=people, subscriptionperiod__in=list(self.period_bits))
+        self._set_bits(self.covered, sub_periods.values_list('subscriptionpayment__person_id',
+                                                             'subscriptionperiod_id'),
+                       self.period_bits)
+        for person_id in free_people:
+            self.covered[person_id] = self.all_bits
+        return self
+
+    @staticmethod
+    def _set_bits(rows: Dict[int, int], pairs, bits):
+        for person_id, key in pairs:
+            rows[person_id] = rows.get(person_id, 0) | bits[key]
+
+    def num_present(self, person_id: int) -> int:
+        """Count the dances that person_id attended"""
+        return self.present.get(person_id, 0).bit_count()
+
+    def is_present(self, person_id: int, dance_id: int) -> bool:
+        return bool(self.present.get(person_id, 0) & self.dance_bits[dance_id])
+
+    def is_paid(self, person_id: int, dance_id: int) -> bool:
+        return bool(self.paid.get(person_id, 0) & self.dance_bits[dance_id])
+
+    def is_covered(self, person_id: int, dance_id: int) -> bool:
+        return bool(self.covered.get(person_id, 0) & self.dance_bits[dance_id])
+
+    def codes(self, person_id: int) -> List[Tuple[str, bool]]:
+        """Find (code, covered) for each dance, in order, for person_id"""
+        present = self.present.get(person_id, 0)
+        paid = self.paid.get(person_id, 0)
+        covered = self.covered.get(person_id, 0)
+        # One bitwise pass per code, over all the dances at once
+        present_paid = present & (paid | covered)
+        present_unpaid = present & ~(paid | covered)
+        paid_absent = paid & ~present
+        row = []
+        for index in range(len(self.dances)):
+            bit = 1 << index
+            if present_paid & bit:
+                code = CODE_PRESENT_PAID
+            elif present_unpaid & bit:
+                code = CODE_PRESENT_UNPAID
+            elif paid_absent & bit:
+                code = CODE_PAID_ABSENT
+            else:
+                code = CODE_NONE
+            row.append((code, bool(covered & bit)))
+        return row
@@ -0,0 +1,69 @@
+"""Bulk inserts of payments, for the paths that record many at once
+
+Batch signin, subscription uploads, bulk subs, copy_subs, and online
+payments all write payments in bulk through here, rather than calling save()
+(and then periods.add) for each, which costs several queries per payment.
+Bulk inserts skip signals, so these add the new payments to the current
+reversion revision (if any) by hand. They don't update anything derived from
+payments (pay methods, ledgers, the payments cube); callers do that once for
+the whole batch."""
+
+import collections
+from typing import Iterable, List, Sequence, Tuple, Union
+
+from django.db.models import prefetch_related_objects
+
+import reversion
+
+import squaresdb.gate.models as gate_models
+from squaresdb.utils.bulk import bulk_create_with_pks
+
+def bulk_create_payments(payments):
+    """Insert DancePayment and SubscriptionPayment objects in bulk
+
+    bulk_create doesn't support multi-table inheritance, so this inserts the
+    Payment rows and then the rows for each subclass, much as Model.save
+    does. Like bulk_create, it doesn't send signals."""
+    parent_fields = gate_models.Payment._meta.concrete_fields
+    parents = [
+        gate_models.Payment(**{field.attname: getattr(payment, field.attname)
+                               for field in parent_fields})
+        for payment in payments
+    ]
+    bulk_create_with_pks(gate_models.Payment, parents)
+
+    by_model = collections.defaultdict(list)
+    for payment, parent in zip(payments, parents):
+        payment.id = payment.pk = parent.pk
+        by_model[type(payment)].append(payment)
+    for model, children in by_model.items():
+        fields = model._meta.local_concrete_fields
+        model._base_manager._insert(children, fields=fields) # pylint:disable=protected-access
+        for child in children:
+            child._state.adding = False # pylint:disable=protected-access
+            child._state.db = parents[0]._state.db # pylint:disable=protected-access
+
+Period = Union[gate_models.SubscriptionPeriod, str]
+
+def bulk_create_subs(subs: Sequence[Tuple[gate_models.SubscriptionPayment, Iterable[Period]]],
+                     ) -> List[gate_models.SubscriptionPayment]:
+    """Insert SubscriptionPayments, and the periods of each, in bulk
+
+    subs has (unsaved subscription, periods or their slugs) pairs. Returns
+    the subscriptions, now saved. Call this inside reversion.create_revision
+    to record them all in that revision."""
+    payments = [payment for payment, _periods in subs]
+    bulk_create_payments(payments)
+    through = gate_models.SubscriptionPayment.periods.through
+    through.objects.bulk_create([
+        through(subscriptionpayment_id=payment.pk,
+                subscriptionperiod_id=getattr(period, 'pk', period))
+        for payment, periods in subs for period in periods
+    ], batch_size=1000)
+    if reversion.is_active():
+        # Serializing the versions reads each payment's periods, so load
+        # them all in one query first
+        prefetch_related_objects(payments, 'periods')
+        for payment in payments:
+            reversion.add_to_revision(payment)
+    return payments
@@ -0,0 +1,154 @@
+"""Payments cube: counts and totals of payments, pre-aggregated by week,
+period, fee category, payment type, dance-vs-sub, and member status
+
+The cube (PaymentCube) has a row per combination of those that has any
+payments, so questions like "revenue by period and fee category, over the
+last decade" read a few thousand rows instead of every payment (see
+gate.views.pay_stats_cube).
+
+A week's rows are recomputed from its payments whenever payments in it are
+written (see refresh_payment_cube), so the cube can't drift from the
+payments the gate records. Edits in the admin (including deletes and
+reverts) refresh the weeks they touch (see gate.edits), and the
+rebuild_payment_cube command recomputes everything.
+
+Each payment is counted once: a subscription covering several periods
+counts towards the first of them."""
+
+import collections
+import datetime
+import operator
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+import squaresdb.gate.edits as gate_edits
+import squaresdb.gate.models as gate_models
+
+PaidFor = gate_models.PaymentCube.PaidFor
+
+CENTS = Decimal('0.01')
+
+# Dimensions the cube can be grouped and filtered by
+DIMENSIONS = ('week', 'period', 'fee_cat', 'payment_type', 'paid_for', 'member')
+
+
+def week_of(time: datetime.datetime) -> datetime.date:
+    """Find the (local) Monday starting the week of time"""
+    return week_of_date(timezone.localdate(time))
+
+
+def week_of_date(date: datetime.date) -> datetime.date:
+    """Find the Monday starting the week of date"""
+    return date - datetime.timedelta(days=date.weekday())
+
+
+def _week_times(week: datetime.date) -> Tuple[datetime.datetime, datetime.datetime]:
+    """Find the start and end times of a week"""
+    local = timezone.get_default_timezone()
+    start = datetime.datetime.combine(week, datetime.time.min)
+    end = start + datetime.timedelta(days=7)
+    return timezone.make_aware(start, local), timezone.make_aware(end, local)
+
+
+def _first_periods(sub_ids: List[int]) -> Dict[int, str]:
+    """Find the first period each subscription payment covers"""
+    through = gate_models.SubscriptionPayment.periods.through.objects.filter(
+        subscriptionpayment__in=sub_ids).order_by('subscriptionperiod__start_date')
+    first: Dict[int, str] = {}
+    for sub_id, period_id in through.values_list('subscriptionpayment', 'subscriptionperiod'):
+        first.setdefault(sub_id, period_id)
+    return first
+
+
+def _week_payments(weeks: List[datetime.date]) -> List[tuple]:
+    """Load the payments made in some weeks, as tuples"""
+    times = Q()
+    for week in weeks:
+        start, end = _week_times(week)
+        times |= Q(time__gte=start, time__lt=end)
+    return list(gate_models.Payment.objects.filter(times).order_by().values_list(
+        'pk', 'time', 'amount', 'payment_type', 'person__status__member',
+        # The category they paid as, if recorded
+        Coalesce('fee_cat', 'person__fee_cat'),
+        'dancepayment__pk', 'dancepayment__for_dance__period'))
+
+
+def _cells(weeks: List[datetime.date]) -> List[gate_models.PaymentCube]:
+    """Aggregate the payments made in some weeks into cube rows"""
+    payments = _week_payments(weeks)
+    sub_periods = _first_periods([row[0] for row in payments if not row[6]])
+
+    cells: Dict[tuple, List] = collections.defaultdict(lambda: [0, Decimal(0)])
+    for (pk, time, amount, payment_type, member, fee_cat,
+         dance_payment, dance_period) in payments:
+        if dance_payment:
+            paid_for, period = PaidFor.DANCE, dance_period
+        else:
+            paid_for, period = PaidFor.SUB, sub_periods.get(pk)
+        cell = cells[(week_of(time), period, fee_cat, payment_type, paid_for, member)]
+        cell[0] += 1
+        cell[1] += amount
+    return [gate_models.PaymentCube(week=week, period_id=period, fee_cat_id=fee_cat,
+                                    payment_type_id=payment_type, paid_for=paid_for,
+                                    member=member, num=num, amount=amount)
+            for (week, period, fee_cat, payment_type, paid_for, member), (num, amount)
+            in cells.items()]
+
+
+def refresh_payment_cube(times: Iterable[Optional[datetime.datetime]]) -> int:
+    """Recompute the cube for the weeks of some payment times
+
+    Call it after writing payments, in the same transaction, with their
+    times. Returns the number of rows written."""
+    weeks = sorted({week_of(time) for time in times if time})
+    if not weeks:
+        return 0
+    # No savepoint: if this fails, so should the payment writes
+    with transaction.atomic(savepoint=False):
+        # Lock the weeks' rows, so that concurrent refreshes of a week take
+        # turns, and the later one sees the earlier one's payments. (A week
+        # with no rows yet has nothing to lock, but then neither refresh
+        # deletes rows the other wrote.)
+        cells = gate_models.PaymentCube.objects.select_for_update().filter(week__in=weeks)
+        list(cells.order_by('pk').values_list('pk', flat=True))
+        rows = _cells(weeks)
+        cells.delete()
+        gate_models.PaymentCube.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+# Refreshes weeks after admin edits (see gate.edits)
+edits = gate_edits.EditTracker(operator.attrgetter('time'), refresh_payment_cube)
+
+
+def query_cube(group: Iterable[str], filters: Dict[str, List],
+               start: Optional[datetime.date] = None,
+               end: Optional[datetime.date] = None) -> Tuple[List[Dict], Dict]:
+    """Sum the cube, grouped by some dimensions and filtered on others
+
+    filters maps dimensions to the values to keep; start and end limit the
+    weeks (inclusive). Returns the grouped rows and overall totals, each with
+    num (of payments) and amount."""
+    group = list(group)
+    cells = gate_models.PaymentCube.objects.filter(
+        **{dim+'__in': values for dim, values in filters.items()})
+    if start:
+        cells = cells.filter(week__gte=week_of_date(start))
+    if end:
+        cells = cells.filter(week__lte=end)
+    totals = cells.aggregate(num=Coalesce(Sum('num'), 0),
+                             amount=Coalesce(Sum('amount'), Decimal(0)))
+    if group:
+        rows = list(cells.order_by(*group).values(*group).annotate(num=Sum('num'),
+                                                                    amount=Sum('amount')))
+    else:
+        rows = [dict(totals)]
+    # SQLite drops the trailing zeros of sums
+    for row in rows + [totals]:
+        row['amount'] = row['amount'].quantize(CENTS)
+    return rows, totals
@@ -0,0 +1,62 @@
+"""Refreshing derived tables after edits made one object at a time
+
+The gate's own views refresh the dance ledgers and the payments cube for
+everything they write in bulk. The admin saves and deletes objects one at a
+time instead, with signals, so each derived table has an EditTracker whose
+receiver (connected in GateConfig.ready) notes what the edits touched, and
+refresh_after_edits refreshes all of them once the edits are done."""
+
+import contextlib
+import threading
+from typing import Any, Callable, Iterable, List
+
+from django.db.models.signals import pre_save
+
+_trackers: List['EditTracker'] = []
+_active = threading.local()
+
+
+class EditTracker: # pylint:disable=too-few-public-methods
+    """Notes what edits to some models touched, for one derived table
+
+    key maps a saved or deleted object to what it touched (say, its dance's
+    id), and refresh is called with the set of those."""
+
+    def __init__(self, key: Callable[[Any], Any], refresh: Callable[[Iterable], Any]):
+        self.key = key
+        self.refresh = refresh
+        _trackers.append(self)
+
+    def record(self, sender, instance, **kwargs):
+        """Signal receiver for pre_save, post_save, and post_delete
+
+        pre_save notes what the object touched before the save, so (say) a
+        dance something was moved away from is refreshed too."""
+        edits = getattr(_active, 'edits', None)
+        if edits is None:
+            return
+        keys = edits[self]
+        keys.add(self.key(instance))
+        if kwargs.get('signal') is pre_save and instance.pk:
+            old = sender.objects.filter(pk=instance.pk).first()
+            if old:
+                keys.add(self.key(old))
+
+
+@contextlib.contextmanager
+def refresh_after_edits():
+    """Refresh what objects saved or deleted inside this block touched, once
+    it's done
+
+    Use it inside the block's transaction."""
+    if getattr(_active, 'edits', None) is not None:
+        # Already inside one
+        yield
+        return
+    _active.edits = {tracker: set() for tracker in _trackers}
+    try:
+        yield
+        for tracker, keys in _active.edits.items():
+            tracker.refresh(keys)
+    finally:
+        _active.edits = None
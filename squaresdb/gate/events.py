@@ -0,0 +1,152 @@
+"""Live notifications of gate activity, for server-sent events streams
+
+Code that adds to the GateChange log calls notify() with the affected dances;
+the events streams (see gate.views.signin_api_events) listen() for their dance
+and then read the log from their cursor. The log is the source of truth, so a
+notification that doesn't arrive only delays an update until the stream's
+next heartbeat, when it checks the log anyway.
+
+Notifications are per dance, so a stream for a quiet dance just waits. The
+broker is chosen by settings.GATE_EVENTS_BROKER:
+
+- "local" (the default) keeps listeners in memory, so it only reaches streams
+  served by the same process
+- a "redis://" URL uses Redis (or a compatible server) pub/sub, which reaches
+  every process, and needs the redis package"""
+
+import contextlib
+import functools
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+_CHANNEL_PREFIX = 'squaresdb:gate:dance:'
+
+
+class LocalListener:
+    """Listener for one dance, in the same process"""
+
+    def __init__(self, owner: 'LocalBroker', dance_id: int):
+        self.owner = owner
+        self.dance_id = dance_id
+        self.event = threading.Event()
+
+    def wait(self, timeout: float) -> bool:
+        """Wait for a notification, returning whether there was one"""
+        notified = self.event.wait(timeout)
+        self.event.clear()
+        return notified
+
+    def close(self):
+        self.owner.remove(self)
+
+
+class LocalBroker:
+    """In-process broker, using a threading.Event per listener"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listeners: Dict[int, List[LocalListener]] = {}
+
+    def listen(self, dance_id: int) -> LocalListener:
+        listener = LocalListener(self, dance_id)
+        with self.lock:
+            self.listeners.setdefault(dance_id, []).append(listener)
+        return listener
+
+    def remove(self, listener: LocalListener):
+        with self.lock:
+            listeners = self.listeners.get(listener.dance_id, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                self.listeners.pop(listener.dance_id, None)
+
+    def publish(self, dance_id: int):
+        with self.lock:
+            listeners = list(self.listeners.get(dance_id, []))
+        for listener in listeners:
+            listener.event.set()
+
+
+class RedisListener:
+    """Listener for one dance, subscribed to its Redis channel"""
+
+    def __init__(self, client, dance_id: int):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(_CHANNEL_PREFIX + str(dance_id))
+
+    def wait(self, timeout: float) -> bool:
+        """Wait for a notification, returning whether there was one"""
+        notified = bool(self.pubsub.get_message(timeout=timeout))
+        # Notifications are only wakeups, so collapse any backlog
+        while self.pubsub.get_message(timeout=0):
+            notified = True
+        return notified
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker:
+    """Broker using Redis (or compatible) pub/sub, shared between processes"""
+
+    def __init__(self, url: str):
+        import redis # pylint:disable=import-outside-toplevel,import-error
+        self.client = redis.Redis.from_url(url)
+
+    def listen(self, dance_id: int) -> RedisListener:
+        return RedisListener(self.client, dance_id)
+
+    def publish(self, dance_id: int):
+        self.client.publish(_CHANNEL_PREFIX + str(dance_id), 'changed')
+
+
+_broker = None # pylint:disable=invalid-name
+_broker_lock = threading.Lock()
+
+def broker():
+    """Return the broker configured by settings.GATE_EVENTS_BROKER"""
+    global _broker # pylint:disable=global-statement,invalid-name
+    with _broker_lock:
+        if _broker is None:
+            url = getattr(settings, 'GATE_EVENTS_BROKER', 'local')
+            if url == 'local':
+                _broker = LocalBroker()
+            elif url.startswith(('redis://', 'rediss://', 'unix://')):
+                _broker = RedisBroker(url)
+            else:
+                raise ValueError(f'Unknown GATE_EVENTS_BROKER {url!r}')
+        return _broker
+
+
+@contextlib.contextmanager
+def listen(dance_id: int):
+    """Listen for notifications about a dance
+
+    Start listening *before* reading the log, so that changes committed in
+    between aren't missed."""
+    listener = broker().listen(dance_id)
+    try:
+        yield listener
+    finally:
+        listener.close()
+
+
+def _publish(dance_id: int):
+    try:
+        broker().publish(dance_id)
+    except Exception: # pylint:disable=broad-exception-caught
+        # The change is saved, and streams will find it at their next heartbeat
+        logger.exception('Failed to publish gate change for dance %s', dance_id)
+
+
+def notify(dance_ids: Iterable[Optional[int]]):
+    """Notify listeners of changes to dances, once the transaction commits"""
+    for dance_id in sorted({dance_id for dance_id in dance_ids if dance_id}):
+        transaction.on_commit(functools.partial(_publish, dance_id))
@@ -0,0 +1,247 @@
+"""Columnar export of gate and money data, for offline analysis
+
+Payments, attendees, and money line items are exported (joined to a few
+attributes of the person, but not their name or email) as Parquet or Arrow
+IPC, readable by pandas, polars, DuckDB, and so on. This needs the pyarrow
+package (the "analytics" extra).
+
+Rows are read in PK order, `chunk_size` at a time, and each chunk becomes one
+record batch (or Parquet row group), so exports use about the same memory
+however big the tables get.
+
+export_to_dir (used by the export_analytics command) writes each table as a
+directory of parts, one per export, named for the range of PKs in them.
+Later exports only write rows past the highest PK already exported, so
+repeated exports just add a (usually small) part, and the directory reads as
+one table -- e.g., pandas.read_parquet("export/payment"). Rows changed after
+they were exported (say, an attendee's pay_method) aren't re-exported; pass
+full=True (--full) to rewrite everything."""
+
+import dataclasses
+import os
+import re
+from typing import Any, Iterator, List, Optional, Tuple
+
+from django.db.models import QuerySet
+
+import squaresdb.gate.models as gate_models
+import squaresdb.money.models as money_models
+
+# Rows per record batch or row group
+CHUNK_SIZE = 10000
+
+# Formats, and the extension of their files
+FORMATS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+class ExportError(Exception):
+    """Exporting isn't possible, e.g., because pyarrow isn't installed"""
+
+
+def _pyarrow():
+    try:
+        # pylint:disable=import-outside-toplevel,import-error
+        import pyarrow
+        import pyarrow.parquet # pylint:disable=unused-import
+    except ImportError as exc:
+        raise ExportError('Exporting needs pyarrow (pip install squaresdb[analytics])') from exc
+    return pyarrow
+
+
+def _arrow_type(kind: str):
+    pa = _pyarrow() # pylint:disable=invalid-name
+    return dict(
+        int=pa.int64(),
+        str=pa.string(),
+        bool=pa.bool_(),
+        time=pa.timestamp('us', tz='UTC'),
+        money=pa.decimal128(11, 2),
+    )[kind]
+
+
+@dataclasses.dataclass(frozen=True)
+class ExportTable:
+    """A table to export: columns of (name, field lookup, kind)
+
+    The kind is one of the keys of _arrow_type. The first column must be
+    the primary key."""
+    name: str
+    queryset: QuerySet
+    columns: Tuple[Tuple[str, str, str], ...]
+
+    def schema(self):
+        pa = _pyarrow() # pylint:disable=invalid-name
+        return pa.schema([(name, _arrow_type(kind)) for name, _field, kind in self.columns])
+
+    def chunks(self, since: int = 0,
+               chunk_size: int = CHUNK_SIZE) -> Iterator[List[Tuple[Any, ...]]]:
+        """Read rows with PKs above since, as lists of tuples, in PK order"""
+        fields = [field for _name, field, _kind in self.columns]
+        last_pk = since
+        while True:
+            rows = self.queryset.filter(pk__gt=last_pk).order_by('pk')
+            chunk = list(rows.values_list(*fields)[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1][0]
+
+    def record_batch(self, chunk: List[Tuple[Any, ...]]):
+        """Convert a chunk of rows to an Arrow RecordBatch"""
+        pa = _pyarrow() # pylint:disable=invalid-name
+        schema = self.schema()
+        arrays = [pa.array(values, type=field.type)
+                  for values, field in zip(zip(*chunk), schema)]
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+# Attributes of the person each row is for
+_PERSON_COLUMNS = (
+    ('person_status', 'person__status', 'str'),
+    ('person_fee_cat', 'person__fee_cat', 'str'),
+    ('person_frequency', 'person__frequency', 'str'),
+    ('person_mit_affil', 'person__mit_affil', 'str'),
+    ('person_level', 'person__level', 'str'),
+    ('person_grad_year', 'person__grad_year', 'int'),
+    ('person_join_date', 'person__join_date', 'time'),
+)
+
+TABLES = {table.name: table for table in [
+    ExportTable('payment', gate_models.Payment.objects.all(), (
+        ('id', 'pk', 'int'),
+        ('time', 'time', 'time'),
+        ('at_dance', 'at_dance', 'int'),
+        ('payment_type', 'payment_type', 'str'),
+        ('amount', 'amount', 'money'),
+        ('fee_cat', 'fee_cat', 'str'),
+        # Null for subscriptions
+        ('for_dance', 'dancepayment__for_dance', 'int'),
+        ('for_dance_period', 'dancepayment__for_dance__period', 'str'),
+        ('person', 'person', 'int'),
+    ) + _PERSON_COLUMNS),
+    ExportTable('attendee', gate_models.Attendee.objects.all(), (
+        ('id', 'pk', 'int'),
+        ('time', 'time', 'time'),
+        ('dance', 'dance', 'int'),
+        ('dance_time', 'dance__time', 'time'),
+        ('dance_period', 'dance__period', 'str'),
+        ('payment', 'payment', 'int'),
+        ('pay_method', 'pay_method', 'str'),
+        ('fee_cat', 'fee_cat', 'str'),
+        ('person', 'person', 'int'),
+    ) + _PERSON_COLUMNS),
+    ExportTable('lineitem', money_models.LineItem.objects.all(), (
+        ('id', 'pk', 'int'),
+        ('transaction', 'transaction', 'int'),
+        ('time', 'transaction__time', 'time'),
+        ('stage', 'transaction__stage', 'int'),
+        ('amount', 'amount', 'money'),
+        ('account_name', 'account_name', 'str'),
+        ('label', 'label', 'str'),
+        # Set for subscriptions bought online
+        ('sub_period', 'subscriptionlineitem__sub_period', 'str'),
+        ('person', 'subscriptionlineitem__person', 'int'),
+    ) + tuple((name, 'subscriptionlineitem__' + field, kind)
+              for name, field, kind in _PERSON_COLUMNS)),
+]}
+
+
+def _write_batches(table: ExportTable, sink, fmt: str, since: int,
+                   chunk_size: int) -> Iterator[int]:
+    """Write the rows of table with PKs above since to sink, yielding the
+    last PK written after each batch"""
+    pa = _pyarrow() # pylint:disable=invalid-name
+    if fmt == 'parquet':
+        writer = pa.parquet.ParquetWriter(sink, table.schema())
+    else:
+        writer = pa.ipc.new_stream(sink, table.schema())
+    with writer:
+        for chunk in table.chunks(since, chunk_size):
+            writer.write_batch(table.record_batch(chunk))
+            yield chunk[-1][0]
+
+
+def write_batches(table: ExportTable, sink, fmt: str, since: int = 0,
+                  chunk_size: int = CHUNK_SIZE) -> Optional[int]:
+    """Write the rows of table with PKs above since to sink (a path or
+    file-like object), as Parquet or Arrow IPC (stream) format
+
+    Returns the last PK written, or None if there weren't any rows."""
+    last_pk = None
+    for last_pk in _write_batches(table, sink, fmt, since, chunk_size):
+        pass
+    return last_pk
+
+
+class _Buffer:
+    """File-like object collecting what's written, for streaming exports"""
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        """Return (and forget) what's been written since the last take"""
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def stream_batches(table: ExportTable, fmt: str, since: int = 0,
+                   chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Export the rows of table with PKs above since, as chunks of bytes"""
+    buffer = _Buffer()
+    for _last_pk in _write_batches(table, buffer, fmt, since, chunk_size):
+        yield buffer.take()
+    # The Parquet footer, or end of stream marker
+    yield buffer.take()
+
+
+_PART_RE = re.compile(r'^part-(\d+)-(\d+)\.')
+
+def watermark(directory: str) -> int:
+    """Find the highest PK exported to a table's directory (or 0)"""
+    if not os.path.isdir(directory):
+        return 0
+    pks = [int(match.group(2)) for match in map(_PART_RE.match, os.listdir(directory))
+           if match]
+    return max(pks, default=0)
+
+
+def export_to_dir(table: ExportTable, directory: str, fmt: str, full: bool = False,
+                  chunk_size: int = CHUNK_SIZE) -> Optional[str]:
+    """Export the rows of table not yet exported to directory, as a new part
+
+    Returns the new part's path, or None if there was nothing new."""
+    if full and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if _PART_RE.match(name):
+                os.remove(os.path.join(directory, name))
+    os.makedirs(directory, exist_ok=True)
+    since = watermark(directory)
+    if not table.queryset.filter(pk__gt=since).exists():
+        return None
+    # Write to a temporary name, so an interrupted export doesn't leave a part
+    tmp_path = os.path.join(directory, f'.tmp-{os.getpid()}.{FORMATS[fmt]}')
+    try:
+        last_pk = write_batches(table, tmp_path, fmt, since, chunk_size)
+        path = os.path.join(directory, f'part-{since+1:010d}-{last_pk:010d}.{FORMATS[fmt]}')
+        os.replace(tmp_path, path)
+        return path
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
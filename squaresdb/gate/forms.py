@@ -76,7 +76,14 @@ class SubUploadForm(forms.Form):
                                                  initial=sub_periods_qs,
                                                  help_text=sub_periods_help)
 
+class SubImportForm(SubUploadForm):
+    # Staged imports are parsed in chunks, so allow multi-year exports
+    file = forms.FileField(validators=[file_size(2*10**7)])
+
 class SubPayAddForm(forms.ModelForm):
+    # Squares Pay submission, to record in a SquaresPayImport
+    webform_sid = forms.CharField(max_length=20, required=False, widget=forms.HiddenInput())
+
     class Meta:
         model = gate_models.SubscriptionPayment
         fields = ['person', 'time', 'payment_type', 'amount', 'fee_cat',
@@ -125,3 +132,41 @@ class BulkSubForm(forms.Form):
     people_qs = people_qs.select_related('fee_cat', 'frequency')
     people = forms.ModelMultipleChoiceField(queryset=people_qs,
                                             widget=forms.CheckboxSelectMultiple)
+
+
+### Voting members
+
+class DanceWindowForm(forms.Form):
+    start = forms.DateField(widget=DATE_INPUT, input_formats=['%Y-%m-%d'], required=False,
+                            help_text="First date to include (default: the voting window)")
+    end = forms.DateField(widget=DATE_INPUT, input_formats=['%Y-%m-%d'], required=False,
+                          help_text="Last date to include, and date to find voting members as of "
+                                    "(default: today)")
+
+    def clean(self):
+        data = super().clean()
+        start = data.get('start')
+        end = data.get('end')
+        if start and end and end < start:
+            self.add_error('end', 'End date must not be before start date')
+        return data
+
+
+### Payment statistics
+
+class PayStatsForm(forms.Form):
+    start = forms.DateField(widget=DATE_INPUT, input_formats=['%Y-%m-%d'], required=False,
+                            help_text="Earliest date to include (default: two years ago)")
+    end = forms.DateField(widget=DATE_INPUT, input_formats=['%Y-%m-%d'], required=False,
+                          help_text="Latest date to include (default: no limit)")
+    period_qs = gate_models.SubscriptionPeriod.objects.order_by('-start_date')
+    period = forms.ModelChoiceField(queryset=period_qs, required=False,
+                                    help_text="Only this period (instead of dates)")
+
+    def clean(self):
+        data = super().clean()
+        start = data.get('start')
+        end = data.get('end')
+        if start and end and end < start:
+            self.add_error('end', 'End date must not be before start date')
+        return data
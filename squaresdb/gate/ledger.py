@@ -0,0 +1,121 @@
+"""Per-dance ledger (books summary), materialized in DanceLedger
+
+The books page shows attendee counts and payment subtotals for a dance.
+Rather than grouping the dance's attendees and payments on every load, they
+are summarized into DanceLedger rows whenever the gate records something, so
+books for any dance are one indexed read (see dance_ledger).
+
+Refreshing recomputes the summary of each affected dance, rather than
+applying deltas, so it can't drift: the code that writes attendees and
+payments calls refresh_dance_ledgers with the dances it touched, edits in
+the admin (including deletes and reverts) refresh the dances they touch
+(see gate.edits), and the rebuild_dance_ledger command covers everything
+else."""
+
+import collections
+from typing import Any, Dict, Iterable, Optional
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Coalesce
+
+import squaresdb.gate.edits as gate_edits
+import squaresdb.gate.models as gate_models
+
+Kind = gate_models.DanceLedger.Kind
+
+
+def _attendee_rows(dance_ids):
+    attendees = gate_models.Attendee.objects.filter(dance__in=dance_ids).order_by()
+    attendees = attendees.values(
+        'dance', 'pay_method', 'fee_cat',
+        ledger_member=F('person__status__member'),
+    ).annotate(num=Count('pk'))
+    for row in attendees:
+        yield gate_models.DanceLedger(dance_id=row['dance'], kind=Kind.ATTENDEE,
+                                      pay_method=row['pay_method'],
+                                      member=row['ledger_member'],
+                                      fee_cat_id=row['fee_cat'], num=row['num'])
+
+
+def _payment_rows(dance_ids):
+    payments = gate_models.Payment.objects.filter(at_dance__in=dance_ids).order_by()
+    payments = payments.values(
+        'at_dance', 'payment_type',
+        ledger_for_dance=F('dancepayment__for_dance'),
+        ledger_member=F('person__status__member'),
+        # The category they paid as, if recorded
+        ledger_fee_cat=Coalesce('fee_cat', 'person__fee_cat'),
+    ).annotate(num=Count('pk'), total=Sum('amount'))
+    for row in payments:
+        yield gate_models.DanceLedger(dance_id=row['at_dance'], kind=Kind.PAYMENT,
+                                      for_dance_id=row['ledger_for_dance'],
+                                      member=row['ledger_member'],
+                                      fee_cat_id=row['ledger_fee_cat'],
+                                      payment_type_id=row['payment_type'],
+                                      num=row['num'], amount=row['total'])
+
+
+def refresh_dance_ledgers(dance_ids: Iterable[Optional[int]]) -> int:
+    """Recompute the ledger of some dances, returning the number of rows
+
+    This uses a fixed number of queries however many dances there are.
+    Call it after writing the dances' attendees or payments, in the same
+    transaction."""
+    dance_ids = sorted({dance_id for dance_id in dance_ids if dance_id})
+    if not dance_ids:
+        return 0
+    # No savepoint: if this fails, so should the writes it summarizes
+    with transaction.atomic(savepoint=False):
+        # Lock the dances, so that concurrent refreshes of a dance take turns,
+        # and the later one sees the earlier one's writes
+        dances = gate_models.Dance.objects.select_for_update().filter(pk__in=dance_ids)
+        list(dances.values_list('pk', flat=True))
+        rows = list(_attendee_rows(dance_ids)) + list(_payment_rows(dance_ids))
+        gate_models.DanceLedger.objects.filter(dance__in=dance_ids).delete()
+        gate_models.DanceLedger.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+def _edited_dance(obj) -> Optional[int]:
+    """Find the dance an attendee or payment counts towards"""
+    return obj.dance_id if isinstance(obj, gate_models.Attendee) else obj.at_dance_id
+
+# Refreshes dances after admin edits (see gate.edits)
+edits = gate_edits.EditTracker(_edited_dance, refresh_dance_ledgers)
+
+
+def dance_ledger(dance: gate_models.Dance) -> Dict[str, Any]:
+    """Read the books summary for a dance from its ledger, in one query
+
+    Returns attendee counts (num_attendees, num_mit, num_members, and
+    pay_method_counts),
+    payment_subtotals (DanceLedger rows, latest dance paid for first and
+    subscriptions last), and payment_totals (payment type name -> amount)."""
+    rows = gate_models.DanceLedger.objects.filter(dance=dance)
+    rows = rows.select_related('for_dance', 'fee_cat', 'payment_type')
+    rows = rows.order_by('kind', F('for_dance__time').desc(nulls_last=True),
+                         F('member').desc(), 'fee_cat__name', 'payment_type__name')
+
+    num_mit = num_members = 0
+    pay_method_nums: Dict[str, int] = collections.Counter()
+    payment_subtotals = []
+    payment_totals: Dict[str, Any] = collections.Counter()
+    for row in rows:
+        if row.kind == Kind.ATTENDEE:
+            if row.fee_cat_id == 'mit-student':
+                num_mit += row.num
+            if row.member:
+                num_members += row.num
+            pay_method_nums[row.pay_method] += row.num
+        elif row.payment_type:
+            payment_subtotals.append(row)
+            payment_totals[row.payment_type.name] += row.amount
+    pay_method_counts = [dict(label=label, num=pay_method_nums[value])
+                         for value, label in gate_models.Attendee.PayMethod.choices
+                         if value in pay_method_nums]
+    return dict(num_attendees=sum(pay_method_nums.values()), num_mit=num_mit,
+                num_members=num_members,
+                pay_method_counts=pay_method_counts,
+                payment_subtotals=payment_subtotals,
+                payment_totals=payment_totals)
@@ -0,0 +1,84 @@
+import bisect
+import collections
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from reversion.models import Version
+
+from squaresdb.gate.ledger import refresh_dance_ledgers
+from squaresdb.gate.models import Attendee, refresh_attendee_pay_methods
+from squaresdb.membership.models import Person
+
+
+def _historical_fee_cats(person_ids):
+    """Find each person's fee category over time, from reversion history
+
+    Returns a dict mapping person id to a list of (time, fee_cat slug),
+    sorted by time."""
+    versions = Version.objects.get_for_model(Person)
+    versions = versions.filter(object_id__in=[str(pk) for pk in person_ids])
+    versions = versions.select_related('revision').order_by('revision__date_created')
+    history = collections.defaultdict(list)
+    for version in versions:
+        if version.format != 'json':
+            continue
+        try:
+            fields = json.loads(version.serialized_data)[0]['fields']
+        except (ValueError, LookupError):
+            continue
+        if fields.get('fee_cat'):
+            history[int(version.object_id)].append((version.revision.date_created,
+                                                    fields['fee_cat']))
+    return history
+
+
+def _fee_cat_at(history, attendee):
+    """Find the person's fee category when they attended"""
+    if attendee.payment_id and attendee.payment.fee_cat_id:
+        return attendee.payment.fee_cat_id
+    changes = history.get(attendee.person_id, [])
+    index = bisect.bisect_right([time for time, _slug in changes], attendee.time)
+    if index:
+        return changes[index-1][1]
+    # No history from before they attended, so assume it hasn't changed
+    return attendee.person.fee_cat_id
+
+
+class Command(BaseCommand):
+    help = ('Fills in Attendee.fee_cat and recomputes Attendee.pay_method '
+            '(and the ledgers of the dances involved)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        num_attendees = 0
+        num_fee_cats = 0
+        num_changed = 0
+        while True:
+            with transaction.atomic():
+                batch = Attendee.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size]
+                batch = list(batch.select_related('person', 'payment'))
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                num_attendees += len(batch)
+
+                missing = [attendee for attendee in batch if not attendee.fee_cat_id]
+                history = _historical_fee_cats({attendee.person_id for attendee in missing})
+                for attendee in missing:
+                    attendee.fee_cat_id = _fee_cat_at(history, attendee)
+                Attendee.objects.bulk_update(missing, ['fee_cat'])
+                num_fee_cats += len(missing)
+
+                batch_qs = Attendee.objects.filter(pk__in=[attendee.pk for attendee in batch])
+                num_changed += refresh_attendee_pay_methods(batch_qs)
+                refresh_dance_ledgers({attendee.dance_id for attendee in batch})
+
+        msg = 'Checked %d attendees: filled in %d fee categories, updated %d pay methods' % (
+            num_attendees, num_fee_cats, num_changed, )
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -1,6 +1,10 @@
 from django.core.management.base import BaseCommand, CommandError
 
 from squaresdb.gate.models import PaymentMethod, SubscriptionPeriod, SubscriptionPayment
+from squaresdb.gate.models import Attendee, refresh_attendee_pay_methods
+from squaresdb.gate.bulk import bulk_create_subs
+from squaresdb.gate.cube import refresh_payment_cube
+from squaresdb.gate.ledger import refresh_dance_ledgers
 
 import reversion
 
@@ -31,14 +35,14 @@ class Command(BaseCommand):
         no_emails = []
         with reversion.create_revision(atomic=True):
             reversion.set_comment("bulk sub copy: " + comment)
-            for payment in from_payments:
-                # Copy the sub
-                kwargs = dict(person=payment.person, payment_type=payment_type,
-                              amount=0, notes=comment)
-                new_pay = SubscriptionPayment(**kwargs)
-                new_pay.save()
-                new_pay.periods.add(to_period)
+            # Copy the subs
+            new_pays = bulk_create_subs([
+                (SubscriptionPayment(person=payment.person, payment_type=payment_type,
+                                     amount=0, notes=comment), [to_period])
+                for payment in from_payments
+            ])
 
+            for payment in from_payments:
                 # Build a list of emails
                 name = payment.person.name
                 assert '"' not in name
@@ -52,6 +56,13 @@ class Command(BaseCommand):
                     else:
                         no_emails.append(name)
 
+            # Usually nobody has attended to_period yet, but just in case
+            people = [payment.person_id for payment in from_payments]
+            attendees = Attendee.objects.filter(person__in=people, dance__period=to_period)
+            if refresh_attendee_pay_methods(attendees):
+                refresh_dance_ledgers(attendees.values_list('dance', flat=True))
+            refresh_payment_cube(new_pay.time for new_pay in new_pays)
+
         msg = 'Copied %d subscriptions' % (len(from_payments, ))
         self.stdout.write(self.style.SUCCESS(msg))
         self.stdout.write(self.style.SUCCESS("Emails: ") + ', '.join(paid_emails))
@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from squaresdb.gate.export import CHUNK_SIZE, FORMATS, TABLES, ExportError, export_to_dir
+
+
+class Command(BaseCommand):
+    help = ('Exports payments, attendees, and line items as Parquet or Arrow, '
+            'adding only rows not exported before')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory to write a subdirectory per table to')
+        parser.add_argument('--table', action='append', choices=sorted(TABLES),
+                            help='Table to export (may repeat; default: all)')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='parquet')
+        parser.add_argument('--full', action='store_true',
+                            help='Rewrite previously exported rows too')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Rows per row group (or record batch)')
+
+    def handle(self, *args, **options):
+        for name in options['table'] or sorted(TABLES):
+            directory = os.path.join(options['directory'], name)
+            try:
+                path = export_to_dir(TABLES[name], directory, options['format'],
+                                     full=options['full'], chunk_size=options['chunk_size'])
+            except ExportError as exc:
+                raise CommandError(str(exc)) from exc
+            if path:
+                self.stdout.write(self.style.SUCCESS('Exported %s to %s' % (name, path)))
+            else:
+                self.stdout.write('No new rows in %s' % (name, ))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from squaresdb.gate.ledger import refresh_dance_ledgers
+from squaresdb.gate.models import Dance
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the books summary (DanceLedger) of dances'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dances', nargs='*', type=int, metavar='dance',
+                            help='Dance ids to rebuild (default: all dances)')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Number of dances to rebuild per transaction')
+
+    def handle(self, *args, **options):
+        dance_ids = options['dances']
+        if not dance_ids:
+            dance_ids = list(Dance.objects.order_by('pk').values_list('pk', flat=True))
+        batch_size = options['batch_size']
+        num_rows = 0
+        for start in range(0, len(dance_ids), batch_size):
+            num_rows += refresh_dance_ledgers(dance_ids[start:start+batch_size])
+
+        msg = 'Rebuilt the ledger of %d dances (%d rows)' % (len(dance_ids), num_rows)
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from squaresdb.gate.cube import refresh_payment_cube, week_of
+from squaresdb.gate.models import Payment, PaymentCube
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the payments cube (PaymentCube) from all payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=26,
+                            help='Number of weeks to rebuild per transaction')
+
+    def handle(self, *args, **options):
+        times = list(Payment.objects.datetimes('time', 'week'))
+        weeks = sorted({week_of(time) for time in times})
+        # Weeks whose payments have all been deleted
+        PaymentCube.objects.exclude(week__in=weeks).delete()
+        batch_size = options['batch_size']
+        num_rows = 0
+        for start in range(0, len(times), batch_size):
+            num_rows += refresh_payment_cube(times[start:start+batch_size])
+
+        msg = 'Rebuilt the payments cube for %d weeks (%d rows)' % (len(weeks), num_rows)
+        self.stdout.write(self.style.SUCCESS(msg))
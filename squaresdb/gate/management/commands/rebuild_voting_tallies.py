@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from squaresdb.gate.models import VotingTally
+from squaresdb.gate.voting import refresh_voting_tallies
+from squaresdb.membership.models import Person
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the attendance counts used to find voting members'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Number of people to recompute at a time')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # Tallies of people who no longer exist go with them (by CASCADE), so
+        # only the people who do exist need recomputing
+        person_ids = list(Person.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(person_ids), batch_size):
+            refresh_voting_tallies(person_ids[start:start+batch_size])
+
+        msg = 'Recomputed voting tallies for %d people (%d rows)' % (
+            len(person_ids), VotingTally.objects.count(), )
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -0,0 +1,30 @@
+import csv
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from squaresdb.gate.models import Dance
+from squaresdb.gate.voting import as_of_time, refresh_voting_tallies, voting_people
+
+
+class Command(BaseCommand):
+    help = 'Lists the voting members as of a date (such as an election), as CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('date', type=datetime.date.fromisoformat,
+                            help='Date to find voting members as of (YYYY-MM-DD)')
+
+    def handle(self, *args, **options):
+        as_of = as_of_time(options['date'])
+        # Make sure the tallies as of then are current
+        anchor = Dance.objects.filter(time__lte=as_of).order_by('-time', '-pk').first()
+        if anchor:
+            refresh_voting_tallies(dance_ids=[anchor.pk])
+
+        people = voting_people(as_of).order_by('name')
+        writer = csv.writer(self.stdout)
+        writer.writerow(['name', 'email', 'dances'])
+        for person in people:
+            writer.writerow([person.name, person.email, person.voting_num])
+        self.stderr.write(self.style.SUCCESS('%d voting members as of %s' % (
+            len(people), options['date'], )))
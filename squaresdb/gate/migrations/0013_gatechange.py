@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0012_online_payments'),
+        ('membership', '0010_autofield'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GateChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('kind', models.CharField(choices=[('attendee', 'Attendee'), ('payment', 'Payment')], max_length=10)),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10)),
+                ('object_id', models.IntegerField()),
+                ('data', models.JSONField(default=dict)),
+                ('dance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gate.dance')),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='membership.person')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dance', 'id'], name='gate_change_dance_cursor')],
+            },
+        ),
+    ]
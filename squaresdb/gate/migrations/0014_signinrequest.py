@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:04
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0013_gatechange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SigninRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('status', models.PositiveSmallIntegerField()),
+                ('response', models.JSONField(default=dict)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0014_signinrequest'),
+        ('membership', '0010_autofield'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attendee',
+            name='fee_cat',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='membership.feecategory'),
+        ),
+        migrations.AddField(
+            model_name='attendee',
+            name='pay_method',
+            field=models.CharField(choices=[('none', 'Not paid'), ('free', 'Free admission'), ('sub', 'Subscription'), ('dance', 'Paid for the dance')], default='none', max_length=5),
+        ),
+        migrations.AddIndex(
+            model_name='attendee',
+            index=models.Index(fields=['dance', 'pay_method'], name='gate_attendee_pay_method'),
+        ),
+    ]
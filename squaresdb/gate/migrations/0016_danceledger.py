@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0015_attendee_pay_method'),
+        ('membership', '0011_personsearchterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DanceLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('attendee', 'Attendee'), ('payment', 'Payment')], max_length=10)),
+                ('pay_method', models.CharField(blank=True, choices=[('none', 'Not paid'), ('free', 'Free admission'), ('sub', 'Subscription'), ('dance', 'Paid for the dance')], max_length=5)),
+                ('member', models.BooleanField(null=True)),
+                ('num', models.IntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=9)),
+                ('dance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gate.dance')),
+                ('fee_cat', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='membership.feecategory')),
+                ('for_dance', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='gate.dance')),
+                ('payment_type', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='gate.paymentmethod')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dance', 'kind'], name='gate_ledger_dance')],
+            },
+        ),
+    ]
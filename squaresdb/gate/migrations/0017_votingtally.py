@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0016_danceledger'),
+        ('membership', '0011_personsearchterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VotingTally',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num', models.PositiveSmallIntegerField()),
+                ('dance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gate.dance')),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='membership.person')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dance', 'num'], name='gate_voting_tally_num')],
+                'constraints': [models.UniqueConstraint(fields=('dance', 'person'), name='gate_voting_tally_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0017_votingtally'),
+        ('membership', '0011_personsearchterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentCube',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('week', models.DateField()),
+                ('paid_for', models.CharField(choices=[('dance', 'Dance'), ('sub', 'Sub')], max_length=5)),
+                ('member', models.BooleanField(null=True)),
+                ('num', models.IntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=11)),
+                ('fee_cat', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='membership.feecategory')),
+                ('payment_type', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='gate.paymentmethod')),
+                ('period', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='gate.subscriptionperiod')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['week'], name='gate_payment_cube_week'), models.Index(fields=['period', 'week'], name='gate_payment_cube_period')],
+            },
+        ),
+    ]
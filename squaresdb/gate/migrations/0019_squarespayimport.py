@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:06
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0018_paymentcube'),
+        ('membership', '0011_personsearchterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SquaresPayImport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('webform_sid', models.CharField(max_length=20)),
+                ('time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('payment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='gate.subscriptionpayment')),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='membership.person')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('webform_sid', 'person'), name='gate_squarespay_import_unique')],
+            },
+        ),
+    ]
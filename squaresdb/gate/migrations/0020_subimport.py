@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:09
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0019_squarespayimport'),
+        ('membership', '0011_personsearchterm'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubImportBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('filename', models.CharField(max_length=255)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SubImportRow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line', models.IntegerField()),
+                ('webform_sid', models.CharField(blank=True, max_length=20)),
+                ('name', models.CharField(max_length=255)),
+                ('time', models.DateTimeField(blank=True, null=True)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('periods', models.JSONField(default=list)),
+                ('notes', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('ready', 'Ready'), ('error', 'Error'), ('skipped', 'Skipped'), ('imported', 'Imported')], max_length=10)),
+                ('message', models.TextField(blank=True)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rows', to='gate.subimportbatch')),
+                ('payment', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='gate.subscriptionpayment')),
+                ('person', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='membership.person')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['batch', 'line'], name='gate_sub_import_line'), models.Index(fields=['batch', 'status', 'id'], name='gate_sub_import_status')],
+            },
+        ),
+    ]
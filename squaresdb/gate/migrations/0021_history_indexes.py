@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gate', '0020_subimport'),
+        ('membership', '0012_personauthlink_expire'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='attendee',
+            index=models.Index(fields=['person', 'dance'], name='gate_attendee_person'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['person', 'time'], name='gate_payment_person_time'),
+        ),
+    ]
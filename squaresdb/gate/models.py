@@ -1,3 +1,4 @@
+from django.contrib.auth import get_user_model
 from django.db import models
 from django.urls import reverse
 from django.utils import timezone
@@ -9,6 +10,9 @@ import squaresdb.money.models as money_models
 
 # Create your models here.
 
+# People in these fee categories get in free
+FREE_FEE_CATS = ('mit-student', )
+
 def format_price_range(low, high):
     return f"${low}" if low == high else f"${low}-{high}"
 
@@ -100,6 +104,12 @@ class Payment(models.Model):
                                 on_delete=models.PROTECT)
     notes = models.TextField(blank=True)
 
+    class Meta:
+        indexes = [
+            # For a person's history (see membership.history)
+            models.Index(fields=['person', 'time'], name='gate_payment_person_time'),
+        ]
+
 
 @reversion.register
 class SubscriptionPayment(Payment):
@@ -125,19 +135,29 @@ class Attendee(models.Model):
     #   another night.
     payment = models.ForeignKey(Payment, blank=True, null=True,
                                 on_delete=models.PROTECT)
-    # TODO: Add pay_method field? Values "none", "free", "sub", "dance",
-    # reflecting whether they failed to pay, get admission free, have a
-    # subscription, or paid for a single dance.
-    # "Have they paid?" then becomes pay_method != none
-    # Right now, figuring this out requires checking for a sub or dance
-    # payment, and also *digging into the history* to figure out if their
-    # fee category was mit-student *at the time*
-    # Alternatively, record their fee category or the price their fee category
-    # owed at time of purchase. This makes the read logic more complicated --
-    # still need to check for a dance or sub -- but we don't need to update
-    # Attendee records based on later payment.
+
+    class PayMethod(models.TextChoices): # pylint:disable=too-many-ancestors
+        NONE = 'none', 'Not paid'
+        FREE = 'free', 'Free admission'
+        SUB = 'sub', 'Subscription'
+        DANCE = 'dance', 'Paid for the dance'
+
+    # How they paid (or didn't), so "have they paid?" is pay_method != none.
+    # This is denormalized from dance and sub payments (and fee_cat), and
+    # kept up to date by refresh_attendee_pay_methods, which the code that
+    # records payments calls. The backfill_pay_method command recomputes it.
+    pay_method = models.CharField(max_length=5, choices=PayMethod,
+                                  default=PayMethod.NONE)
+    # Fee category when they attended (Person.fee_cat may change later)
+    fee_cat = models.ForeignKey(member_models.FeeCategory, blank=True, null=True,
+                                on_delete=models.PROTECT)
 
     class Meta:
+        indexes = [
+            models.Index(fields=['dance', 'pay_method'], name='gate_attendee_pay_method'),
+            # For a person's history (see membership.history)
+            models.Index(fields=['person', 'dance'], name='gate_attendee_person'),
+        ]
         permissions = (
             ("signin_app", "Can use signin app"),
             # In general, signin (gate) is more sensitive than books -- both
@@ -151,6 +171,235 @@ class Attendee(models.Model):
         )
 
 
+def refresh_attendee_pay_methods(attendees: models.QuerySet) -> int:
+    """Recompute pay_method (and fill in a missing fee_cat) for attendees
+
+    Call this with the attendees that a new or deleted payment might cover.
+    It uses a fixed number of queries, and returns the number of attendees
+    that changed."""
+    dance_payments = DancePayment.objects.filter(person=models.OuterRef('person'),
+                                                 for_dance=models.OuterRef('dance'))
+    subscriptions = SubscriptionPayment.objects.filter(person=models.OuterRef('person'),
+                                                       periods=models.OuterRef('dance__period'))
+    attendees = attendees.annotate(paid_dance=models.Exists(dance_payments),
+                                   is_subscriber=models.Exists(subscriptions))
+    attendees = attendees.select_related('person')
+    changed = []
+    for attendee in attendees:
+        fee_cat_id = attendee.fee_cat_id or attendee.person.fee_cat_id
+        if attendee.paid_dance:
+            pay_method = Attendee.PayMethod.DANCE
+        elif attendee.is_subscriber:
+            pay_method = Attendee.PayMethod.SUB
+        elif fee_cat_id in FREE_FEE_CATS:
+            pay_method = Attendee.PayMethod.FREE
+        else:
+            pay_method = Attendee.PayMethod.NONE
+        if (pay_method, fee_cat_id) != (attendee.pay_method, attendee.fee_cat_id):
+            attendee.pay_method = pay_method
+            attendee.fee_cat_id = fee_cat_id
+            changed.append(attendee)
+    Attendee.objects.bulk_update(changed, ['pay_method', 'fee_cat'], batch_size=500)
+    return len(changed)
+
+
+class DanceLedger(models.Model):
+    """Attendee counts and payment totals for a dance, by group (see gate.ledger)"""
+
+    class Kind(models.TextChoices): # pylint:disable=too-many-ancestors
+        ATTENDEE = 'attendee'
+        PAYMENT = 'payment'
+
+    dance = models.ForeignKey(Dance, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=Kind)
+    # Attendees are grouped by pay_method, member, and fee_cat; payments by
+    # for_dance (blank for subscriptions), member, fee_cat, and payment_type
+    pay_method = models.CharField(max_length=5, blank=True,
+                                  choices=Attendee.PayMethod)
+    for_dance = models.ForeignKey(Dance, blank=True, null=True, related_name='+',
+                                  on_delete=models.CASCADE)
+    member = models.BooleanField(null=True)
+    fee_cat = models.ForeignKey(member_models.FeeCategory, blank=True, null=True,
+                                on_delete=models.PROTECT)
+    payment_type = models.ForeignKey(PaymentMethod, blank=True, null=True,
+                                     on_delete=models.PROTECT)
+    num = models.IntegerField()
+    amount = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dance', 'kind'], name='gate_ledger_dance'),
+        ]
+
+
+class PaymentCube(models.Model):
+    """Payment counts and totals, by week and a few other dimensions (see gate.cube)"""
+
+    class PaidFor(models.TextChoices): # pylint:disable=too-many-ancestors
+        DANCE = 'dance'
+        SUB = 'sub'
+
+    # Week the payment was made, as the (local) Monday starting it
+    week = models.DateField()
+    # Period of the dance paid for, or the (first) period subscribed for
+    period = models.ForeignKey(SubscriptionPeriod, blank=True, null=True,
+                               on_delete=models.CASCADE)
+    fee_cat = models.ForeignKey(member_models.FeeCategory, blank=True, null=True,
+                                on_delete=models.PROTECT)
+    payment_type = models.ForeignKey(PaymentMethod, on_delete=models.PROTECT)
+    paid_for = models.CharField(max_length=5, choices=PaidFor)
+    member = models.BooleanField(null=True)
+    num = models.IntegerField()
+    amount = models.DecimalField(max_digits=11, decimal_places=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['week'], name='gate_payment_cube_week'),
+            models.Index(fields=['period', 'week'], name='gate_payment_cube_period'),
+        ]
+
+
+class VotingTally(models.Model):
+    """How many counted dances a person attended in the voting window ending
+    at a dance (see gate.voting)
+
+    People with no counted dances in a window have no row."""
+    dance = models.ForeignKey(Dance, on_delete=models.CASCADE)
+    person = models.ForeignKey(member_models.Person, on_delete=models.CASCADE)
+    num = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dance', 'person'], name='gate_voting_tally_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['dance', 'num'], name='gate_voting_tally_num'),
+        ]
+
+
+class GateChange(models.Model):
+    """Log of attendance and payment changes affecting a dance
+
+    Gate stations poll this, using the pk as a cursor, to pick up changes made
+    by other stations without reloading the whole roster."""
+
+    class Kind(models.TextChoices): # pylint:disable=too-many-ancestors
+        ATTENDEE = 'attendee'
+        PAYMENT = 'payment'
+
+    class Action(models.TextChoices): # pylint:disable=too-many-ancestors
+        CREATE = 'create'
+        UPDATE = 'update'
+        DELETE = 'delete'
+
+    dance = models.ForeignKey(Dance, on_delete=models.CASCADE)
+    time = models.DateTimeField(default=timezone.now)
+    kind = models.CharField(max_length=10, choices=Kind)
+    action = models.CharField(max_length=10, choices=Action)
+    # Not a ForeignKey, since the object may have been deleted
+    object_id = models.IntegerField()
+    person = models.ForeignKey(member_models.Person, on_delete=models.CASCADE)
+    data = models.JSONField(default=dict)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dance', 'id'], name='gate_change_dance_cursor'),
+        ]
+
+
+class SigninRequest(models.Model):
+    """Stored response to a signin API request made with an idempotency key
+
+    The signin page sends a fresh key with each write, so that a request
+    retried after a network failure gets the original response back, rather
+    than (say) recording a payment twice."""
+    key = models.CharField(max_length=64, unique=True)
+    time = models.DateTimeField(default=timezone.now)
+    status = models.PositiveSmallIntegerField()
+    response = models.JSONField(default=dict)
+
+    def __str__(self):
+        return f"{self.key} ({self.status})"
+
+
+@reversion.register
+class SquaresPayImport(models.Model):
+    """Link from a subscription to the Squares Pay submission it came from
+
+    Subscription uploads skip submissions that were already imported, so
+    that the treasurer can upload overlapping (say, cumulative) exports. A
+    submission paying for several people has a row for each of them."""
+    # Drupal's site-wide submission id (see find_subs_from_upload)
+    webform_sid = models.CharField(max_length=20)
+    person = models.ForeignKey(member_models.Person, on_delete=models.PROTECT)
+    payment = models.OneToOneField(SubscriptionPayment, on_delete=models.CASCADE)
+    time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['webform_sid', 'person'],
+                                    name='gate_squarespay_import_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.webform_sid} ({self.person})"
+
+
+class SubImportBatch(models.Model):
+    """A Squares Pay export, staged for review before importing
+
+    Uploads are parsed into SubImportRows a chunk at a time, so big exports
+    (say, a multi-year backfill) can be reviewed a page at a time and
+    imported in chunks."""
+    time = models.DateTimeField(default=timezone.now)
+    user = models.ForeignKey(get_user_model(), on_delete=models.PROTECT,
+                             blank=True, null=True)
+    filename = models.CharField(max_length=255)
+
+    def __str__(self):
+        return f"{self.filename} ({self.time})"
+
+    def get_absolute_url(self):
+        return reverse('gate:sub-import-batch', args=[self.pk])
+
+
+class SubImportRow(models.Model):
+    """A subscription (or a problem) parsed from a row of a SubImportBatch
+
+    A row paying for several people has a SubImportRow for each of them."""
+
+    class Status(models.TextChoices): # pylint:disable=too-many-ancestors
+        READY = 'ready'
+        ERROR = 'error'
+        SKIPPED = 'skipped'
+        IMPORTED = 'imported'
+
+    batch = models.ForeignKey(SubImportBatch, on_delete=models.CASCADE, related_name='rows')
+    # Line of the file the row came from
+    line = models.IntegerField()
+    webform_sid = models.CharField(max_length=20, blank=True)
+    # Name(s) as given in the file
+    name = models.CharField(max_length=255)
+    person = models.ForeignKey(member_models.Person, blank=True, null=True,
+                               on_delete=models.SET_NULL)
+    time = models.DateTimeField(blank=True, null=True)
+    amount = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
+    # Slugs of the periods subscribed for
+    periods = models.JSONField(default=list)
+    notes = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=Status)
+    # Why the row is an error, or was skipped
+    message = models.TextField(blank=True)
+    payment = models.OneToOneField(SubscriptionPayment, blank=True, null=True,
+                                   on_delete=models.SET_NULL)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['batch', 'line'], name='gate_sub_import_line'),
+            models.Index(fields=['batch', 'status', 'id'], name='gate_sub_import_status'),
+        ]
+
+
 ### (Online) Payments
 
 # Most models live in the reusable-ish money app; these are the SquaresDB
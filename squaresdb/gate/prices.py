@@ -0,0 +1,112 @@
+"""Price matrix (fee category x product), cached
+
+Prices change a few times a year, but the matrix is needed on every signin
+page load and online payment form. It's cached in Django's cache framework,
+and the cache is invalidated (by signals connected in GateConfig.ready)
+whenever prices, price schemes, periods, or fee categories change.
+
+Invalidation bumps a "generation" stored in the cache, so it only reaches
+other processes if they share a cache backend. Cached matrices also expire
+after PRICE_CACHE_TIMEOUT, which bounds how stale they can get otherwise
+(and covers changes that skip signals, like QuerySet.update)."""
+
+import collections
+import uuid
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+from django.core.cache import cache
+from django.db import transaction
+
+import squaresdb.gate.models as gate_models
+import squaresdb.membership.models as member_models
+
+PRICE_CACHE_TIMEOUT = 60*60
+_GENERATION_KEY = 'gate:prices:generation'
+
+# (low, high, description) -- eg, (8, 12, "$8-12")
+Price = Tuple[int, int, str]
+
+
+def build_price_matrix_col(fee_cat_prices, slug, price_set):
+    """Fill in a column of the price matrix"""
+    for price in price_set.select_related('fee_cat'):
+        for_cat = fee_cat_prices[price.fee_cat.slug]
+        for_cat['cat_name'] = price.fee_cat.name
+        price_range = gate_models.format_price_range(price.low, price.high)
+        for_cat['prices'][slug] = (price.low, price.high, price_range)
+
+
+def build_price_matrix(price_scheme_id, periods):
+    """Build a matrix of fee category x product (dance or period), uncached"""
+    default = collections.OrderedDict()
+    if price_scheme_id:
+        default['dance'] = None
+    for period in periods:
+        default[period.slug] = None
+    matrix = collections.defaultdict(lambda: dict(prices=default.copy()))
+
+    if price_scheme_id:
+        dance_prices = gate_models.DancePrice.objects.filter(price_scheme_id=price_scheme_id)
+        build_price_matrix_col(matrix, 'dance', dance_prices)
+    for period in periods:
+        build_price_matrix_col(matrix, period.slug, period.subscriptionperiodprice_set)
+
+    # We convert matrix to a real dict, because otherwise when Django templates
+    # check if there's an "items" key, the defaultdict will create that key...
+    return dict(**matrix)
+
+
+def _generation():
+    generation = cache.get(_GENERATION_KEY)
+    if generation is None:
+        cache.add(_GENERATION_KEY, uuid.uuid4().hex, None)
+        generation = cache.get(_GENERATION_KEY)
+    return generation
+
+
+def _bump_generation():
+    cache.set(_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+def invalidate(**kwargs): # pylint:disable=unused-argument
+    """Forget all cached price matrices (usable as a signal receiver)
+
+    This waits for the current transaction (if any) to commit, so another
+    process can't cache the old prices again in between."""
+    transaction.on_commit(_bump_generation)
+
+
+def price_matrix(dance: Optional[gate_models.Dance],
+                 periods: Iterable[gate_models.SubscriptionPeriod]) -> Dict:
+    """Return the price matrix for a dance (if any) and some periods
+
+    The matrix maps fee category slugs to dicts with the category's name
+    (`cat_name`) and `prices`, an ordered dict from product ('dance' or period
+    slug) to Price (or None, if no price is set)."""
+    periods = list(periods)
+    price_scheme_id = dance.price_scheme_id if dance else None
+    period_slugs = ','.join(period.slug for period in periods)
+    key = f'gate:prices:{_generation()}:{price_scheme_id}:{period_slugs}'
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = build_price_matrix(price_scheme_id, periods)
+        cache.set(key, matrix, PRICE_CACHE_TIMEOUT)
+    return matrix
+
+
+def price_for(fee_cat: Union[member_models.FeeCategory, str],
+              product: Union[gate_models.Dance, gate_models.SubscriptionPeriod],
+              ) -> Optional[Price]:
+    """Look up what fee_cat pays for product (a dance or sub period)
+
+    fee_cat may be a FeeCategory or its slug. Returns None if no price is
+    set."""
+    if isinstance(product, gate_models.Dance):
+        matrix = price_matrix(product, [])
+        column = 'dance'
+    else:
+        matrix = price_matrix(None, [product])
+        column = product.slug
+    slug = fee_cat.slug if isinstance(fee_cat, member_models.FeeCategory) else fee_cat
+    row = matrix.get(slug)
+    return row['prices'][column] if row else None
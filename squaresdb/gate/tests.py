@@ -1,13 +1,35 @@
+import datetime
+import importlib.util
+import io
+import json
 import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import Client
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
+import reversion
+from reversion.models import Version
+
+import squaresdb.gate.attendance as gate_attendance
+import squaresdb.gate.cube as gate_cube
+import squaresdb.gate.events as gate_events
+import squaresdb.gate.export as gate_export
+import squaresdb.gate.ledger as gate_ledger
 import squaresdb.gate.models as gate_models
+import squaresdb.gate.prices as gate_prices
+import squaresdb.gate.voting as gate_voting
+import squaresdb.gate.views as gate_views
+import squaresdb.membership.models as member_models
 
 logger = logging.getLogger(__name__)
 
@@ -19,11 +41,15 @@ def get_user(perm):
     user.save()
     return user
 
+# Queries to build the roster, with a cold price cache
+ROSTER_QUERIES = 9
+
 class SigninTestCase(TestCase):
     fixtures = ['people.json', 'sample.json']
 
     def setUp(self):
         self.user = get_user('signin_app')
+        cache.clear()
 
     def test_render_index(self):
         client = Client()
@@ -49,27 +75,790 @@ class SigninTestCase(TestCase):
         client = Client()
         client.force_login(self.user)
         path = reverse('gate:signin-dance', args=(2,))
-        with self.assertNumQueries(17):
+        with self.assertNumQueries(12):
             response = client.get(path)
         logger.info(response)
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "Squares Signin for ")
 
+    def test_roster(self):
+        client = Client()
+        client.force_login(self.user)
+        path = reverse('gate:signin-roster', args=(2,))
+        with self.assertNumQueries(ROSTER_QUERIES):
+            response = client.get(path)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['version'], 2)
+        self.assertEqual(len(data['ids']), len(data['names']))
+        self.assertEqual(len(data['ids']), len(data['status']))
+        row = data['ids'].index(554)
+        self.assertEqual(data['statuses'][data['status'][row]], 'covered')
+        self.assertEqual(data['subscriber'][row], 1)
+        search = data['search']
+        self.assertEqual(search['tokens'], sorted(search['tokens']))
+        token = search['tokens'].index('mctest3')
+        self.assertEqual([data['names'][i] for i in search['postings'][token]],
+                         ['Tester McTest3'])
+        self.assertIn(token, search['trigrams']['tes'])
+
+        # Revalidating an unchanged roster doesn't resend it
+        response = client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_roster_query_count(self):
+        """The roster takes the same number of queries however many attend"""
+        client = Client()
+        client.force_login(self.user)
+        dance = gate_models.Dance.objects.get(pk=2)
+        cash = gate_models.PaymentMethod.objects.get(slug='cash')
+        model_person = member_models.Person.objects.get(pk=556)
+        for i in range(30):
+            person = member_models.Person.objects.create(
+                name=f'Extra Dancer {i}', email='testing@mit.edu',
+                level_id=model_person.level_id, status_id=model_person.status_id,
+                mit_affil_id=model_person.mit_affil_id,
+                fee_cat_id=model_person.fee_cat_id,
+                frequency_id=model_person.frequency_id,
+            )
+            payment = None
+            if i % 2:
+                payment = gate_models.DancePayment.objects.create(
+                    person=person, at_dance=dance, for_dance=dance,
+                    payment_type=cash, amount=8)
+            gate_models.Attendee.objects.create(person=person, dance=dance,
+                                                payment=payment)
+
+        path = reverse('gate:signin-roster', args=(2,))
+        with self.assertNumQueries(ROSTER_QUERIES):
+            response = client.get(path)
+        data = response.json()
+        statuses = {name: data['statuses'][status]
+                    for name, status in zip(data['names'], data['status'])}
+        self.assertEqual(statuses['Extra Dancer 0'], 'owing')
+        self.assertEqual(statuses['Extra Dancer 1'], 'paid')
+        self.assertEqual(statuses['Tester McStudent'], 'covered')
+        self.assertEqual(statuses['Tester McTest3'], 'absent')
+
+    def test_signin_query_count(self):
+        """Signing in takes a fixed number of queries, however long the history"""
+        client = Client()
+        client.force_login(self.user)
+        # Warm reversion's content type cache
+        for model in (gate_models.Attendee, gate_models.DancePayment,
+                      gate_models.SubscriptionPayment):
+            ContentType.objects.get_for_model(model)
+        signins = [
+            (dict(person=556, present='true', paid='false'), 29),
+            (dict(person=555, present='true', paid='true', paid_for='dance',
+                  paid_amount='8', paid_method='cash'), 38),
+            (dict(person=411, present='true', paid='true', paid_for='sub',
+                  paid_amount='60', paid_method='cash', **{'paid_period[]': '2019-summer'}), 44),
+        ]
+        for signin, queries in signins:
+            with self.assertNumQueries(queries):
+                response = client.post(reverse('gate:signin-api'), dict(signin, dance=2))
+            self.assertEqual(response.status_code, 201)
+
+    def test_changes(self):
+        client = Client()
+        client.force_login(self.user)
+        roster = client.get(reverse('gate:signin-roster', args=(2,))).json()
+        changes_path = reverse('gate:signin-api-changes')
+        response = client.get(changes_path, dict(dance=2, since=roster['cursor']))
+        self.assertEqual(response.json()['changes'], [])
+
+        signin = dict(person=556, dance=2, present='true', paid='true',
+                      paid_amount='8', paid_method='cash', paid_for='dance')
+        response = client.post(reverse('gate:signin-api'), signin)
+        self.assertEqual(response.status_code, 201)
+        created = response.json()
+        with self.assertNumQueries(7):
+            response = client.get(changes_path, dict(dance=2, since=roster['cursor']))
+        data = response.json()
+        kinds = [(change['kind'], change['action']) for change in data['changes']]
+        self.assertEqual(kinds, [('payment', 'create'), ('attendee', 'create')])
+        self.assertEqual(data['people'], {'556': dict(status='paid', subscriber=0)})
+        self.assertFalse(data['more'])
+
+        undo = dict(payment=created['payment'], attendee=created['attendee'])
+        response = client.post(reverse('gate:signin-api-undo'), undo)
+        self.assertEqual(response.status_code, 200)
+        response = client.get(changes_path, dict(dance=2, since=data['cursor']))
+        data = response.json()
+        kinds = [(change['kind'], change['action']) for change in data['changes']]
+        self.assertEqual(kinds, [('attendee', 'delete'), ('payment', 'delete')])
+        self.assertEqual(data['people']['556']['status'], 'absent')
+
+        # Other dances don't see the changes
+        response = client.get(changes_path, dict(dance=1, since=0))
+        self.assertEqual(response.json()['changes'], [])
+
+    def test_batch(self):
+        client = Client()
+        client.force_login(self.user)
+        ops = [
+            dict(person=556, present=True, paid=True, paid_amount='8',
+                 paid_method='cash', paid_for='dance'),
+            dict(person=555, present=True, paid=False),
+            dict(person=9999, present=True, paid=False),
+            dict(person=411, present=False, paid=True, paid_amount='60',
+                 paid_method='check', paid_for='sub', paid_period=['2019-summer'],
+                 notes='batch sub'),
+            dict(person=556, present=True, paid=False),
+            dict(person=411, present=True, paid=True, paid_amount='1000',
+                 paid_method='cash', paid_for='dance'),
+        ]
+        body = json.dumps(dict(dance=2, ops=ops))
+        response = client.post(reverse('gate:signin-api-batch'), body,
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['ok'] for result in results],
+                         [True, True, False, True, True, False])
+        self.assertIn('9999', results[2]['msg'])
+
+        payment = gate_models.DancePayment.objects.get(pk=results[0]['payment'])
+        self.assertEqual((payment.person_id, payment.for_dance_id, payment.amount),
+                         (556, 2, 8))
+        attendee = gate_models.Attendee.objects.get(pk=results[0]['attendee'])
+        self.assertEqual(attendee.payment_id, payment.pk)
+        self.assertEqual(results[1]['payment'], 0)
+        self.assertTrue(results[1]['attendee_created'])
+        sub = gate_models.SubscriptionPayment.objects.get(pk=results[3]['payment'])
+        self.assertEqual([period.slug for period in sub.periods.all()], ['2019-summer'])
+        self.assertEqual(sub.notes, 'batch sub')
+        self.assertEqual(results[3]['attendee'], 0)
+        # Marking somebody present twice in one batch reuses the attendee
+        self.assertFalse(results[4]['attendee_created'])
+        self.assertEqual(results[4]['attendee'], results[0]['attendee'])
+
+        changes = gate_models.GateChange.objects.filter(dance=2)
+        self.assertEqual(changes.filter(kind='payment').count(), 2)
+        self.assertEqual(changes.filter(kind='attendee').count(), 2)
+        self.assertEqual(Version.objects.get_for_object(payment).count(), 1)
+
+        response = client.post(reverse('gate:signin-api-batch'), '{"dance": 2}',
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_idempotency_key(self):
+        client = Client()
+        client.force_login(self.user)
+        signin = dict(person=556, dance=2, present='true', paid='true',
+                      paid_amount='8', paid_method='cash', paid_for='dance',
+                      idempotency_key='key-1')
+        payments = gate_models.DancePayment.objects.filter(person=556)
+        first = client.post(reverse('gate:signin-api'), signin)
+        self.assertEqual(first.status_code, 201)
+        retry = client.post(reverse('gate:signin-api'), signin)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(payments.count(), 1)
+
+        # The batch API shares keys with signin_api, and dedupes within a batch
+        op = dict(signin, present=True, paid=True, idempotency_key='key-2')
+        ops = [dict(signin, present=True, paid=True), op, op]
+        body = json.dumps(dict(dance=2, ops=ops))
+        path = reverse('gate:signin-api-batch')
+        results = client.post(path, body, content_type='application/json').json()['results']
+        self.assertEqual(results[0]['payment'], first.json()['payment'])
+        self.assertEqual(results[1], results[2])
+        self.assertEqual(payments.count(), 2)
+        retry = client.post(path, body, content_type='application/json').json()['results']
+        self.assertEqual(retry, results)
+        self.assertEqual(payments.count(), 2)
+
+        # Resending an undo gets the first response, not "Could not find"
+        undo = dict(payment=first.json()['payment'], attendee=first.json()['attendee'],
+                    idempotency_key='key-3')
+        path = reverse('gate:signin-api-undo')
+        first = client.post(path, undo)
+        self.assertEqual(first.status_code, 200)
+        retry = client.post(path, undo)
+        self.assertEqual((retry.status_code, retry.json()), (200, first.json()))
+        self.assertEqual(payments.count(), 1)
+
+    def test_pay_method(self):
+        client = Client()
+        client.force_login(self.user)
+        attendees = gate_models.Attendee.objects.filter(dance=2)
+        for person in (556, 555, 411):
+            signin = dict(person=person, dance=2, present='true', paid='false')
+            response = client.post(reverse('gate:signin-api'), signin)
+            self.assertEqual(response.status_code, 201)
+        pay_methods = dict(attendees.values_list('person', 'pay_method'))
+        self.assertEqual(pay_methods, {556: 'none', 555: 'free', 411: 'sub'})
+        self.assertEqual(attendees.get(person=555).fee_cat_id, 'mit-student')
+
+        # Paying later (for a sub, via the batch API) updates the attendee
+        op = dict(person=556, present=False, paid=True, paid_amount='60',
+                  paid_method='check', paid_for='sub', paid_period=['2019-summer'])
+        body = json.dumps(dict(dance=1, ops=[op]))
+        response = client.post(reverse('gate:signin-api-batch'), body,
+                               content_type='application/json')
+        result = response.json()['results'][0]
+        self.assertEqual(attendees.get(person=556).pay_method, 'sub')
+
+        undo = dict(payment=result['payment'], attendee=0)
+        response = client.post(reverse('gate:signin-api-undo'), undo)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(attendees.get(person=556).pay_method, 'none')
+
+    def test_ledger(self):
+        client = Client()
+        client.force_login(self.user)
+        dance = gate_models.Dance.objects.get(pk=2)
+        call_command('rebuild_dance_ledger', stdout=io.StringIO())
+        summary = gate_views.books_summary(dance)
+        self.assertEqual(summary['num_attendees'], 0)
+        self.assertEqual(dict(summary['payment_totals']), {'Cash': 5})
+
+        signin = dict(person=556, dance=2, present='true', paid='true', paid_for='dance',
+                      paid_amount='8', paid_method='cash')
+        response = client.post(reverse('gate:signin-api'), signin)
+        member_models.Person.objects.filter(pk=555).update(status='guest')
+        signin = dict(person=555, dance=2, present='true', paid='false')
+        client.post(reverse('gate:signin-api'), signin)
+        with self.assertNumQueries(1):
+            summary = gate_views.books_summary(dance)
+        self.assertEqual((summary['num_attendees'], summary['num_mit'], summary['num_members']),
+                         (2, 1, 1))
+        attendee_rows = gate_models.DanceLedger.objects.filter(dance=dance, kind='attendee')
+        self.assertEqual(sorted(attendee_rows.values_list('member', 'fee_cat', 'num')),
+                         [(False, 'mit-student', 1), (True, 'full', 1)])
+        self.assertEqual(dict(summary['payment_totals']), {'Cash': 13})
+        row = summary['payment_subtotals'][0]
+        self.assertEqual((row.for_dance_id, row.fee_cat_id, row.num), (2, 'full', 2))
+
+        # Undoing updates the ledger, and a rebuild agrees with it
+        undo = dict(payment=response.json()['payment'], attendee=response.json()['attendee'])
+        client.post(reverse('gate:signin-api-undo'), undo)
+        def ledger():
+            rows = gate_models.DanceLedger.objects.filter(dance=dance)
+            return sorted(rows.values_list('kind', 'pay_method', 'fee_cat', 'num', 'amount'))
+        before = ledger()
+        self.assertEqual(len(before), 2)
+        out = io.StringIO()
+        call_command('rebuild_dance_ledger', '2', stdout=out)
+        self.assertIn('Rebuilt the ledger of 1 dances (2 rows)', out.getvalue())
+        self.assertEqual(ledger(), before)
+
+    @mock.patch.object(gate_views, 'GATE_EVENTS_DURATION', 0)
+    @override_settings(GATE_EVENTS_STREAMS=True)
+    def test_events(self):
+        client = Client()
+        client.force_login(self.user)
+        signin = dict(person=556, dance=2, present='true', paid='false')
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            client.post(reverse('gate:signin-api'), signin)
+        self.assertEqual(len(callbacks), 1)
+        cursor = gate_models.GateChange.objects.latest('pk').pk
+
+        path = reverse('gate:signin-api-events')
+        response = client.get(path, dict(dance=2, since=0))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = b''.join(response.streaming_content).decode().split('\n\n')
+        self.assertEqual(events[1].split('\n')[:2], ['event: changes', f'id: {cursor}'])
+        data = json.loads(events[1].split('\n')[2][len('data: '):])
+        self.assertEqual(data['people'], {'556': dict(status='owing', subscriber=0)})
+
+        # Reconnecting from the latest event sends nothing new
+        response = client.get(path, dict(dance=2, since=0), HTTP_LAST_EVENT_ID=str(cursor))
+        self.assertNotIn('event:', b''.join(response.streaming_content).decode())
+
+        # With streams off, the page polls instead, and streams are refused
+        with self.settings(GATE_EVENTS_STREAMS=False):
+            response = client.get(reverse('gate:signin-dance', args=(2,)))
+            self.assertContains(response, 'var eventsUrl = null;')
+            self.assertEqual(client.get(path, dict(dance=2, since=0)).status_code, 404)
+
+    def test_events_broker(self):
+        broker = gate_events.LocalBroker()
+        listener = broker.listen(1)
+        broker.publish(2)
+        self.assertFalse(listener.wait(0))
+        broker.publish(1)
+        self.assertTrue(listener.wait(0))
+        self.assertFalse(listener.wait(0))
+        listener.close()
+        self.assertEqual(broker.listeners, {})
+
+class PayMethodBackfillTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json']
+
+    def test_backfill(self):
+        person = member_models.Person.objects.get(pk=556)
+        with reversion.create_revision():
+            person.fee_cat_id = 'mit-student'
+            person.save()
+        with reversion.create_revision():
+            person.fee_cat_id = 'full'
+            person.save()
+        revisions = [version.revision for version in Version.objects.get_for_object(person)]
+        for revision, year in zip(sorted(revisions, key=lambda rev: rev.pk), (2019, 2020)):
+            revision.date_created = datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc)
+            revision.save()
+
+        dance = gate_models.Dance.objects.get(pk=2)
+        for person_id in (556, 555, 411, 554):
+            gate_models.Attendee.objects.create(person_id=person_id, dance=dance,
+                                                time=dance.time)
+        out = io.StringIO()
+        call_command('backfill_pay_method', batch_size=3, stdout=out)
+        self.assertIn('Checked 4 attendees', out.getvalue())
+        attendees = gate_models.Attendee.objects.filter(dance=dance)
+        self.assertEqual(dict(attendees.values_list('person', 'pay_method')),
+                         {556: 'free', 555: 'free', 411: 'sub', 554: 'dance'})
+        self.assertEqual(attendees.get(person=556).fee_cat_id, 'mit-student')
+
+class SubUploadTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json']
+
+    FIELDS = ['webform_sid', 'webform_completed_time', 'name', 'email', 'virtual_dances',
+              'tuesday_subscriptions', 'rounds_class', 'other_items', 'amount', 'notes',
+              'paymentOption', 'decision']
+
+    @staticmethod
+    def subs_file(rows):
+        lines = ['', ''] + ['\t'.join(row) for row in [SubUploadTestCase.FIELDS] + rows]
+        return io.BytesIO('\n'.join(lines).encode())
+
+    def setUp(self):
+        self.form = mock.Mock(cleaned_data=dict(
+            sub_periods=list(gate_models.SubscriptionPeriod.objects.all())))
+
+    def find_subs(self, rows):
+        return gate_views.find_subs_from_upload(self.subs_file(rows), self.form)
+
+    def test_find_subs_from_upload(self):
+        rows = [
+            ['1', '2019-06-01 12:00:00', 'Tester McStudent', '', '', '2019-summer',
+             '', '', '40', '', 'card', 'ACCEPT'],
+            ['2', '2019-06-01 12:01:00', 'tester mcsubscriber, Tester McTset3', '', '',
+             'summer2019', '', '', '80', '', 'card', 'ACCEPT'],
+            ['3', '2019-06-01 12:02:00', 'Nobody Atall', '', '', '2019-summer',
+             '', '', '40', '', 'card', 'ACCEPT'],
+        ]
+        # Everyone is looked up at once, however many rows there are
+        with self.assertNumQueries(5):
+            new_subs, errors, warns = self.find_subs(rows)
+        self.assertEqual(warns, [])
+        self.assertEqual([data['person'].pk for _row, data in new_subs], [555, 554])
+        self.assertEqual(errors, [
+            "Person couldn't be found: Tester McTset3 (did you mean: Tester McTest3?)",
+            "Person couldn't be found: Nobody Atall",
+        ])
+
+    def test_reupload(self):
+        user = get_user('view_attendee')
+        user.user_permissions.add(Permission.objects.get(codename='add_subscriptionpayment'))
+        client = Client()
+        client.force_login(user)
+        rows = [
+            ['7', '2019-06-01 12:00:00', 'Tester McStudent, Tester McTest3', '', '',
+             '2019-summer', '', '', '40', '', 'card', 'ACCEPT'],
+        ]
+        new_subs, errors, _warns = self.find_subs(rows)
+        self.assertEqual(errors, [])
+        post = {'form-TOTAL_FORMS': len(new_subs), 'form-INITIAL_FORMS': 0,
+                'submit_add_subs': 'Add subscriptions'}
+        for index, (_row, data) in enumerate(new_subs):
+            post.update({f'form-{index}-{field}': value for field, value in dict(
+                person=data['person'].pk, time=data['time'], payment_type='credit',
+                amount=data['amount'], fee_cat=data['fee_cat'].pk, notes=data['notes'],
+                periods='2019-summer', webform_sid=data['webform_sid']).items()})
+        response = client.post(reverse('gate:sub-upload'), post)
+        self.assertEqual(len(response.context['sub_instances']), 2)
+        imports = gate_models.SquaresPayImport.objects.filter(webform_sid='7')
+        self.assertEqual(sorted(imports.values_list('person', flat=True)), [555, 556])
+
+        # Saving the same formset again doesn't duplicate them
+        response = client.post(reverse('gate:sub-upload'), post)
+        self.assertEqual(response.context['sub_instances'], [])
+        self.assertEqual(len(response.context['warns']), 2)
+
+        # Uploading a later export skips them too
+        rows.append(['8', '2019-06-02 12:00:00', 'Tester McSubscriber', '', '',
+                     '2019-summer', '', '', '40', '', 'card', 'ACCEPT'])
+        new_subs, errors, warns = self.find_subs(rows)
+        self.assertEqual([data['webform_sid'] for _row, data in new_subs], ['8'])
+        self.assertEqual(warns, ['Skipped 1 payments that were already imported: '
+                                 'Tester McStudent, Tester McTest3 (SID 7)'])
+
+    @mock.patch.object(gate_views, 'SUB_IMPORT_STAGE_CHUNK', 2)
+    @mock.patch.object(gate_views, 'SUB_IMPORT_CHUNK', 2)
+    def test_staged_import(self):
+        user = get_user('view_attendee')
+        user.user_permissions.add(Permission.objects.get(codename='add_subscriptionpayment'))
+        client = Client()
+        client.force_login(user)
+        rows = [
+            ['11', '2019-06-01 12:00:00', 'Tester McStudent, Tester McTest3', '', '',
+             '2019-summer', '', '', '50', '', 'card', 'ACCEPT'],
+            ['12', '2019-06-01 12:01:00', 'Nobody Atall', '', '', '2019-summer',
+             '', '', '40', '', 'card', 'ACCEPT'],
+            ['13', '2019-06-01 12:02:00', 'Tester McSubscriber', '', '', '2019-summer',
+             '', '', '40', '', 'card', 'DECLINE'],
+            ['14', '2019-06-01 12:03:00', 'Tester McSubscriber', '', '', '2019-summer',
+             '', '', '40', '', 'card', 'ACCEPT'],
+            ['15', '2019-06-01 12:04:00', 'Tester McSubscriber', '', '', '2019-summer',
+             '', '', 'forty', '', 'card', 'ACCEPT'],
+            ['16', '2019-06-01 12:05:00', 'Tester McSubscriber', '', '', '2019-summer',
+             '', '', '4000', '', 'card', 'ACCEPT'],
+        ]
+        upload = self.subs_file(rows)
+        upload.name = 'export.tsv'
+        response = client.post(reverse('gate:sub-import'),
+                                dict(file=upload, sub_periods=['2019-summer']))
+        batch = gate_models.SubImportBatch.objects.get()
+        self.assertRedirects(response, batch.get_absolute_url())
+        Status = gate_models.SubImportRow.Status # pylint:disable=invalid-name
+        self.assertEqual(list(batch.rows.order_by('id').values_list('line', 'status')),
+                         [(4, Status.READY), (4, Status.READY), (5, Status.ERROR),
+                          (6, Status.SKIPPED), (7, Status.READY), (8, Status.ERROR),
+                          (9, Status.ERROR)])
+        self.assertEqual(batch.rows.filter(line=4).first().amount, 25)
+        self.assertEqual(batch.rows.get(line=8).message, "Unexpected amount 'forty'")
+        self.assertEqual(batch.rows.get(line=9).message, 'Amount 4000.00 is too large')
+
+        # Ready rows are imported a chunk at a time
+        client.post(batch.get_absolute_url())
+        self.assertEqual(gate_models.SquaresPayImport.objects.count(), 2)
+        response = client.get(batch.get_absolute_url(), dict(status='ready'))
+        self.assertContains(response, 'Import 1 ready rows')
+        self.assertEqual([row.line for row in response.context['page']], [7])
+        client.post(batch.get_absolute_url())
+        subs = gate_models.SubscriptionPayment.objects.filter(notes__contains='squares-pay SID: 1')
+        self.assertEqual(sorted(subs.values_list('person', flat=True)), [554, 555, 556])
+        self.assertEqual(subs.get(person=554).time.minute, 3)
+        self.assertFalse(batch.rows.filter(status=Status.READY).exists())
+
+        # Staging the file again skips everything that was imported
+        upload.seek(0)
+        client.post(reverse('gate:sub-import'), dict(file=upload, sub_periods=['2019-summer']))
+        batch = gate_models.SubImportBatch.objects.latest('pk')
+        self.assertEqual(list(batch.rows.order_by('line').values_list('status', flat=True)),
+                         [Status.SKIPPED, Status.ERROR, Status.SKIPPED, Status.SKIPPED,
+                          Status.ERROR, Status.ERROR])
+
+class BulkSubTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json']
+
+    def test_copy_subs(self):
+        # The same number of queries however many subscribers there are
+        # (once reversion has looked up the content type)
+        ContentType.objects.get_for_model(gate_models.SubscriptionPayment)
+        queries = 19
+        with self.assertNumQueries(queries):
+            call_command('copy_subs', '2019-summer', '2019-spring', stdout=io.StringIO())
+        subs = gate_models.SubscriptionPayment.objects.filter(periods='2019-spring')
+        self.assertEqual(sorted(subs.values_list('person', flat=True)), [1, 411, 554])
+        versions = Version.objects.get_for_model(gate_models.SubscriptionPayment)
+        self.assertEqual(versions.count(), 3)
+        self.assertEqual(len({version.revision_id for version in versions}), 1)
+        self.assertIn('2019-spring', versions[0].serialized_data)
+
+        for person_id in (555, 556):
+            sub = gate_models.SubscriptionPayment.objects.create(
+                person_id=person_id, payment_type_id='cash', amount=10)
+            sub.periods.add('2019-summer')
+        gate_models.SubscriptionPayment.objects.filter(periods='2019-spring').delete()
+        with self.assertNumQueries(queries):
+            call_command('copy_subs', '2019-summer', '2019-spring', stdout=io.StringIO())
+        self.assertEqual(subs.count(), 5)
+
+class AttendanceTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json']
+
+    def setUp(self):
+        for person_id, dance_id in ((556, 1), (554, 1), (555, 2)):
+            gate_models.Attendee.objects.create(person_id=person_id, dance_id=dance_id)
+
+    def test_matrix(self):
+        dances = list(gate_models.Dance.objects.order_by('time'))
+        people = member_models.Person.objects.filter(pk__in=(554, 555, 556))
+        with self.assertNumQueries(3):
+            matrix = gate_attendance.AttendanceMatrix(dances).load(people, free_people=[555])
+        self.assertEqual(matrix.codes(556), [('O', False), ('', False)])
+        # Subscriber, who also paid for (but missed) dance 2
+        self.assertEqual(matrix.codes(554), [('X', True), ('P', True)])
+        # Free admission (for MIT students) covers every dance
+        self.assertEqual(matrix.codes(555), [('', True), ('X', True)])
+        self.assertEqual(matrix.codes(411), [('', False), ('', False)])
+        self.assertEqual([matrix.num_present(pk) for pk in (554, 555, 556, 411)], [1, 1, 1, 0])
+
+    def test_render_tables(self):
+        client = Client()
+        client.force_login(get_user('view_attendee'))
+        member_models.Person.objects.filter(pk=556).update(status='member')
+        with self.assertNumQueries(11):
+            response = client.get(reverse('gate:voting'), dict(start='2019-06-01',
+                                                               end='2019-06-15'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['dances']),
+                         [gate_models.Dance.objects.get(pk=1)])
+        self.assertContains(response, '<td data-sub="False" data-code="O">O</td>', html=True)
+        response = client.get(reverse('gate:paper-gate'))
+        self.assertEqual(response.status_code, 200)
+
+class VotingTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json']
+
+    def setUp(self):
+        self.dances = list(gate_models.Dance.objects.order_by('time'))
+
+    def voters(self, dance):
+        return dict(gate_voting.voting_people(dance.time).values_list('pk', 'voting_num'))
+
+    @override_settings(GATE_VOTING_RULE=dict(window=1, threshold=1, window_skip_seasons=[]))
+    def test_tallies(self):
+        client = Client()
+        client.force_login(get_user('signin_app'))
+        for person, dance in ((556, 1), (555, 2), (554, 1), (554, 2)):
+            signin = dict(person=person, dance=dance, present='true', paid='false')
+            response = client.post(reverse('gate:signin-api'), signin)
+        self.assertEqual(self.voters(self.dances[0]), {556: 1, 554: 1})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.voters(self.dances[1]), {555: 1, 554: 1})
+
+        # With a longer window, both dances count
+        with self.settings(GATE_VOTING_RULE=dict(window=2, threshold=2)):
+            call_command('rebuild_voting_tallies', stdout=io.StringIO())
+            self.assertEqual(self.voters(self.dances[1]), {554: 2})
+            # Summer dances don't count towards the window by default, so
+            # the window is everything so far
+            with self.settings(GATE_VOTING_RULE=dict(threshold=1)):
+                call_command('rebuild_voting_tallies', stdout=io.StringIO())
+                self.assertEqual(self.voters(self.dances[1]), {554: 2, 555: 1, 556: 1})
+
+        # Undoing an attendee updates the tallies
+        call_command('rebuild_voting_tallies', stdout=io.StringIO())
+        undo = dict(payment=0, attendee=response.json()['attendee'])
+        client.post(reverse('gate:signin-api-undo'), undo)
+        self.assertEqual(self.voters(self.dances[1]), {555: 1})
+
+        out = io.StringIO()
+        call_command('voting_list', '2019-06-30', stdout=out, stderr=io.StringIO())
+        self.assertEqual(out.getvalue().splitlines()[1:],
+                         ['Tester McStudent,testing@mit.edu,1'])
+
+    @override_settings(GATE_VOTING_RULE=dict(window=2, threshold=1, window_skip_seasons=[]))
+    def test_refresh_nearby(self):
+        """Refreshing a few dances only reads nearby ones, but agrees with a rebuild"""
+        last = self.dances[-1]
+        for week in range(1, 7):
+            self.dances.append(gate_models.Dance.objects.create(
+                time=last.time + datetime.timedelta(weeks=week),
+                period=last.period, price_scheme=last.price_scheme))
+        # Out of order, like a dance that's fixed up later
+        for person, index in ((556, 4), (556, 5), (555, 7), (556, 2), (554, 0)):
+            gate_models.Attendee.objects.create(person_id=person, dance=self.dances[index])
+            gate_voting.refresh_voting_tallies([person], [self.dances[index].pk])
+        tallies = gate_models.VotingTally.objects.values_list('dance', 'person', 'num')
+        refreshed = set(tallies)
+        gate_voting.refresh_voting_tallies()
+        self.assertEqual(set(tallies), refreshed)
+        self.assertEqual(self.voters(self.dances[5]), {556: 2})
+
+    @override_settings(GATE_VOTING_RULE=dict(window=1, threshold=1, window_skip_seasons=[]))
+    def test_untallied_dance(self):
+        client = Client()
+        client.force_login(get_user('signin_app'))
+        signin = dict(person=556, dance=self.dances[1].pk, present='true', paid='false')
+        client.post(reverse('gate:signin-api'), signin)
+        # A later dance nobody has signed in to yet has no tallies, so the
+        # list is as of the last dance that does
+        later = gate_models.Dance.objects.create(
+            time=self.dances[1].time + datetime.timedelta(weeks=1),
+            period=self.dances[1].period, price_scheme=self.dances[1].price_scheme)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.voters(later), {556: 1})
+
+class PayStatsTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json']
+
+    def setUp(self):
+        self.user = get_user('view_attendee')
+        perms = Permission.objects.filter(codename__in=['view_subscriptionpayment',
+                                                        'view_dancepayment'])
+        self.user.user_permissions.add(*perms)
+
+    def export(self, name, **params):
+        client = Client()
+        client.force_login(self.user)
+        response = client.get(reverse(name), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    @mock.patch.object(gate_views, 'PAY_STATS_CHUNK', 2)
+    def test_subs(self):
+        rows = self.export('gate:pay-stats-subs', period='2019-summer')
+        self.assertEqual(rows[0], 'time,payment_type,fee_cat,amount,periods')
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1], '2019-06-10 05:20:41+00:00,credit,full,80.00,2019-summer')
+        rows_by_date = self.export('gate:pay-stats-subs', start='2019-06-01', end='2019-06-30')
+        self.assertEqual(rows_by_date, rows)
+        self.assertEqual(len(self.export('gate:pay-stats-subs', start='2020-01-01')), 1)
+
+    def test_dances(self):
+        rows = self.export('gate:pay-stats-dances', start='2019-01-01')
+        self.assertEqual(rows[1:], ['2019-06-10 05:21:43+00:00,cash,full,5.00,'
+                                    '2019-summer,2019-06-19 00:00:00+00:00'])
+        self.assertEqual(self.export('gate:pay-stats-dances', period='2019-spring'), rows[:1])
+
+        client = Client()
+        client.force_login(self.user)
+        response = client.get(reverse('gate:pay-stats-dances'), dict(start='2020-01-01',
+                                                                     end='2019-01-01'))
+        self.assertEqual(response.status_code, 400)
+
+    def cube(self, status=200, **params):
+        client = Client()
+        client.force_login(self.user)
+        response = client.get(reverse('gate:pay-stats-cube'), params)
+        self.assertEqual(response.status_code, status)
+        return response.json()
+
+    def test_cube(self):
+        call_command('rebuild_payment_cube', stdout=io.StringIO())
+        data = self.cube(group='paid_for')
+        self.assertEqual(data['rows'], [dict(paid_for='dance', num=1, amount='5.00'),
+                                        dict(paid_for='sub', num=3, amount='195.00')])
+        self.assertEqual(data['totals'], dict(num=4, amount='200.00'))
+        data = self.cube(group='week,period', paid_for='sub', fee_cat=['full', 'student'])
+        self.assertEqual(data['rows'], [
+            dict(week='2019-06-03', period='2019-summer', num=1, amount='95.00'),
+            dict(week='2019-06-10', period='2019-summer', num=2, amount='100.00'),
+        ])
+        data = self.cube(start='2019-06-10', end='2019-06-30', member='true')
+        self.assertEqual(data['rows'], [dict(num=2, amount='85.00')])
+        self.cube(status=400, group='person')
+        self.cube(status=400, start='June')
+
+        # Signing in a payment updates its week, and a rebuild agrees
+        perm = Permission.objects.get(codename='signin_app')
+        self.user.user_permissions.add(perm)
+        client = Client()
+        client.force_login(self.user)
+        signin = dict(person=556, dance=2, present='false', paid='true', paid_for='dance',
+                      paid_amount='8', paid_method='cash')
+        self.assertEqual(client.post(reverse('gate:signin-api'), signin).status_code, 201)
+        week = gate_cube.week_of(gate_models.Payment.objects.latest('pk').time).isoformat()
+        data = self.cube(group='paid_for', start=week)
+        self.assertEqual(data['rows'][0], dict(paid_for='dance', num=1, amount='8.00'))
+        def cells():
+            return sorted(gate_models.PaymentCube.objects.values_list(
+                'week', 'period', 'fee_cat', 'payment_type', 'paid_for', 'member', 'num',
+                'amount'))
+        before = cells()
+        call_command('rebuild_payment_cube', stdout=io.StringIO())
+        self.assertEqual(cells(), before)
+
+@unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'needs pyarrow')
+class ExportTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json']
+
+    def test_export_dir(self):
+        import pyarrow.parquet # pylint:disable=import-outside-toplevel,import-error
+        with tempfile.TemporaryDirectory() as tmp:
+            out = io.StringIO()
+            call_command('export_analytics', tmp, '--chunk-size=3', stdout=out)
+            self.assertIn('No new rows in lineitem', out.getvalue())
+            directory = os.path.join(tmp, 'payment')
+            self.assertEqual(os.listdir(directory), ['part-0000000001-0000000004.parquet'])
+            payments = pyarrow.parquet.read_table(directory).to_pylist()
+            self.assertEqual([row['id'] for row in payments], [1, 2, 3, 4])
+            self.assertEqual(payments[1]['for_dance'], 2)
+            self.assertEqual(str(payments[1]['amount']), '5.00')
+            self.assertEqual(payments[1]['person_status'], 'grad')
+
+            # Later exports only add the new rows
+            gate_models.SubscriptionPayment.objects.create(
+                person_id=556, payment_type_id='cash', amount=10)
+            self.assertIsNone(gate_export.export_to_dir(gate_export.TABLES['attendee'],
+                                                        os.path.join(tmp, 'attendee'),
+                                                        'parquet'))
+            path = gate_export.export_to_dir(gate_export.TABLES['payment'], directory,
+                                             'parquet')
+            self.assertEqual(os.path.basename(path), 'part-0000000005-0000000005.parquet')
+            self.assertEqual(pyarrow.parquet.read_table(directory).num_rows, 5)
+
+    def test_view(self):
+        import pyarrow # pylint:disable=import-outside-toplevel,import-error
+        client = Client()
+        path = reverse('gate:analytics-export', args=('payment', 'arrow'))
+        client.force_login(get_user('view_attendee'))
+        self.assertEqual(client.get(path).status_code, 302)
+        get_user_model().objects.filter(username='user').update(is_staff=True)
+        response = client.get(path, dict(since=2))
+        self.assertEqual(response.status_code, 200)
+        table = pyarrow.ipc.open_stream(b''.join(response.streaming_content)).read_all()
+        self.assertEqual(table.column('id').to_pylist(), [3, 4])
+        bad = reverse('gate:analytics-export', args=('person', 'arrow'))
+        self.assertEqual(client.get(bad).status_code, 404)
+
+class PricesTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_price_for(self):
+        dance = gate_models.Dance.objects.get(pk=2)
+        period = gate_models.SubscriptionPeriod.objects.get(slug='2019-summer')
+        price = gate_models.DancePrice.objects.filter(price_scheme=dance.price_scheme).first()
+        fee_cat = price.fee_cat
+        self.assertEqual(gate_prices.price_for(fee_cat, dance)[:2], (price.low, price.high))
+        with self.assertNumQueries(0):
+            gate_prices.price_for(fee_cat.slug, dance)
+            gate_prices.price_matrix(dance, [])
+        self.assertIsNone(gate_prices.price_for('no-such-category', period))
+
+        # Changing a price invalidates the cached matrix, once it commits
+        price.high += 5
+        with self.captureOnCommitCallbacks() as callbacks:
+            price.save()
+        self.assertEqual(gate_prices.price_for(fee_cat, dance)[1], price.high - 5)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(gate_prices.price_for(fee_cat, dance)[1], price.high)
+
 class BooksTestCase(TestCase):
     fixtures = ['people.json', 'sample.json']
 
     def setUp(self):
         self.user = get_user('books_app')
+        cache.clear()
 
     def test_render_books(self):
         client = Client()
         client.force_login(self.user)
         path = reverse('gate:books-dance', args=(2,))
-        with self.assertNumQueries(16):
+        with self.assertNumQueries(13):
             response = client.get(path)
         logger.info(response)
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "Payments")
+        # The usual price of the one dance payment, from price_for
+        payment = gate_models.DancePayment.objects.get(pk=2)
+        price = gate_prices.price_for(payment.fee_cat_id, payment.for_dance)
+        self.assertContains(response, f"<td>{price[2]}</td>", html=True)
+
+    @mock.patch.object(gate_views, 'GATE_EVENTS_DURATION', 0)
+    @override_settings(GATE_EVENTS_STREAMS=True)
+    def test_books_events(self):
+        client = Client()
+        client.force_login(self.user)
+        dance = gate_models.Dance.objects.get(pk=2)
+        gate_models.Attendee.objects.create(person_id=555, dance=dance, fee_cat_id='mit-student')
+        gate_ledger.refresh_dance_ledgers([dance.pk])
+        gate_models.GateChange.objects.create(dance=dance, kind='attendee', action='create',
+                                              object_id=1, person_id=555)
+        response = client.get(reverse('gate:books-events', args=(2,)), dict(since=0))
+        events = b''.join(response.streaming_content).decode()
+        self.assertIn('event: summary', events)
+        self.assertIn('There were 1 total attendees, including 1 current MIT', events)
 
 class AdminTestCase(TestCase):
     fixtures = ['people.json', 'sample.json']
@@ -92,3 +881,54 @@ class AdminTestCase(TestCase):
         logger.info(response)
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "Select subscription payment to ")
+
+    def test_admin_edits_ledger(self):
+        admin = get_user_model().objects.create_superuser(username='admin', password='pass')
+        client = Client()
+        client.force_login(admin)
+        with reversion.create_revision():
+            attendee = gate_models.Attendee.objects.create(person_id=555, dance_id=2)
+        gate_ledger.refresh_dance_ledgers([1, 2])
+        def num_attendees(dance_id):
+            summary = gate_ledger.dance_ledger(gate_models.Dance.objects.get(pk=dance_id))
+            return summary['num_attendees']
+        self.assertEqual((num_attendees(1), num_attendees(2)), (0, 1))
+
+        # Moving them to another dance refreshes both
+        path = reverse('admin:gate_attendee_change', args=(attendee.pk,))
+        form = dict(person=555, dance=1, payment='', time_0='2019-06-12', time_1='00:00:00')
+        response = client.post(path, form)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual((num_attendees(1), num_attendees(2)), (1, 0))
+
+        # ...as does reverting that
+        version = Version.objects.get_for_object(attendee).order_by('pk').first()
+        path = reverse('admin:gate_attendee_revision', args=(attendee.pk, version.pk))
+        form['dance'] = 2
+        response = client.post(path, form)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual((num_attendees(1), num_attendees(2)), (0, 1))
+
+        path = reverse('admin:gate_attendee_delete', args=(attendee.pk,))
+        response = client.post(path, dict(post='yes'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual((num_attendees(1), num_attendees(2)), (0, 0))
+
+    def test_admin_edits_cube(self):
+        admin = get_user_model().objects.create_superuser(username='admin', password='pass')
+        client = Client()
+        client.force_login(admin)
+        call_command('rebuild_payment_cube', stdout=io.StringIO())
+        def dance_payments():
+            _rows, totals = gate_cube.query_cube([], dict(paid_for=['dance']))
+            return totals['num'], totals['amount']
+        self.assertEqual(dance_payments(), (1, 5))
+
+        # Deleting with the changelist action refreshes the payment's week
+        path = reverse('admin:gate_dancepayment_changelist')
+        action = dict(action='delete_selected', _selected_action=[2], post='yes')
+        response = client.post(path, action)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(dance_payments(), (0, 0))
+        summary = gate_views.books_summary(gate_models.Dance.objects.get(pk=2))
+        self.assertEqual(dict(summary['payment_totals']), {})
@@ -8,16 +8,25 @@ gate_patterns = [ # pylint:disable=invalid-name
     path('period/<slug:slug>/bulk_sub/', views.bulk_sub, name='bulk-sub'),
     path('period/<slug:slug>/member_stats/', views.member_stats, name='member-stats'),
     path('signin/<int:pk>/', views.signin, name='signin-dance'),
+    path('signin_api/roster/<int:pk>', views.signin_roster, name='signin-roster'),
     path('signin_api/payments', views.signin_api, name='signin-api'),
     path('signin_api/payment_undo', views.signin_api_undo, name='signin-api-undo'),
+    path('signin_api/batch', views.signin_api_batch, name='signin-api-batch'),
+    path('signin_api/changes', views.signin_api_changes, name='signin-api-changes'),
+    path('signin_api/events', views.signin_api_events, name='signin-api-events'),
     path('books/<int:pk>/', views.books, name='books-dance'),
+    path('books/<int:pk>/events', views.books_events, name='books-events'),
     path('new_period/', views.new_sub_period, name='new-period'),
     path('sub_upload/', views.upload_subs, name='sub-upload'),
+    path('sub_import/', views.sub_import, name='sub-import'),
+    path('sub_import/<int:pk>/', views.sub_import_batch, name='sub-import-batch'),
     path('voting/', views.voting_members, name='voting'),
     path('paper-gate/', views.paper_gate, name='paper-gate'),
     path('pay-stats/', views.pay_stats, name='pay-stats'),
     path('pay-stats/subs/', views.pay_stats_subs, name='pay-stats-subs'),
     path('pay-stats/dances/', views.pay_stats_dances, name='pay-stats-dances'),
+    path('pay-stats/cube/', views.pay_stats_cube, name='pay-stats-cube'),
+    path('export/<slug:table>.<slug:fmt>', views.analytics_export, name='analytics-export'),
 ]
 
 def urls():
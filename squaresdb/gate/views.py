@@ -5,32 +5,50 @@ import decimal
 from http import HTTPStatus
 import io
 import itertools
+import json
 import logging
 
+from time import monotonic
 from typing import Any, Dict, List, Optional, Tuple
 
 from django import forms
+from django.conf import settings
 from django.contrib.auth.decorators import permission_required, user_passes_test
-from django.db import transaction, connection
-from django.db.models import Count, Sum
-from django.db.models.query import QuerySet
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, OuterRef, Q, Value
 from django.forms import ValidationError
 # pylint doesn't recognize usage in type annotations
 from django.http import HttpRequest, HttpResponse # pylint:disable=unused-import
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render # pylint:disable=unused-import
+from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.views.decorators.http import require_POST
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import conditional_page, require_GET, require_POST
 from django.views.generic import DetailView
 
 import reversion
 
 import squaresdb.gate.models as gate_models
 import squaresdb.gate.forms as gate_forms
+import squaresdb.gate.attendance as gate_attendance
+import squaresdb.gate.bulk as gate_bulk
+import squaresdb.gate.cube as gate_cube
+import squaresdb.gate.events as gate_events
+import squaresdb.gate.export as gate_export
+import squaresdb.gate.ledger as gate_ledger
+import squaresdb.gate.prices as gate_prices
+import squaresdb.gate.voting as gate_voting
 import squaresdb.membership.models as member_models
+import squaresdb.membership.search as member_search
 import squaresdb.money.models as money_models
 import squaresdb.money.views as money_views
+import squaresdb.utils.bulk as utils_bulk
 
 # TODO(pylint): This is probably true, but I'm not fixing it right now.
 # pylint:disable=too-many-lines
@@ -69,11 +87,15 @@ def _make_sub_period(form, dance_dates, price_formset):
     price_formset.instance = new_period
     price_formset.save()
     price_scheme = form.cleaned_data['default_price_scheme']
+    dance_ids = []
     for date in dance_dates:
         time = datetime.datetime.combine(date, form.cleaned_data['time'])
         dance = gate_models.Dance(time=time, period=new_period,
                                   price_scheme=price_scheme)
         dance.save()
+        dance_ids.append(dance.pk)
+    # New dances start new voting windows
+    gate_voting.refresh_voting_tallies(dance_ids=dance_ids)
     return new_period
 
 @permission_required(['gate.add_subscriptionperiod',
@@ -159,60 +181,78 @@ class SubPeriodView(DetailView): #pylint:disable=too-many-ancestors
 
 ### Signin app
 
-def build_price_matrix_col(fee_cat_prices, slug, price_set):
-    """Fill in a column of the price matrix"""
-    for price in price_set.select_related('fee_cat'):
-        for_cat = fee_cat_prices[price.fee_cat.slug]
-        for_cat['cat_name'] = price.fee_cat.name
-        price_range = gate_models.format_price_range(price.low, price.high)
-        for_cat['prices'][slug] = (price.low, price.high, price_range)
-
-
-def build_price_matrix(dance, periods):
-    """Build a matrix of fee category x product (dance or period)"""
-    default = collections.OrderedDict()
-    if dance:
-        default['dance'] = None
-    for period in periods:
-        default[period.slug] = None
-    matrix = collections.defaultdict(lambda: dict(prices=default.copy()))
+def signin_annotate_status(dance, people):
+    """Annotate a Person queryset with their paid/present status for dance
+
+    Each person gets `is_present`, `is_subscriber`, and `paid_dance` flags, all
+    computed by the database as part of fetching the people, so the number of
+    queries doesn't depend on how many people or attendees there are."""
+    person_ref = OuterRef('pk')
+    if dance.period_id:
+        subscriptions = gate_models.SubscriptionPayment.objects.filter(
+            person=person_ref, periods=dance.period_id)
+        is_subscriber = Exists(subscriptions)
+    else:
+        is_subscriber = Value(False)
+    return people.annotate(
+        is_present=Exists(gate_models.Attendee.objects.filter(person=person_ref, dance=dance)),
+        is_subscriber=is_subscriber,
+        paid_dance=Exists(gate_models.DancePayment.objects.filter(person=person_ref,
+                                                                  for_dance=dance)),
+    )
 
-    if dance:
-        build_price_matrix_col(matrix, 'dance', dance.price_scheme.danceprice_set)
-    for period in periods:
-        build_price_matrix_col(matrix, period.slug, period.subscriptionperiodprice_set)
-
-    # We convert matrix to a real dict, because otherwise when Django templates
-    # check if there's an "items" key, the defaultdict will create that key...
-    return dict(**matrix)
-
-def signin_annotate_button_class(dance, people, subscribers):
-    """Annotate the people with their button class (paid/present status) for dance"""
-    # Find people already marked as attending
-    dance_payments = gate_models.DancePayment.objects.filter(for_dance=dance)
-    payees_dance = set()
-    for payment in dance_payments:
-        payees_dance.add(payment.person_id)
-    attendees = gate_models.Attendee.objects.filter(dance=dance)
-    attendees_paid = set()  # already paid as required
-    attendees_owing = set() # owe payment
-    for attendee in attendees:
-        if (attendee.person_id in payees_dance
-            or attendee.person_id in subscribers
-            or attendee.person.fee_cat.slug == "mit-student"):
-            attendees_paid.add(attendee.person_id)
-        else:
-            attendees_owing.add(attendee.person_id)
-    # Annotate each person with a button class for attendee status
-    for person in people:
-        if person.pk in attendees_paid:
-            person.button_class = "btn-primary"
-        elif (person.pk in subscribers or person.fee_cat.slug == "mit-student"):
-            person.button_class = "btn-success"
-        elif person.pk in attendees_owing:
-            person.button_class = "btn-warning"
-        else:
-            person.button_class = "btn-secondary"
+def signin_button_class(person):
+    """Find the button class for a person from signin_annotate_status"""
+    covered = person.is_subscriber or person.fee_cat_id in gate_models.FREE_FEE_CATS
+    if person.is_present:
+        if covered or person.paid_dance:
+            return "btn-primary"    # present, and paid as required
+        return "btn-warning"        # present, but owes payment
+    if covered:
+        return "btn-success"        # not present, student or subscriber
+    return "btn-secondary"          # not present, needs to pay
+
+def refresh_pay_methods(person_ids, dance_ids=(), period_ids=()):
+    """Update Attendee.pay_method and dance ledgers after payments change
+
+    This covers the people's attendance at dance_ids and at any dance in
+    period_ids (see gate_models.refresh_attendee_pay_methods). The ledgers of
+    dance_ids, and of any dance whose attendees changed, are recomputed, so
+    dance_ids should include any dance that attendees or payments were
+    written for."""
+    dances = Q(dance__in=dance_ids) | Q(dance__period__in=period_ids)
+    attendees = gate_models.Attendee.objects.filter(dances, person__in=person_ids)
+    num_changed = gate_models.refresh_attendee_pay_methods(attendees)
+    ledger_dance_ids = set(dance_ids)
+    # Without periods, the attendees are all at dance_ids already
+    if num_changed and period_ids:
+        ledger_dance_ids.update(attendees.values_list('dance', flat=True))
+    gate_ledger.refresh_dance_ledgers(ledger_dance_ids)
+    return num_changed
+
+def _payment_scope(payment, dance):
+    """Find the (dance ids, period ids) that a payment might cover
+
+    dance (if any) is included too, for the attendee record being created.
+    Call this before deleting payment."""
+    dance_ids = {dance.pk} if dance else set()
+    period_ids: List[str] = []
+    if payment is None:
+        return dance_ids, period_ids
+    if isinstance(payment, gate_models.DancePayment):
+        for_dance_id: Optional[int] = payment.for_dance_id
+    elif isinstance(payment, gate_models.SubscriptionPayment):
+        for_dance_id = None
+    else:
+        dance_payments = gate_models.DancePayment.objects.filter(payment_ptr=payment)
+        for_dance_id = dance_payments.values_list('for_dance', flat=True).first()
+    if for_dance_id:
+        dance_ids.add(for_dance_id)
+    else:
+        periods = gate_models.SubscriptionPayment.periods.through.objects
+        periods = periods.filter(subscriptionpayment_id=payment.pk)
+        period_ids = list(periods.values_list('subscriptionperiod_id', flat=True))
+    return dance_ids, period_ids
 
 
 def _current_sub_periods():
@@ -221,45 +261,40 @@ def _current_sub_periods():
     periods = periods.order_by('start_date', 'slug')
     return periods
 
+def _signin_people(dance, person_ids=None):
+    """Find all "real" people who attend sometimes, with their button class
+
+    If `person_ids` is supplied, only those people are considered."""
+    people = member_models.Person.objects.exclude(status__slug='system')
+    if person_ids is not None:
+        people = people.filter(pk__in=person_ids)
+    people = people.order_by('frequency__order', 'name')
+    people = people.select_related('fee_cat', 'frequency')
+    people = signin_annotate_status(dance, people)
+
+    subscribers = set()
+    for person in people:
+        person.button_class = signin_button_class(person)
+        if person.is_subscriber:
+            subscribers.add(person.pk)
+    return people, subscribers
+
 @permission_required('gate.signin_app')
 @ensure_csrf_cookie
 def signin(request, pk):
-    """Main gate view"""
-    # Find all "real" people who attend sometimes
+    """Main gate view
+
+    The list of people is fetched separately, from `signin_roster`, and
+    built client-side."""
     dance = get_object_or_404(gate_models.Dance, pk=pk)
     past_dances = gate_models.Dance.objects.filter(time__lt=dance.time)
     past_dances = past_dances.order_by('-time')[:10]
     future_dances = gate_models.Dance.objects.filter(time__gt=dance.time)
     future_dances = future_dances.order_by('time')[:10]
     period = dance.period
-    people = member_models.Person.objects.exclude(status__slug='system')
-    people = people.order_by('frequency__order', 'name')
-    people = people.select_related('fee_cat', 'frequency')
-
-    # Find people who have paid already
-    subscriptions = gate_models.SubscriptionPayment.objects
-    subscriptions = subscriptions.filter(periods=period, person__in=people)
-    # I thought that Django had a cache such that forcing `people` to be
-    # fetched earlier would prevent the subscribers from being fetched
-    # individually, but seemingly that's not true. selected_related solves this
-    # for us, though.
-    subscriptions = subscriptions.select_related('person')
-    subscribers = set()
-    for subscription in subscriptions:
-        subscribers.add(subscription.person_id)
-    signin_annotate_button_class(dance, people, subscribers)
 
     subscription_periods = _current_sub_periods()
-
-    # Annotate each person with their status
-    fee_cat_prices = build_price_matrix(dance, subscription_periods)
-    for person in people:
-        try:
-            person.prices = fee_cat_prices[person.fee_cat.slug]['prices']
-        except KeyError:
-            logger.error("No prices for %s in scheme %s", person.fee_cat, dance.price_scheme)
-            person.prices = None
-
+    fee_cat_prices = gate_prices.price_matrix(dance, subscription_periods)
 
     context = dict(
         pagename='signin',
@@ -270,11 +305,128 @@ def signin(request, pk):
         future_dances=future_dances,
         period=period,
         price_matrix=fee_cat_prices,
-        people=people,
-        subscribers=subscribers,
+        events_streams=settings.GATE_EVENTS_STREAMS,
     )
     return render(request, 'gate/signin.html', context)
 
+# Bump this if the roster format changes incompatibly
+ROSTER_VERSION = 2
+
+# The roster sends each person's status as an index into this tuple
+ROSTER_STATUSES = ('absent', 'covered', 'owing', 'paid')
+ROSTER_BUTTON_STATUS = {
+    'btn-secondary': 'absent',  # not present, needs to pay
+    'btn-success': 'covered',   # not present, student or subscriber
+    'btn-warning': 'owing',     # present, but hasn't paid
+    'btn-primary': 'paid',      # present and paid
+}
+
+def _signin_roster_prices(dance):
+    """Build the shared price matrix for the roster
+
+    Returns the column labels, the rows (one per fee category), and a map
+    from fee category slug to row index. The dance column is what each
+    person is charged at the door, so it comes from price_for, like the
+    books' usual prices."""
+    subscription_periods = _current_sub_periods()
+    price_matrix = gate_prices.price_matrix(dance, subscription_periods)
+    price_cols = ['dance'] + [period.slug for period in subscription_periods]
+    price_rows = []
+    price_row_index = {}
+    for slug, row in price_matrix.items():
+        price_row_index[slug] = len(price_rows)
+        price_rows.append([gate_prices.price_for(slug, dance)]
+                          + [row['prices'][col] for col in price_cols[1:]])
+    return price_cols, price_rows, price_row_index
+
+def signin_roster_data(dance: gate_models.Dance) -> Dict[str, Any]:
+    """Build the columnar roster payload for the signin page
+
+    Each per-person field is a list, with one entry per person, in display
+    order. Fee categories, frequencies, and prices are sent once, with each
+    person referring to them by index."""
+    # Find the cursor before the people, so that a change racing with building
+    # the roster gets replayed by the client rather than lost
+    cursor = gate_change_cursor(dance)
+    people, subscribers = _signin_people(dance)
+    price_cols, price_rows, price_row_index = _signin_roster_prices(dance)
+
+    fee_cats: Dict[str, int] = {}
+    fee_cat_list: List[Dict[str, str]] = []
+    frequencies: Dict[str, int] = {}
+    frequency_list: List[str] = []
+    status_index = {status: i for i, status in enumerate(ROSTER_STATUSES)}
+    data: Dict[str, Any] = dict(
+        version=ROSTER_VERSION,
+        dance=dance.pk,
+        cursor=cursor,
+        statuses=ROSTER_STATUSES,
+        price_cols=price_cols,
+        price_rows=price_rows,
+        ids=[], names=[], fee_cat=[], frequency=[],
+        status=[], subscriber=[], price_row=[],
+    )
+    for person in people:
+        if person.fee_cat_id not in fee_cats:
+            fee_cats[person.fee_cat_id] = len(fee_cat_list)
+            fee_cat_list.append(dict(slug=person.fee_cat.slug, name=person.fee_cat.name))
+        if person.frequency_id not in frequencies:
+            frequencies[person.frequency_id] = len(frequency_list)
+            frequency_list.append(person.frequency.name)
+        price_row = price_row_index.get(person.fee_cat_id, -1)
+        if price_row < 0:
+            logger.error("No prices for %s in scheme %s", person.fee_cat, dance.price_scheme)
+
+        data['ids'].append(person.pk)
+        data['names'].append(person.name)
+        data['fee_cat'].append(fee_cats[person.fee_cat_id])
+        data['frequency'].append(frequencies[person.frequency_id])
+        data['status'].append(status_index[ROSTER_BUTTON_STATUS[person.button_class]])
+        data['subscriber'].append(1 if person.pk in subscribers else 0)
+        data['price_row'].append(price_row)
+    data['fee_cats'] = fee_cat_list
+    data['frequencies'] = frequency_list
+    data['search'] = signin_roster_search(data['names'])
+    return data
+
+def signin_roster_search(names: List[str]) -> Dict[str, Any]:
+    """Build the search index for the roster's names
+
+    The index has the sorted list of distinct name `tokens` (see
+    member_search.name_tokens), so prefixes can be found by binary search;
+    `postings`, the roster indexes of the people with each token; and
+    `trigrams`, mapping each trigram to the indexes of tokens containing it,
+    for finding matches inside a word. The signin page searches it with
+    signinSearch, so searches don't need to scan the roster."""
+    token_people = collections.defaultdict(list)
+    for row, name in enumerate(names):
+        for token in member_search.name_tokens(name):
+            token_people[token].append(row)
+    tokens = sorted(token_people)
+    token_trigrams = collections.defaultdict(list)
+    for token_index, token in enumerate(tokens):
+        for trigram in member_search.trigrams(token):
+            token_trigrams[trigram].append(token_index)
+    return dict(
+        tokens=tokens,
+        postings=[token_people[token] for token in tokens],
+        trigrams=token_trigrams,
+    )
+
+@permission_required('gate.signin_app')
+@require_GET
+@gzip_page
+@conditional_page
+@cache_control(private=True, no_cache=True)
+def signin_roster(request, pk):
+    """JSON roster of people for the signin page
+
+    Responses carry an ETag, so a client that already has the current roster
+    can revalidate it with If-None-Match and get a 304 back."""
+    dance = get_object_or_404(gate_models.Dance, pk=pk)
+    data = signin_roster_data(dance)
+    return JsonResponse(data=data, json_dumps_params=dict(separators=(',', ':')))
+
 class FailureResponseException(Exception):
     def __init__(self, response):
         super().__init__()
@@ -286,13 +438,28 @@ class JSONFailureException(FailureResponseException):
         super().__init__(response)
         self.msg = msg
 
-def make_api_getters(params):
-    """Return functions to get field/object or return error"""
+def make_api_getters(params, cache=None):
+    """Return functions to get field/object or return error
+
+    If supplied, `cache` maps models to dicts of objects by pk (as returned by
+    `in_bulk`), and objects are looked up there rather than queried one by
+    one."""
+    def get_cached(model, pk):
+        try:
+            obj = cache[model].get(model._meta.pk.to_python(pk))
+        except ValidationError as exc:
+            raise model.DoesNotExist() from exc
+        if obj is None:
+            raise model.DoesNotExist()
+        return obj
+
     def get_object_or_respond(model, field, null_ok=False):
         try:
             pk = params[field]
             if null_ok and pk in (0, '0', ['0']):
                 return None
+            if cache is not None:
+                return get_cached(model, pk)
             return model.objects.get(pk=pk)
         except KeyError as exc:
             raise JSONFailureException(f'Could not find field {field}') from exc
@@ -305,7 +472,7 @@ def make_api_getters(params):
             return converter(params[field])
         except KeyError as exc:
             raise JSONFailureException(f'Could not find field {field}') from exc
-        except ValueError as exc:
+        except (TypeError, ValueError) as exc:
             msg = f'Could not interpret field {field} ({params[field]})'
             raise JSONFailureException(msg) from exc
         except decimal.InvalidOperation as exc:
@@ -326,8 +493,9 @@ def make_api_getters(params):
 # - paid_period: SubscriptionPeriod
 
 def _signin_api_paid(person: member_models.Person, dance: gate_models.Dance,
-                     notes: str, params) -> gate_models.Payment:
-    """Create payment record in the signin API"""
+                     notes: str, params,
+                     changes: List[gate_models.GateChange]) -> gate_models.Payment:
+    """Create payment record in the signin API, adding to changes"""
     get_object_or_respond, get_field_or_respond = make_api_getters(params)
 
     paid_amount = get_field_or_respond(decimal.Decimal, 'paid_amount')
@@ -343,7 +511,7 @@ def _signin_api_paid(person: member_models.Person, dance: gate_models.Dance,
         payment = gate_models.DancePayment(person=person, at_dance=dance,
                                            payment_type=paid_method,
                                            amount=paid_amount,
-                                           fee_cat=person.fee_cat,
+                                           fee_cat_id=person.fee_cat_id,
                                            for_dance=for_dance,
                                            notes=notes, )
         payment.save()
@@ -359,41 +527,101 @@ def _signin_api_paid(person: member_models.Person, dance: gate_models.Dance,
                                                   at_dance=dance,
                                                   payment_type=paid_method,
                                                   amount=paid_amount,
-                                                  fee_cat=person.fee_cat,
+                                                  fee_cat_id=person.fee_cat_id,
                                                   notes=notes, )
-        payment.save()
-        payment.periods.set(periods)
+        # Adds the periods without first diffing them like periods.set()
+        gate_bulk.bulk_create_subs([(payment, periods)])
     else:
         raise JSONFailureException('Unexpected value {paid_for=}')
+    changes += payment_changes(payment, gate_models.GateChange.Action.CREATE)
     return payment
 
 def _signin_api_present(person: member_models.Person, dance: gate_models.Dance,
-                       payment: Optional[gate_models.Payment], data):
-    """Create attendee record in the API"""
-    defaults = dict(payment=payment)
+                       payment: Optional[gate_models.Payment], data,
+                       changes: List[gate_models.GateChange]):
+    """Create attendee record in the API, adding to changes"""
+    defaults = dict(payment=payment, fee_cat_id=person.fee_cat_id)
     qs = gate_models.Attendee.objects
     attendee, created = qs.get_or_create(person=person, dance=dance, defaults=defaults)
     if created:
         data['attendee_created'] = True
+        changes += attendee_changes(attendee, gate_models.GateChange.Action.CREATE)
     else:
         data['attendee_created'] = False
-        if attendee.payment:
+        if attendee.payment_id:
             data['msg'] = 'Success, attendee already existed, with payment'
         elif payment:
             attendee.payment = payment
             attendee.save()
+            changes += attendee_changes(attendee, gate_models.GateChange.Action.UPDATE)
             data['msg'] = 'Success, attendee already existed, but set payment'
     return attendee
 
+# Idempotency keys, so retried requests don't write twice
+
+IDEMPOTENCY_KEY_MAX_LENGTH = gate_models.SigninRequest._meta.get_field('key').max_length
+
+def _check_idempotency_key(key):
+    if not isinstance(key, str) or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        msg = f'idempotency_key must be a string of at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters'
+        raise JSONFailureException(msg)
+
+def _store_signin_requests(requests):
+    """Save SigninRequest objects, returning an error response on a conflict
+
+    A conflict means another request with the same key committed while this
+    one was running. In that case, roll back this request's writes -- its
+    twin's are the ones that count -- and ask the client to retry, which will
+    get the stored response."""
+    try:
+        with transaction.atomic():
+            gate_models.SigninRequest.objects.bulk_create(requests)
+    except IntegrityError:
+        transaction.set_rollback(True)
+        msg = 'A request with the same idempotency_key was made concurrently; retry'
+        return JsonResponse(data={'msg': msg}, status=HTTPStatus.CONFLICT)
+    return None
+
+def _idempotent_call(params, call):
+    """Return call(params), unless params' `idempotency_key` was seen before
+
+    If a request with the same key has already been processed, its response
+    is returned and nothing is written. Otherwise, the response is stored
+    under the key."""
+    key = params.get('idempotency_key')
+    if key:
+        try:
+            _check_idempotency_key(key)
+        except FailureResponseException as exc:
+            return exc.response
+        previous = gate_models.SigninRequest.objects.filter(key=key).first()
+        if previous:
+            return JsonResponse(data=previous.response, status=previous.status)
+
+    response = call(params)
+    if key:
+        stored = gate_models.SigninRequest(key=key, status=response.status_code,
+                                           response=json.loads(response.content))
+        conflict = _store_signin_requests([stored])
+        if conflict:
+            return conflict
+    return response
+
 @permission_required('gate.signin_app')
 @require_POST
 @transaction.atomic
 def signin_api(request):
-    #pylint:disable=too-many-locals,too-many-statements
+    """Mark somebody present and/or paid
+
+    An `idempotency_key` may be supplied (see _idempotent_call)."""
     # I was going to take JSON input, but apparently jQuery prefers
     # form-encoded, and that seems fine too, so whatever
     params = request.POST
     logger.getChild('signin_api').info('call: params=%s', params)
+    return _idempotent_call(params, _signin_api_call)
+
+def _signin_api_call(params):
+    """Do the work of signin_api"""
     get_object_or_respond, get_field_or_respond = make_api_getters(params)
 
 
@@ -415,11 +643,21 @@ def signin_api(request):
 
         payment = None
         data = dict(msg="Success")
+        # Saved together, once everything is written
+        changes: List[gate_models.GateChange] = []
         if paid:
-            payment = _signin_api_paid(person, dance, notes, params)
+            payment = _signin_api_paid(person, dance, notes, params, changes)
 
         if present:
-            attendee = _signin_api_present(person, dance, payment, data)
+            attendee = _signin_api_present(person, dance, payment, data, changes)
+            if data['attendee_created']:
+                gate_voting.refresh_voting_tallies([person.pk], [dance.pk])
+
+        if paid or present:
+            refresh_pay_methods([person.pk], *_payment_scope(payment, dance))
+        if paid:
+            gate_cube.refresh_payment_cube([payment.time])
+        save_gate_changes(changes)
 
     except FailureResponseException as exc:
         return exc.response
@@ -434,8 +672,15 @@ def signin_api(request):
 @require_POST
 @transaction.atomic
 def signin_api_undo(request):
+    """Delete a payment and/or attendee that signin_api recorded
+
+    An `idempotency_key` may be supplied (see _idempotent_call)."""
     params = request.POST
     logger.getChild('signin_api_undo').info('call: params=%s', params)
+    return _idempotent_call(params, _signin_api_undo_call)
+
+def _signin_api_undo_call(params):
+    """Do the work of signin_api_undo"""
     get_object_or_respond, _get_field_or_respond = make_api_getters(params)
 
     try:
@@ -451,9 +696,19 @@ def signin_api_undo(request):
                 msg = ("Attendee has associated payment, but supplied payment "
                        "doesn't match")
                 raise JSONFailureException(msg)
+            log_attendee_change(attendee, gate_models.GateChange.Action.DELETE)
             attendee.delete()
+            gate_voting.refresh_voting_tallies([attendee.person_id], [attendee.dance_id])
+        person_ids = {obj.person_id for obj in (payment, attendee) if obj}
+        dance_ids, period_ids = _payment_scope(payment, None)
+        if attendee:
+            dance_ids.add(attendee.dance_id)
         if payment:
+            dance_ids.add(payment.at_dance_id)
+            log_payment_change(payment, gate_models.GateChange.Action.DELETE)
             payment.delete()
+            gate_cube.refresh_payment_cube([payment.time])
+        refresh_pay_methods(person_ids, dance_ids, period_ids)
     except FailureResponseException as exc:
         return exc.response
 
@@ -461,8 +716,506 @@ def signin_api_undo(request):
     return JsonResponse(data=data, status=HTTPStatus.OK)
 
 
+### Batch signin, for busy nights and replaying writes made offline
+
+# Most operations to accept in one signin_api_batch call
+SIGNIN_BATCH_LIMIT = 500
+
+def _json_bool(value):
+    """Accept either JSON booleans or "true"/"false" strings"""
+    return value if isinstance(value, bool) else strtobool(value)
+
+def _batch_periods(op):
+    periods = op.get('paid_period', op.get('paid_period[]', []))
+    return periods if isinstance(periods, list) else [periods]
+
+def _signin_batch_cache(dance, ops):
+    """Fetch everything the batch refers to, with one query per model"""
+    def as_int(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    ops = [op for op in ops if isinstance(op, dict)]
+    person_ids = {as_int(op.get('person')) for op in ops} - {None}
+    dance_ids = {as_int(op.get('for_dance')) for op in ops} - {None}
+    period_slugs = {str(slug) for op in ops for slug in _batch_periods(op)}
+    dances = gate_models.Dance.objects.in_bulk(dance_ids - {dance.pk})
+    dances[dance.pk] = dance
+    cache = {
+        member_models.Person: member_models.Person.objects.in_bulk(person_ids),
+        gate_models.Dance: dances,
+        gate_models.PaymentMethod: gate_models.PaymentMethod.objects.in_bulk(),
+        gate_models.SubscriptionPeriod:
+            gate_models.SubscriptionPeriod.objects.in_bulk(period_slugs),
+    }
+    attendees = gate_models.Attendee.objects.filter(dance=dance, person__in=person_ids)
+    return cache, {attendee.person_id: attendee for attendee in attendees}
+
+def _signin_batch_prepare(op, dance, cache):
+    """Check one batch operation, and build its (unsaved) payment
+
+    This mirrors the checks in signin_api and _signin_api_paid."""
+    if not isinstance(op, dict):
+        raise JSONFailureException('Operation must be an object')
+    get_object_or_respond, get_field_or_respond = make_api_getters(op, cache)
+
+    person = get_object_or_respond(member_models.Person, 'person')
+    present = get_field_or_respond(_json_bool, 'present')
+    paid = get_field_or_respond(_json_bool, 'paid')
+    notes = str(op.get('notes', ''))
+    if notes and not paid:
+        raise JSONFailureException('Can only add a note if marking as paid')
+
+    prepared = dict(person=person, present=present, payment=None, periods=[])
+    if paid:
+        _signin_batch_prepare_paid(prepared, op, dance, notes, cache)
+    return prepared
+
+def _signin_batch_prepare_paid(prepared, op, dance, notes, cache):
+    """Check the payment fields of a batch operation, and build the payment"""
+    get_object_or_respond, get_field_or_respond = make_api_getters(op, cache)
+    paid_amount = get_field_or_respond(decimal.Decimal, 'paid_amount')
+    try:
+        # One bad amount would otherwise fail the whole bulk insert
+        gate_models.Payment._meta.get_field('amount').clean(paid_amount, None)
+    except ValidationError as exc:
+        raise JSONFailureException(f'Invalid paid_amount ({paid_amount})') from exc
+    paid_method = get_object_or_respond(gate_models.PaymentMethod, 'paid_method')
+    paid_for = get_field_or_respond(str, 'paid_for')
+    common = dict(person=prepared['person'], at_dance=dance, payment_type=paid_method,
+                  amount=paid_amount, fee_cat_id=prepared['person'].fee_cat_id,
+                  notes=notes)
+    if paid_for == 'dance':
+        if 'for_dance' in op:
+            for_dance = get_object_or_respond(gate_models.Dance, 'for_dance')
+        else:
+            for_dance = dance
+        prepared['payment'] = gate_models.DancePayment(for_dance=for_dance, **common)
+    elif paid_for == 'sub':
+        period_slugs = _batch_periods(op)
+        if not period_slugs:
+            raise JSONFailureException('Field paid_period was missing')
+        prepared['periods'] = [cache[gate_models.SubscriptionPeriod].get(str(slug))
+                               for slug in period_slugs]
+        if None in prepared['periods']:
+            raise JSONFailureException('Could not find some sub periods')
+        prepared['payment'] = gate_models.SubscriptionPayment(**common)
+    else:
+        raise JSONFailureException(f'Unexpected value {paid_for=}')
+
+def _signin_batch_attendee(prepared, dance, attendees, updated):
+    """Find or build the attendee for a batch operation
+
+    Returns the attendee (unsaved if new) and the result fields, like
+    _signin_api_present."""
+    payment = prepared['payment']
+    result = dict(msg='Success')
+    attendee = attendees.get(prepared['person'].pk)
+    if attendee is None:
+        attendee = gate_models.Attendee(person=prepared['person'], dance=dance,
+                                        payment=payment,
+                                        fee_cat_id=prepared['person'].fee_cat_id)
+        attendees[prepared['person'].pk] = attendee
+        result['attendee_created'] = True
+    else:
+        result['attendee_created'] = False
+        if attendee.payment_id:
+            result['msg'] = 'Success, attendee already existed, with payment'
+        elif payment:
+            attendee.payment = payment
+            if attendee.pk:
+                updated.append(attendee)
+            result['msg'] = 'Success, attendee already existed, but set payment'
+    return attendee, result
+
+def _signin_batch_refresh_pay_methods(dance, prepared_ops):
+    dance_ids = {dance.pk}
+    dance_ids.update(prepared['payment'].for_dance_id for prepared in prepared_ops
+                     if isinstance(prepared['payment'], gate_models.DancePayment))
+    period_ids = {period.pk for prepared in prepared_ops for period in prepared['periods']}
+    refresh_pay_methods({prepared['person'].pk for prepared in prepared_ops},
+                        dance_ids, period_ids)
+
+def _signin_batch_write(dance, prepared_ops, attendees):
+    """Write the prepared operations in bulk, returning a result for each"""
+    payments = [prepared['payment'] for prepared in prepared_ops if prepared['payment']]
+    gate_bulk.bulk_create_payments(payments)
+    through = gate_models.SubscriptionPayment.periods.through
+    through.objects.bulk_create([
+        through(subscriptionpayment_id=prepared['payment'].pk,
+                subscriptionperiod_id=period.pk)
+        for prepared in prepared_ops for period in prepared['periods']
+    ])
+
+    new_attendees = []
+    updated_attendees: List[gate_models.Attendee] = []
+    op_attendees = []
+    results = []
+    for prepared in prepared_ops:
+        attendee = None
+        if prepared['present']:
+            attendee, result = _signin_batch_attendee(prepared, dance, attendees,
+                                                      updated_attendees)
+            if result['attendee_created']:
+                new_attendees.append(attendee)
+        else:
+            result = dict(msg='Success')
+        op_attendees.append(attendee)
+        results.append(result)
+    utils_bulk.bulk_create_with_pks(gate_models.Attendee, new_attendees)
+    gate_models.Attendee.objects.bulk_update(updated_attendees, ['payment'])
+    if new_attendees:
+        gate_voting.refresh_voting_tallies({attendee.person_id for attendee in new_attendees},
+                                           [dance.pk])
+
+    changes = []
+    for payment in payments:
+        changes += payment_changes(payment, gate_models.GateChange.Action.CREATE)
+    for attendee in new_attendees:
+        changes += attendee_changes(attendee, gate_models.GateChange.Action.CREATE)
+    for attendee in updated_attendees:
+        changes += attendee_changes(attendee, gate_models.GateChange.Action.UPDATE)
+    save_gate_changes(changes)
+
+    _signin_batch_refresh_pay_methods(dance, prepared_ops)
+    gate_cube.refresh_payment_cube(payment.time for payment in payments)
+
+    # Bulk inserts skip the signals reversion uses, so add them by hand
+    if reversion.is_active():
+        for obj in payments + new_attendees + updated_attendees:
+            reversion.add_to_revision(obj)
+
+    for prepared, attendee, result in zip(prepared_ops, op_attendees, results):
+        result['ok'] = True
+        result['payment'] = prepared['payment'].pk if prepared['payment'] else 0
+        result['attendee'] = attendee.pk if attendee else 0
+    return results
+
+def _signin_batch_parse(body):
+    """Parse the body of a batch request into the dance and list of ops"""
+    try:
+        params = json.loads(body)
+    except ValueError as exc:
+        raise JSONFailureException('Could not parse body as JSON') from exc
+    if not isinstance(params, dict):
+        raise JSONFailureException('Body must be an object')
+    get_object_or_respond, _get_field_or_respond = make_api_getters(params)
+    dance = get_object_or_respond(gate_models.Dance, 'dance')
+    ops = params.get('ops')
+    if not isinstance(ops, list):
+        raise JSONFailureException('Field ops must be a list')
+    if len(ops) > SIGNIN_BATCH_LIMIT:
+        raise JSONFailureException(f'At most {SIGNIN_BATCH_LIMIT} ops are allowed')
+    return dance, ops
+
+@permission_required('gate.signin_app')
+@require_POST
+@transaction.atomic
+def signin_api_batch(request):
+    """Apply many signin_api operations at once
+
+    The body is JSON, `{"dance": pk, "ops": [...]}`, where each op has the
+    same fields as a signin_api call (with `paid_period` as a list). Each op is
+    checked separately -- any that fail are reported and skipped -- and the
+    rest are written with bulk inserts in one transaction. The response's
+    `results` list parallels `ops`, and each has `ok`, `msg`, and (if ok) the
+    same fields as a signin_api response.
+
+    Like signin_api, ops may have an `idempotency_key`, so that the signin
+    page can safely replay writes it queued while offline."""
+    logger.getChild('signin_api_batch').info('call: body=%s', request.body[:1000])
+    try:
+        dance, ops = _signin_batch_parse(request.body)
+    except FailureResponseException as exc:
+        return exc.response
+
+    results, keyed = _signin_batch_run(dance, ops)
+    conflict = _store_signin_requests([
+        gate_models.SigninRequest(
+            key=key,
+            status=HTTPStatus.CREATED if results[op_index]['ok'] else HTTPStatus.BAD_REQUEST,
+            response={k: v for k, v in results[op_index].items() if k != 'ok'},
+        ) for key, op_index in keyed.items()
+    ])
+    if conflict:
+        return conflict
+    return JsonResponse(data=dict(results=results))
+
+def _signin_batch_run(dance, ops):
+    """Check and write a batch of operations
+
+    Returns the results, and a map from each new idempotency key to the index
+    of its op. Ops whose key has been seen before get the stored result and
+    aren't written again."""
+    #pylint:disable=too-many-locals
+    cache, attendees = _signin_batch_cache(dance, ops)
+    keys = [op.get('idempotency_key') for op in ops if isinstance(op, dict)]
+    previous = gate_models.SigninRequest.objects.in_bulk(
+        [key for key in keys if isinstance(key, str) and key], field_name='key')
+    results: List[Dict[str, Any]] = [{}] * len(ops)
+    keyed: Dict[str, int] = {}
+    duplicates = []
+    prepared_ops = []
+    prepared_indexes = []
+    for op_index, op in enumerate(ops):
+        key = None
+        try:
+            if isinstance(op, dict) and op.get('idempotency_key'):
+                _check_idempotency_key(op['idempotency_key'])
+                key = op['idempotency_key']
+                if key in previous:
+                    stored = previous[key]
+                    results[op_index] = dict(stored.response, ok=stored.status < 400)
+                    continue
+                if key in keyed:
+                    duplicates.append((op_index, keyed[key]))
+                    continue
+            prepared_ops.append(_signin_batch_prepare(op, dance, cache))
+            prepared_indexes.append(op_index)
+        except JSONFailureException as exc:
+            results[op_index] = dict(ok=False, msg=exc.msg)
+        if key:
+            keyed[key] = op_index
+    written = _signin_batch_write(dance, prepared_ops, attendees)
+    for op_index, result in zip(prepared_indexes, written):
+        results[op_index] = result
+    for op_index, original_index in duplicates:
+        results[op_index] = results[original_index]
+    return results, keyed
+
+
+### Change log, so signin stations can follow each other's changes
+
+def gate_change_cursor(dance: gate_models.Dance) -> int:
+    """Return the id of the latest change for dance (or 0 if none)"""
+    changes = gate_models.GateChange.objects.filter(dance=dance)
+    latest = changes.order_by('-pk').values_list('pk', flat=True).first()
+    return latest or 0
+
+def _gate_changes(dance_ids, kind, action, obj, data=None):
+    """Build change records for obj (an Attendee or Payment), one per dance"""
+    return [
+        gate_models.GateChange(dance_id=dance_id, kind=kind, action=action,
+                               object_id=obj.pk, person_id=obj.person_id,
+                               data=data or {})
+        for dance_id in sorted(set(dance_ids)) if dance_id
+    ]
+
+def attendee_changes(attendee: gate_models.Attendee,
+                     action: str) -> List[gate_models.GateChange]:
+    """Build (unsaved) change records for attendee"""
+    data = dict(payment=attendee.payment_id)
+    return _gate_changes([attendee.dance_id], gate_models.GateChange.Kind.ATTENDEE,
+                         action, attendee, data)
+
+def payment_changes(payment: gate_models.Payment,
+                    action: str) -> List[gate_models.GateChange]:
+    """Build (unsaved) change records for payment
+
+    Dance payments are logged for both the dance they were made at and the
+    dance they were for."""
+    dance_ids = [payment.at_dance_id]
+    data: Dict[str, Any] = dict(amount=str(payment.amount),
+                                payment_type=payment.payment_type_id)
+    if isinstance(payment, gate_models.DancePayment):
+        dance_payment: Optional[gate_models.DancePayment] = payment
+    elif isinstance(payment, gate_models.SubscriptionPayment):
+        dance_payment = None
+    else:
+        dance_payment = gate_models.DancePayment.objects.filter(payment_ptr=payment).first()
+    if dance_payment:
+        data['paid_for'] = 'dance'
+        data['for_dance'] = dance_payment.for_dance_id
+        dance_ids.append(dance_payment.for_dance_id)
+    else:
+        data['paid_for'] = 'sub'
+    return _gate_changes(dance_ids, gate_models.GateChange.Kind.PAYMENT,
+                         action, payment, data)
+
+def save_gate_changes(changes: List[gate_models.GateChange]):
+    """Save change records, and notify the events streams for their dances"""
+    gate_models.GateChange.objects.bulk_create(changes)
+    gate_events.notify(change.dance_id for change in changes)
+
+def log_attendee_change(attendee: gate_models.Attendee, action: str):
+    """Record a change to attendee (call before deleting it)"""
+    save_gate_changes(attendee_changes(attendee, action))
+
+def log_payment_change(payment: gate_models.Payment, action: str):
+    """Record a change to payment (call before deleting it)"""
+    save_gate_changes(payment_changes(payment, action))
+
+def _signin_people_status(dance, person_ids):
+    """Find the roster status of some people, by pk"""
+    people, subscribers = _signin_people(dance, person_ids)
+    return {
+        person.pk: dict(status=ROSTER_BUTTON_STATUS[person.button_class],
+                        subscriber=1 if person.pk in subscribers else 0)
+        for person in people
+    }
+
+# Most changes to return to a signin_api_changes call
+GATE_CHANGES_LIMIT = 200
+
+@permission_required('gate.signin_app')
+@require_GET
+def signin_api_changes(request):
+    """Return changes to a dance since a cursor
+
+    Parameters are `dance` and `since` (a cursor from the roster or a previous
+    call). The response has the changes, the new cursor, whether there are
+    `more` changes to fetch, and the current status of everybody affected,
+    so the cost is proportional to the number of changes, not the roster."""
+    get_object_or_respond, get_field_or_respond = make_api_getters(request.GET)
+    try:
+        dance = get_object_or_respond(gate_models.Dance, 'dance')
+        since = get_field_or_respond(int, 'since')
+    except FailureResponseException as exc:
+        return exc.response
+    return JsonResponse(data=_signin_changes_data(dance, since))
+
+def _signin_changes_data(dance, since):
+    """Find the changes to a dance since a cursor (see signin_api_changes)"""
+    changes = gate_models.GateChange.objects.filter(dance=dance, pk__gt=since)
+    changes = changes.order_by('pk')
+    fields = ('id', 'time', 'kind', 'action', 'object_id', 'person_id', 'data')
+    change_list = list(changes.values(*fields)[:GATE_CHANGES_LIMIT+1])
+    more = len(change_list) > GATE_CHANGES_LIMIT
+    change_list = change_list[:GATE_CHANGES_LIMIT]
+
+    person_ids = {change['person_id'] for change in change_list}
+    data = dict(
+        cursor=change_list[-1]['id'] if change_list else since,
+        more=more,
+        changes=change_list,
+        people=_signin_people_status(dance, person_ids) if person_ids else {},
+    )
+    return data
+
+
+### Live updates, over server-sent events
+#
+# These are off unless settings.GATE_EVENTS_STREAMS is set, since each open
+# stream holds a server thread (see the setting).
+
+# How often (in seconds) a stream checks the change log and sends a keepalive
+# if it hasn't been notified of changes. With the "local" events broker, this
+# bounds the delay for changes made via another server process.
+GATE_EVENTS_HEARTBEAT = 15
+# How long (in seconds) to keep a stream open before asking the browser to
+# reconnect, so a stream doesn't hold a server thread forever
+GATE_EVENTS_DURATION = 5*60
+# How long (in milliseconds) browsers should wait before reconnecting
+GATE_EVENTS_RETRY = 1000
+
+def _sse_message(event, event_id, data):
+    data = json.dumps(data, cls=DjangoJSONEncoder)
+    return f'event: {event}\nid: {event_id}\ndata: {data}\n\n'
+
+def _event_stream_since(request):
+    """Find where an events stream starts: Last-Event-ID, or else `since`
+
+    Raises Http404 if streams are off, so browsers fall back to polling."""
+    if not settings.GATE_EVENTS_STREAMS:
+        raise Http404("Live updates are off")
+    params = request.GET.copy()
+    if 'Last-Event-ID' in request.headers:
+        params['since'] = request.headers['Last-Event-ID']
+    _get_object_or_respond, get_field_or_respond = make_api_getters(params)
+    return get_field_or_respond(int, 'since')
+
+def gate_event_stream(dance, since, event, render_event):
+    """Generate server-sent events as dance's change log moves past since
+
+    Whenever it does, render_event(cursor) is called, and should return the new
+    cursor (used as the event id) and the data for the event."""
+    deadline = monotonic() + GATE_EVENTS_DURATION
+    with gate_events.listen(dance.pk) as listener:
+        yield f'retry: {GATE_EVENTS_RETRY}\n\n'
+        cursor = since
+        while True:
+            if gate_change_cursor(dance) > cursor:
+                cursor, data = render_event(cursor)
+                yield _sse_message(event, cursor, data)
+                continue
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return
+            if not listener.wait(min(GATE_EVENTS_HEARTBEAT, remaining)):
+                yield ': keepalive\n\n'
+
+def event_stream_response(stream):
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Don't let proxies hold events back to buffer them
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@permission_required('gate.signin_app')
+@require_GET
+def signin_api_events(request):
+    """Stream changes to a dance, as server-sent events
+
+    Parameters are `dance` and `since`, like signin_api_changes, and each
+    `changes` event has the same data as a signin_api_changes response. When
+    the browser reconnects, the Last-Event-ID header overrides `since`."""
+    get_object_or_respond, _get_field_or_respond = make_api_getters(request.GET)
+    try:
+        dance = get_object_or_respond(gate_models.Dance, 'dance')
+        since = _event_stream_since(request)
+    except FailureResponseException as exc:
+        return exc.response
+
+    def render_changes(cursor):
+        data = _signin_changes_data(dance, cursor)
+        return data['cursor'], data
+    return event_stream_response(gate_event_stream(dance, since, 'changes', render_changes))
+
+
 ### Books app
 
+def _payment_expected_price(payment) -> Optional[gate_prices.Price]:
+    """Find the usual price for what payment bought, if known"""
+    fee_cat = payment.fee_cat_id or payment.person.fee_cat_id
+    try:
+        return gate_prices.price_for(fee_cat, payment.dancepayment.for_dance)
+    except gate_models.DancePayment.DoesNotExist:
+        pass
+    try:
+        periods = payment.subscriptionpayment.periods.all()
+    except gate_models.SubscriptionPayment.DoesNotExist:
+        return None
+    if not periods:
+        return None
+    low = high = 0
+    for period in periods:
+        price = gate_prices.price_for(fee_cat, period)
+        if price is None:
+            return None
+        low += price[0]
+        high += price[1]
+    return (low, high, gate_models.format_price_range(low, high))
+
+def _books_annotate_expected_price(payments):
+    """Annotate payments with their usual price, and if the amount differs"""
+    for payment in payments:
+        payment.expected_price = _payment_expected_price(payment)
+        if payment.expected_price:
+            low, high, _text = payment.expected_price
+            payment.unexpected_amount = not low <= payment.amount <= high
+
+def books_summary(dance):
+    """Build the books summary (attendee counts and payment totals)
+
+    This is the part of the books page that books_events keeps up to date.
+    It comes from the dance's ledger (see gate_ledger.dance_ledger)."""
+    summary = gate_ledger.dance_ledger(dance)
+    logger.debug('books totals: %s', summary['payment_totals'])
+    summary.update(dance=dance, payment_totals=summary['payment_totals'].items())
+    return summary
+
 @permission_required('gate.books_app')
 def books(request, pk):
     """Main books view"""
@@ -470,38 +1223,45 @@ def books(request, pk):
     period = dance.period
     payments = dance.payment_set.all()
     payments = payments.order_by('payment_type', 'amount', 'time')
+    payments = payments.select_related('person__fee_cat', 'payment_type',
+                                       'dancepayment__for_dance')
+    payments = payments.prefetch_related('subscriptionpayment__periods')
+    _books_annotate_expected_price(payments)
     attendees = dance.attendee_set.order_by('person__name')
-    num_mit = sum(1 if att.person.fee_cat.slug == 'mit-student' else 0
-                  for att in attendees)
-
-    # Total up amounts paid
-    summary_keys = [
-        'dancepayment__for_dance__time',
-        'dancepayment__for_dance',
-        'person__status__member',
-        'person__fee_cat__name',
-        'payment_type__name',
-    ]
-    summary_vals = dict(num=Count('person'), amount=Sum('amount'))
-    payment_subtotals = dance.payment_set.values(*summary_keys).order_by(*summary_keys)
-    payment_subtotals = payment_subtotals.annotate(**summary_vals)
-    payment_totals = collections.Counter()
-    for cat in payment_subtotals:
-        payment_totals[cat['payment_type__name']] += cat['amount']
-    print(payment_totals.items())
+    attendees = attendees.select_related('person__fee_cat', 'fee_cat')
 
     context = dict(
         pagename='signin',
-        dance=dance,
         period=period,
-        payment_subtotals=reversed(payment_subtotals),
-        payment_totals=payment_totals.items(),
         payments=payments,
         attendees=attendees,
-        num_mit=num_mit,
+        # Changes after this are pushed by books_events
+        cursor=gate_change_cursor(dance),
+        events_streams=settings.GATE_EVENTS_STREAMS,
+        **books_summary(dance),
     )
     return render(request, 'gate/books.html', context)
 
+@permission_required('gate.books_app')
+@require_GET
+def books_events(request, pk):
+    """Stream updated books summaries for a dance, as server-sent events
+
+    Each `summary` event has the rendered summary (see books_summary) as
+    `html`. The stream starts after the `since` cursor (or the Last-Event-ID
+    header, when the browser reconnects)."""
+    dance = get_object_or_404(gate_models.Dance, pk=pk)
+    try:
+        since = _event_stream_since(request)
+    except FailureResponseException as exc:
+        return exc.response
+
+    def render_summary(_cursor):
+        cursor = gate_change_cursor(dance)
+        html = render_to_string('gate/books_summary.html', books_summary(dance))
+        return cursor, dict(cursor=cursor, html=html)
+    return event_stream_response(gate_event_stream(dance, since, 'summary', render_summary))
+
 
 ### Subscription upload
 
@@ -557,21 +1317,47 @@ def _fill_squarespay_note(row) -> str:
         lines.append(f"{label}: {val}")
     return "\n".join(lines)
 
-def _fill_squarespay_people(name_str, errors) -> List[member_models.Person]:
+def _squarespay_names(name_str) -> List[str]:
+    """Split the name field of a payment into the names of the people"""
     names = [name.strip() for name in name_str.split(',')]
     if len(names) == 1:
         name_words = name_str.split()
         if len(name_words) == 4:
             first1, _and, first2, last = name_words
             names = [f"{first1} {last}", f"{first2} {last}"]
-    people: List[member_models.Person] = []
-    for name in names:
-        try:
-            person = member_models.Person.objects.get(name=name)
-            people.append(person)
-        except member_models.Person.DoesNotExist:
-            errors.append("Person couldn't be found: %s" % (name, ))
-    return people
+    return names
+
+class _SquaresPayPeople: # pylint:disable=too-few-public-methods
+    """People named in an upload, looked up in bulk"""
+
+    def __init__(self, rows):
+        names = {name for row in rows for name in _squarespay_names(row['name'])}
+        self.found = member_search.find_people_by_name(names)
+        self.suggestions = member_search.suggest_people(names - set(self.found))
+
+    def people(self, name_str, errors) -> List[member_models.Person]:
+        """Find the people for a payment's name field, adding errors for unknown names"""
+        people: List[member_models.Person] = []
+        for name in _squarespay_names(name_str):
+            if name in self.found:
+                people.append(self.found[name])
+            elif name in self.suggestions:
+                maybe = ', '.join(person.name for person in self.suggestions[name])
+                errors.append("Person couldn't be found: %s (did you mean: %s?)" % (name, maybe))
+            else:
+                errors.append("Person couldn't be found: %s" % (name, ))
+        return people
+
+def _parse_squarespay_amount(value, errors) -> Optional[decimal.Decimal]:
+    """Parse a payment's total, adding an error if it isn't a valid amount"""
+    try:
+        amount = decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        amount = None
+    if amount is None or not amount.is_finite():
+        errors.append('Unexpected amount %r' % (value, ))
+        return None
+    return amount
 
 def _fill_squarespay_sub_amount(total, sub_datas):
     """Allocate payment among people for a single sub payment"""
@@ -580,7 +1366,7 @@ def _fill_squarespay_sub_amount(total, sub_datas):
         sub_data['amount'] = amount
 
 def _find_squarespay_subs_from_row(new_subs, errors, warns,
-                                   allow_periods, row, payment_type) -> None:
+                                   allow_periods, row, payment_type, people_lookup) -> None:
     # pylint:disable=too-many-arguments,too-many-positional-arguments
     assert row['paymentOption'] == 'card'
     if row['decision'] != 'ACCEPT':
@@ -590,11 +1376,13 @@ def _find_squarespay_subs_from_row(new_subs, errors, warns,
     periods = _fill_squarespay_periods(row, allow_periods, errors)
     if periods is None:
         return
+    if _parse_squarespay_amount(row['amount'], errors) is None:
+        return
     notes = _fill_squarespay_note(row)
-    people = _fill_squarespay_people(row['name'], errors)
+    people = people_lookup.people(row['name'], errors)
     data = dict(at_dance=None, time=row['webform_completed_time'],
                 payment_type=payment_type,
-                notes=notes, periods=periods, )
+                notes=notes, periods=periods, webform_sid=row['webform_sid'], )
     sub_datas = []
     for person in people:
         data2 = data.copy()
@@ -605,6 +1393,18 @@ def _find_squarespay_subs_from_row(new_subs, errors, warns,
         new_subs.append((row, data2))
     _fill_squarespay_sub_amount(row['amount'], sub_datas)
 
+def _skip_imported_squarespay_rows(rows, warns):
+    """Drop rows for submissions that were already imported, with a warning"""
+    imports = gate_models.SquaresPayImport.objects.filter(
+        webform_sid__in={row['webform_sid'] for row in rows})
+    imported = set(imports.values_list('webform_sid', flat=True))
+    if imported:
+        names = ['%s (SID %s)' % (row['name'], row['webform_sid'])
+                 for row in rows if row['webform_sid'] in imported]
+        warns.append('Skipped %d payments that were already imported: %s' %
+                     (len(names), ', '.join(names)))
+    return [row for row in rows if row['webform_sid'] not in imported]
+
 def find_subs_from_upload(subs_file, form):
     """Processes payment data from squares-pay
 
@@ -612,6 +1412,10 @@ def find_subs_from_upload(subs_file, form):
     webform_serial is per form, webform_sid is site-wide
     (per https://www.drupal.org/project/webform/issues/919832)
 
+    Submissions whose webform_sid was imported before (see
+    gate_models.SquaresPayImport) are skipped, so overlapping exports can be
+    uploaded.
+
     We care about:
     webform_completed_time -- copied to payment.time
     name/email -- used to find person
@@ -637,6 +1441,24 @@ def find_subs_from_upload(subs_file, form):
     errors = []
     warns = []
 
+    reader = _squarespay_reader(subs_file, errors)
+    if reader is None:
+        # Don't bother running the rest of the code (especially since it will surely error)
+        return new_subs, errors, warns
+
+    # Parse the fields, looking up everyone named in the file at once
+    rows = _skip_imported_squarespay_rows(list(reader), warns)
+    people_lookup = _SquaresPayPeople(rows)
+    for row in rows:
+        _find_squarespay_subs_from_row(new_subs, errors, warns, allow_periods, row, payment_type,
+                                       people_lookup)
+    return new_subs, errors, warns
+
+def _squarespay_reader(subs_file, errors) -> Optional[csv.DictReader]:
+    """Start reading a Squares Pay export, checking that it has the right fields
+
+    Returns a DictReader for the rows, or None (with errors added) if the
+    file isn't usable."""
     try:
         subs_text = io.TextIOWrapper(subs_file) # binary mode -> text mode
         subs_text.readline() # First two lines aren't really headers
@@ -645,35 +1467,66 @@ def find_subs_from_upload(subs_file, form):
         error = "Couldn't parse upload as text. (Is it in UTF-8?)"
         errors.append(error)
         logger.warning(error)
-        return new_subs, errors, warns
+        return None
 
     # Create reader and check for correct fields in the TSV
     reader = csv.DictReader(subs_text, delimiter='\t')
-    expected_fields = ['webform_completed_time', 'name', 'amount', 'notes', 'paymentOption',
-                       'decision']
+    fieldnames = reader.fieldnames or []
+    expected_fields = ['webform_sid', 'webform_completed_time', 'name', 'amount', 'notes',
+                       'paymentOption', 'decision']
     for field in expected_fields:
-        if not field in reader.fieldnames:
+        if not field in fieldnames:
             errors.append('Missing expected fields. For the Squares Pay export format, '
                           'did you choose "delimited text" using tabs and with "form keys" '
                           'for the column headers?')
             error = "Missing expected field %s: got fields %s, expected at least fields %s" % \
-                    (field, reader.fieldnames, expected_fields, )
+                    (field, fieldnames, expected_fields, )
             errors.append(error)
             logger.warning(error)
             break
-    if 'tuesday_subscriptions' not in reader.fieldnames:
+    if 'tuesday_subscriptions' not in fieldnames:
         errors.append('Missing tuesday_subscriptions field. Under "select list options", '
                       'did you choose "Short, raw options (keys)" '
                       'and the "compact" select list format?')
-    if errors:
-        # Don't bother running the rest of the code (especially since it will surely error)
-        return new_subs, errors, warns
-
-    # Parse the fields
-    for row in reader:
-        _find_squarespay_subs_from_row(new_subs, errors, warns, allow_periods, row, payment_type)
-    return new_subs, errors, warns
-
+    return None if errors else reader
+
+
+def _refresh_sub_pay_methods(subpays):
+    """Update Attendee.pay_method (and the payments cube) for a list of
+    (saved) SubscriptionPayments"""
+    periods = gate_models.SubscriptionPayment.periods.through.objects
+    periods = periods.filter(subscriptionpayment__in=subpays)
+    refresh_pay_methods({subpay.person_id for subpay in subpays},
+                        period_ids=set(periods.values_list('subscriptionperiod_id', flat=True)))
+    gate_cube.refresh_payment_cube(subpay.time for subpay in subpays)
+
+def _save_upload_subs(forms_to_save):
+    """Save the subscriptions from an upload's formset, and their SquaresPayImports
+
+    Returns the new subscriptions and warnings. Subscriptions that were
+    imported since the upload (say, from another tab) are skipped."""
+    sid_people = [(form.cleaned_data['webform_sid'], form.instance.person_id)
+                  for form in forms_to_save]
+    imports = gate_models.SquaresPayImport.objects.filter(
+        webform_sid__in={sid for sid, _person in sid_people if sid})
+    imported = set(imports.values_list('webform_sid', 'person'))
+    warns = ['Skipped %s (SID %s), which was already imported' % (form.instance.person, sid)
+             for form, (sid, person_id) in zip(forms_to_save, sid_people)
+             if (sid, person_id) in imported]
+    forms_to_save = [form for form, sid_person in zip(forms_to_save, sid_people)
+                     if sid_person not in imported]
+
+    subpays = gate_bulk.bulk_create_subs([(form.instance, form.cleaned_data['periods'])
+                                          for form in forms_to_save])
+    sub_imports = gate_models.SquaresPayImport.objects.bulk_create([
+        gate_models.SquaresPayImport(webform_sid=form.cleaned_data['webform_sid'],
+                                     person_id=subpay.person_id, payment=subpay)
+        for form, subpay in zip(forms_to_save, subpays) if form.cleaned_data['webform_sid']
+    ])
+    if reversion.is_active():
+        for import_row in sub_imports:
+            reversion.add_to_revision(import_row)
+    return subpays, warns
 
 def _bulk_add_subs(request, new_subs=None, errors=None, warns=None):
     if new_subs:
@@ -697,7 +1550,10 @@ def _bulk_add_subs(request, new_subs=None, errors=None, warns=None):
             with reversion.create_revision(atomic=True):
                 reversion.set_comment("bulk sub add")
                 reversion.set_user(request.user)
-                context['sub_instances'] = formset.save()
+                new = {id(sub) for sub in formset.save(commit=False)}
+                forms_to_save = [form for form in formset.forms if id(form.instance) in new]
+                context['sub_instances'], context['warns'] = _save_upload_subs(forms_to_save)
+                _refresh_sub_pay_methods(context['sub_instances'])
         else:
             context['sub_formset'] = formset
     return render(request, 'gate/sub_upload.html', context)
@@ -718,18 +1574,198 @@ def upload_subs(request):
     return render(request, 'gate/sub_upload.html', {'upload_form': form})
 
 
+### Staged subscription import, for big Squares Pay exports
+
+# Rows to parse (and look people up for) at once when staging an upload
+SUB_IMPORT_STAGE_CHUNK = 500
+# Staged rows to turn into subscriptions per request
+SUB_IMPORT_CHUNK = 1000
+# Staged rows to show per page
+SUB_IMPORT_PAGE = 100
+
+def _parse_squarespay_time(value) -> Optional[datetime.datetime]:
+    try:
+        time = parse_datetime(value)
+    except ValueError:
+        return None
+    if time and timezone.is_naive(time):
+        time = timezone.make_aware(time)
+    return time
+
+def _check_squarespay_amounts(new_subs, errors):
+    """Round the amounts of a row's subscriptions, adding an error if they don't fit"""
+    for _row, data in new_subs:
+        data['amount'] = data['amount'].quantize(decimal.Decimal('0.01'))
+        try:
+            gate_models.Payment._meta.get_field('amount').clean(data['amount'], None)
+        except ValidationError:
+            errors.append('Amount %s is too large' % (data['amount'], ))
+            return
+
+def _stage_squarespay_row(line, row, imported, parse_args) -> List[gate_models.SubImportRow]:
+    """Build the SubImportRows for a row of a Squares Pay export"""
+    Status = gate_models.SubImportRow.Status # pylint:disable=invalid-name
+    base = dict(line=line, webform_sid=row['webform_sid'], name=row['name'][:255])
+    if row['webform_sid'] in imported:
+        return [gate_models.SubImportRow(status=Status.SKIPPED, message='Already imported',
+                                         **base)]
+    new_subs: List[Tuple[Dict, Dict]] = []
+    errors: List[str] = []
+    warns: List[str] = []
+    allow_periods, payment_type, people_lookup = parse_args
+    _find_squarespay_subs_from_row(new_subs, errors, warns, allow_periods, row, payment_type,
+                                   people_lookup)
+    time = _parse_squarespay_time(row['webform_completed_time'])
+    if time is None:
+        errors.append('Unexpected time %r' % (row['webform_completed_time'], ))
+    _check_squarespay_amounts(new_subs, errors)
+    if errors:
+        return [gate_models.SubImportRow(status=Status.ERROR, message='\n'.join(errors),
+                                         **base)]
+    if not new_subs:
+        return [gate_models.SubImportRow(status=Status.SKIPPED, message='\n'.join(warns),
+                                         **base)]
+    return [gate_models.SubImportRow(status=Status.READY, person=data['person'], time=time,
+                                     amount=data['amount'],
+                                     periods=[period.slug for period in data['periods']],
+                                     notes=data['notes'], **base)
+            for _row, data in new_subs]
+
+def stage_sub_import(batch, subs_file, sub_periods) -> List[str]:
+    """Parse a Squares Pay export into SubImportRows of batch
+
+    Rows are read, checked, and written SUB_IMPORT_STAGE_CHUNK at a time, so
+    memory use doesn't grow with the size of the file. Returns errors with
+    the file as a whole, in which case nothing is staged."""
+    errors: List[str] = []
+    reader = _squarespay_reader(subs_file, errors)
+    if reader is None:
+        return errors
+    allow_periods = _build_period_label_obj_map(sub_periods)
+    payment_type = gate_models.PaymentMethod(slug='credit')
+    # The first row is on line 4, after the two junk lines and the header
+    lines = enumerate(reader, start=4)
+    while chunk := list(itertools.islice(lines, SUB_IMPORT_STAGE_CHUNK)):
+        rows = [row for _line, row in chunk]
+        imports = gate_models.SquaresPayImport.objects.filter(
+            webform_sid__in={row['webform_sid'] for row in rows})
+        imported = set(imports.values_list('webform_sid', flat=True))
+        parse_args = (allow_periods, payment_type, _SquaresPayPeople(
+            [row for row in rows if row['webform_sid'] not in imported]))
+        staged = [staged_row for line, row in chunk
+                  for staged_row in _stage_squarespay_row(line, row, imported, parse_args)]
+        for staged_row in staged:
+            staged_row.batch = batch
+        gate_models.SubImportRow.objects.bulk_create(staged)
+    return errors
+
+def import_sub_rows(batch, limit: Optional[int] = None) -> int:
+    """Create subscriptions for (up to limit, default SUB_IMPORT_CHUNK, of)
+    the ready rows of batch
+
+    Call this inside reversion.create_revision (or another transaction).
+    Returns the number of subscriptions created. If the same batch is
+    imported twice at once (say, a double-clicked button), each row is only
+    imported by one of them."""
+    Status = gate_models.SubImportRow.Status # pylint:disable=invalid-name
+    # Imports of a batch take turns (where the database can lock rows)...
+    gate_models.SubImportBatch.objects.select_for_update().filter(pk=batch.pk).exists()
+    ready = batch.rows.filter(status=Status.READY).order_by('id')
+    row_ids = list(ready.values_list('pk', flat=True)[:limit or SUB_IMPORT_CHUNK])
+    # ...and claim their rows, so rows another import just took are left to it
+    batch.rows.filter(pk__in=row_ids, status=Status.READY).update(status=Status.IMPORTED)
+    rows = batch.rows.filter(pk__in=row_ids, status=Status.IMPORTED, payment=None)
+    rows = list(rows.order_by('id').select_related('person'))
+    # Skip anything imported since it was staged
+    imports = gate_models.SquaresPayImport.objects.filter(
+        webform_sid__in={row.webform_sid for row in rows if row.webform_sid})
+    imported = set(imports.values_list('webform_sid', 'person'))
+    todo = []
+    for row in rows:
+        if (row.webform_sid, row.person_id) in imported:
+            row.status, row.message = Status.SKIPPED, 'Already imported'
+        else:
+            todo.append(row)
+
+    subpays = gate_bulk.bulk_create_subs([
+        (gate_models.SubscriptionPayment(person=row.person, at_dance=None, time=row.time,
+                                         payment_type_id='credit', amount=row.amount,
+                                         fee_cat_id=row.person.fee_cat_id, notes=row.notes),
+         row.periods)
+        for row in todo
+    ])
+    sub_imports = gate_models.SquaresPayImport.objects.bulk_create([
+        gate_models.SquaresPayImport(webform_sid=row.webform_sid, person=row.person,
+                                     payment=subpay)
+        for row, subpay in zip(todo, subpays) if row.webform_sid
+    ])
+    if reversion.is_active():
+        for import_row in sub_imports:
+            reversion.add_to_revision(import_row)
+    for row, subpay in zip(todo, subpays):
+        row.status, row.payment = Status.IMPORTED, subpay
+    gate_models.SubImportRow.objects.bulk_update(rows, ['status', 'message', 'payment'])
+    _refresh_sub_pay_methods(subpays)
+    return len(subpays)
+
+@permission_required('gate.add_subscriptionpayment')
+def sub_import(request):
+    """Upload a Squares Pay export to stage, and list recent uploads"""
+    errors: List[str] = []
+    if request.method == 'POST':
+        form = gate_forms.SubImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            with transaction.atomic():
+                batch = gate_models.SubImportBatch.objects.create(
+                    user=request.user, filename=request.FILES['file'].name[:255])
+                errors = stage_sub_import(batch, request.FILES['file'],
+                                          form.cleaned_data['sub_periods'])
+                if not errors:
+                    return redirect(batch)
+                transaction.set_rollback(True)
+    else:
+        form = gate_forms.SubImportForm()
+    batches = gate_models.SubImportBatch.objects.order_by('-time')[:20]
+    context = dict(form=form, errors=errors, batches=batches)
+    return render(request, 'gate/sub_import.html', context)
+
+@permission_required('gate.add_subscriptionpayment')
+def sub_import_batch(request, pk):
+    """Review a staged upload a page at a time, and import it in chunks"""
+    batch = get_object_or_404(gate_models.SubImportBatch, pk=pk)
+    if request.method == 'POST':
+        with reversion.create_revision(atomic=True):
+            reversion.set_comment("sub import: %s" % (batch, ))
+            reversion.set_user(request.user)
+            num = import_sub_rows(batch)
+        logger.info('imported %d subscriptions from %s', num, batch)
+        return redirect(batch)
+
+    counts = dict(batch.rows.order_by().values_list('status').annotate(num=Count('pk')))
+    statuses = [(value, label, counts.get(value, 0))
+                for value, label in gate_models.SubImportRow.Status.choices]
+    rows = batch.rows.order_by('line', 'id').select_related('person')
+    status = request.GET.get('status')
+    if status in gate_models.SubImportRow.Status.values:
+        rows = rows.filter(status=status)
+    page = Paginator(rows, SUB_IMPORT_PAGE).get_page(request.GET.get('page'))
+    context = dict(batch=batch, statuses=statuses, status=status, page=page,
+                   num_ready=counts.get(gate_models.SubImportRow.Status.READY, 0),
+                   total=sum(counts.values()), chunk=SUB_IMPORT_CHUNK)
+    return render(request, 'gate/sub_import_batch.html', context)
+
+
 ### Bulk add subscriptions
 
 def _bulk_sub_save_form(clean, period):
-    subpays = []
-    for person in clean['people']:
-        data = dict(person=person, payment_type=clean['payment_type'],
-                    amount=clean['amount'], fee_cat=person.fee_cat,
-                    notes=clean['notes'])
-        subpay = gate_models.SubscriptionPayment(**data)
-        subpay.save()
-        subpay.periods.add(period)
-        subpays.append(subpay)
+    subpays = gate_bulk.bulk_create_subs([
+        (gate_models.SubscriptionPayment(person=person, payment_type=clean['payment_type'],
+                                         amount=clean['amount'], fee_cat=person.fee_cat,
+                                         notes=clean['notes']), [period])
+        for person in clean['people']
+    ])
+    refresh_pay_methods([person.pk for person in clean['people']], period_ids=[period.pk])
+    gate_cube.refresh_payment_cube(subpay.time for subpay in subpays)
     return subpays
 
 
@@ -771,72 +1807,23 @@ class AnnoPerson(member_models.Person):
 
     def __init__(self, *args: List[Any], **kwargs: Dict[str, Any]) -> None:
         super().__init__(*args, **kwargs)
-        self.attend: Dict[int,gate_models.Attendee] = {}
-        self.dance_pays: Dict[int,gate_models.DancePayment] = {}
-        self.subs: Dict[str,gate_models.SubscriptionPayment] = {}
         self.dance_list: List[Tuple[str,bool]] = [] # list of attendee status per dance, in order
+        self.dance_len = 0 # number of dances attended
+        self.is_voting = False
 
     class Meta:
         proxy = True
 
-def person_table_annotate_people(people: QuerySet[AnnoPerson],
-                                  dance_ids: List[int], sub_ids: List[int]) \
-        -> QuerySet[AnnoPerson]:
-    # Find the people
-    people_dict: Dict[int, AnnoPerson] = {}
-    for person in people:
-        people_dict[person.pk] = person
-
-    # Find attendance data
-    attendees = gate_models.Attendee.objects.filter(person__in=people, dance__in=dance_ids)
-    attendees = attendees.order_by('person', '-dance__time')
-    for attendee in attendees:
-        # This uses a *different* person object than we found above, so we
-        # find the shared one in the dict we built above
-        people_dict[attendee.person.pk].attend[attendee.dance_id] = attendee
-
-    # Find dance payment data
-    dance_pays = gate_models.DancePayment.objects.filter(person__in=people)
-    dance_pays = dance_pays.filter(for_dance__in=dance_ids)
-    for dance_pay in dance_pays:
-        people_dict[dance_pay.person.pk].dance_pays[dance_pay.for_dance_id] = dance_pay
-
-    # Find sub payment data
-    sub_pays = gate_models.SubscriptionPayment.objects.filter(person__in=people)
-    sub_pays = sub_pays.filter(periods__in=sub_ids)
-    for sub_pay in sub_pays:
-        for period in sub_pay.periods.all():
-            people_dict[sub_pay.person.pk].subs[period.pk] = sub_pay
-
-    return people
-
-def _person_table_generate_table(people, dance_ids, sub_ids):
-    """Populate dance_list for voting member table"""
+def _person_table_build_data(people_all, dance_objs):
+    """Build the context for an attendance table (see gate_attendance)"""
+    people = list(people_all.select_related('fee_cat', 'frequency'))
+    free_people = [person.pk for person in people
+                   if person.fee_cat_id in gate_models.FREE_FEE_CATS]
+    matrix = gate_attendance.AttendanceMatrix(dance_objs).load(people_all, free_people)
     for person in people:
-        for dance, period in zip(dance_ids, sub_ids):
-            paid = (dance in person.dance_pays)
-            # TODO: check price, not just hard-coded fee_cat
-            sub = ((period in person.subs) or (person.fee_cat_id == 'mit-student'))
-            if dance in person.attend:
-                if paid or sub:
-                    code = 'X'
-                else:
-                    code = 'O'
-            else:
-                if paid:
-                    code = 'P'
-                else:
-                    code = ''
-            data = (code, sub)
-            person.dance_list.append(data)
+        person.dance_list = matrix.codes(person.pk)
         # This lets us use dictsort in the template
-        person.dance_len = len(person.attend)
-
-def _person_table_build_data(people_all, dance_objs):
-    dance_ids = [dance.pk for dance in dance_objs]
-    sub_ids = [dance.period_id for dance in dance_objs]
-    people = person_table_annotate_people(people_all, dance_ids, sub_ids)
-    _person_table_generate_table(people, dance_ids, sub_ids)
+        person.dance_len = matrix.num_present(person.pk)
 
     # Render the page
     context = dict(
@@ -848,17 +1835,29 @@ def _person_table_build_data(people_all, dance_objs):
 
 @permission_required('gate.view_attendee')
 def voting_members(request):
-    # Find the dances
-    # TODO: Allow choosing the right time range
     # TODO: Allow choosing individual dances
-    # TODO: Automatically filter out non-Tuesday dances
-    # TODO: Summer dances don't count towards the 15, but do count towards attendance numbers
-    end = datetime.datetime.now()
-    dance_qs = gate_models.Dance.objects.filter(time__lte=end).order_by('-time')
-    dance_qs = dance_qs.select_related('period')
-    dance_objs = list(reversed(dance_qs[:15]))
+    form = gate_forms.DanceWindowForm(request.GET)
+    window = form.cleaned_data if form.is_valid() else {}
+    rule = gate_voting.voting_rule()
+    if window.get('end'):
+        as_of = gate_voting.as_of_time(window['end'])
+    else:
+        as_of = timezone.now()
+
+    # Find the dances: by default, the voting window
+    if window.get('start'):
+        dance_qs = gate_models.Dance.objects.select_related('period')
+        dance_qs = dance_qs.filter(time__lte=as_of, time__date__gte=window['start'])
+        dance_objs = [dance for dance in dance_qs.order_by('time') if rule.counts(dance.time)]
+    else:
+        dance_objs = gate_voting.window_dances(as_of, rule)
     people_all = AnnoPerson.objects.filter(status__member=True)
     context = _person_table_build_data(people_all, dance_objs)
+
+    voting = set(gate_voting.voting_people(as_of).values_list('pk', flat=True))
+    for person in context['people']:
+        person.is_voting = person.pk in voting
+    context.update(form=form, rule=rule, as_of=as_of, num_voting=len(voting))
     return render(request, 'gate/voting.html', context)
 
 @permission_required('gate.view_attendee')
@@ -910,58 +1909,191 @@ def pay_stats(request, ):
     # Render the page
     context = dict(
         pagename='signin',
+        form=gate_forms.PayStatsForm(),
     )
     return render(request, 'gate/pay_stats.html', context)
 
+# Rows to read per query when exporting
+PAY_STATS_CHUNK = 2000
+
+class _Echo: # pylint:disable=too-few-public-methods
+    """File-like object that returns what's written, for streaming CSV"""
+    def write(self, value):
+        return value
+
+def _stream_csv(filename, header, rows):
+    """Build a response streaming rows (an iterable) as a CSV file"""
+    # https://docs.djangoproject.com/en/6.0/howto/outputting-csv/#streaming-large-csv-files
+    writer = csv.writer(_Echo())
+    lines = itertools.chain([writer.writerow(header)], (writer.writerow(row) for row in rows))
+    return StreamingHttpResponse(
+        lines, content_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+def _keyset_chunks(queryset, fields):
+    """Read values_list rows of queryset in pk order, PAY_STATS_CHUNK per query
+
+    The pk is the first value of each row. Unlike QuerySet.iterator, this
+    keeps memory use flat on MySQL too, whose client library otherwise
+    buffers the whole result."""
+    last_pk = 0
+    while True:
+        chunk = queryset.filter(pk__gt=last_pk).order_by('pk')
+        chunk = list(chunk.values_list('pk', *fields)[:PAY_STATS_CHUNK])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1][0]
+
+def _pay_stats_params(request):
+    """Parse the start/end/period parameters, or raise FailureResponseException"""
+    form = gate_forms.PayStatsForm(request.GET)
+    if not form.is_valid():
+        raise FailureResponseException(HttpResponse(form.errors.as_text(), status=400,
+                                                    content_type='text/plain'))
+    params = form.cleaned_data
+    if not (params['period'] or params['start']):
+        params['start'] = datetime.date.today() - datetime.timedelta(days=365*2)
+    logger.info('exporting pay stats: %s', params)
+    return params
+
 @permission_required(['gate.view_subscriptionpayment', ])
+@require_GET
 def pay_stats_subs(request, ):
-    # https://docs.djangoproject.com/en/6.0/howto/outputting-csv/
-    response = HttpResponse(
-        content_type="text/csv",
-        headers={"Content-Disposition": 'attachment; filename="tech-squares-subs.csv"'},
-    )
+    """Export subscription payments as CSV
+
+    Takes either `period` (a slug), or `start` and `end` dates, in which case
+    it includes subscriptions for any period overlapping those dates."""
+    try:
+        params = _pay_stats_params(request)
+    except FailureResponseException as exc:
+        return exc.response
+    if params['period']:
+        periods = gate_models.SubscriptionPeriod.objects.filter(pk=params['period'].pk)
+    else:
+        periods = gate_models.SubscriptionPeriod.objects.filter(end_date__gte=params['start'])
+        if params['end']:
+            periods = periods.filter(start_date__lte=params['end'])
+    through = gate_models.SubscriptionPayment.periods.through
+    subs = gate_models.SubscriptionPayment.objects.filter(Exists(through.objects.filter(
+        subscriptionpayment=OuterRef('pk'), subscriptionperiod__in=periods)))
+
+    def rows():
+        fields = ['time', 'payment_type', 'fee_cat', 'amount']
+        for chunk in _keyset_chunks(subs, fields):
+            sub_periods = through.objects.filter(subscriptionpayment__in=[row[0] for row in chunk])
+            sub_periods = sub_periods.order_by('subscriptionperiod__start_date')
+            period_slugs = collections.defaultdict(list)
+            sub_periods = sub_periods.values_list('subscriptionpayment', 'subscriptionperiod')
+            for sub_id, slug in sub_periods:
+                period_slugs[sub_id].append(slug)
+            for pk, *values in chunk:
+                yield values + [','.join(period_slugs[pk])]
 
     cols = ['time', 'payment_type', 'fee_cat', 'amount', 'periods', ]
-    writer = csv.DictWriter(response, cols)
-    writer.writeheader()
-    start_date = datetime.date.today() - datetime.timedelta(days=365*2)
-    periods = gate_models.SubscriptionPeriod.objects.filter(end_date__gte=start_date)
-    subs = gate_models.SubscriptionPayment.objects.filter(periods__in=periods)
-    subs = subs.select_related('payment_type', 'fee_cat')
-    subs = subs.prefetch_related('periods')
-    for sub in subs:
-        sub_periods = ','.join([period.slug for period in sub.periods.all()])
-        writer.writerow({'time': sub.time, 'payment_type': sub.payment_type.slug,
-                         'fee_cat': sub.fee_cat.slug, 'amount': sub.amount,
-                         'periods': sub_periods, })
-    logger.info('used %d queries to find sub payments since %s [periods: %s]',
-                len(connection.queries), start_date, periods)
-    return response
+    return _stream_csv('tech-squares-subs.csv', cols, rows())
 
 @permission_required(['gate.view_dancepayment', ])
+@require_GET
 def pay_stats_dances(request, ):
-    # https://docs.djangoproject.com/en/6.0/howto/outputting-csv/
-    response = HttpResponse(
-        content_type="text/csv",
-        headers={"Content-Disposition": 'attachment; filename="tech-squares-dances.csv"'},
-    )
+    """Export dance payments as CSV
+
+    Takes either `period` (a slug), or `start` and `end` dates, and includes
+    payments for dances in that period or between those dates."""
+    try:
+        params = _pay_stats_params(request)
+    except FailureResponseException as exc:
+        return exc.response
+    dances = gate_models.DancePayment.objects.all()
+    if params['period']:
+        dances = dances.filter(for_dance__period=params['period'])
+    else:
+        dances = dances.filter(for_dance__time__date__gte=params['start'])
+        if params['end']:
+            dances = dances.filter(for_dance__time__date__lte=params['end'])
+
+    def rows():
+        fields = ['time', 'payment_type', 'fee_cat', 'amount',
+                  'for_dance__period', 'for_dance__time']
+        for chunk in _keyset_chunks(dances, fields):
+            for _pk, *values in chunk:
+                yield values
 
     cols = ['time', 'payment_type', 'fee_cat', 'amount', 'period', 'for_dance', ]
-    writer = csv.DictWriter(response, cols)
-    writer.writeheader()
-    start_date = datetime.date.today() - datetime.timedelta(days=365*2)
-    periods = gate_models.SubscriptionPeriod.objects.filter(end_date__gte=start_date)
-    first_dance = min(period.start_date for period in periods)
-    dances = gate_models.DancePayment.objects.filter(for_dance__time__gte=first_dance)
-    dances = dances.select_related('payment_type', 'fee_cat', 'for_dance', )
-    for dance in dances:
-        writer.writerow({'time': dance.time, 'payment_type': dance.payment_type.slug,
-                         'fee_cat': dance.fee_cat.slug, 'amount': dance.amount,
-                         'period': dance.for_dance.period_id,
-                         'for_dance': dance.for_dance.time, })
-    logger.info('used %d queries to find dance payments since (%s) %s [periods: %s]',
-                len(connection.queries), start_date, first_dance, periods)
-    return response
+    return _stream_csv('tech-squares-dances.csv', cols, rows())
+
+def _pay_stats_cube_params(params):
+    """Parse the group, filter, and start/end parameters for pay_stats_cube"""
+    group = [dim for dim in params.get('group', '').split(',') if dim]
+    for dim in group:
+        if dim not in gate_cube.DIMENSIONS:
+            raise JSONFailureException(f'Unknown dimension {dim!r} to group by')
+    filters = {}
+    for dim in gate_cube.DIMENSIONS:
+        values = params.getlist(dim)
+        if not values or dim == 'week':
+            continue
+        if dim == 'member':
+            try:
+                values = [strtobool(value) for value in values]
+            except ValueError as exc:
+                raise JSONFailureException(f'Bad member filter {values!r}') from exc
+        filters[dim] = values
+    form = gate_forms.PayStatsForm(params)
+    form.fields.pop('period')
+    if not form.is_valid():
+        raise JSONFailureException(form.errors.get_json_data())
+    return group, filters, form.cleaned_data['start'], form.cleaned_data['end']
+
+@permission_required(['gate.view_subscriptionpayment', 'gate.view_dancepayment', ])
+@require_GET
+def pay_stats_cube(request, ):
+    """Sum payments from the payments cube, as JSON
+
+    `group` is a comma-separated list of dimensions (week, period, fee_cat,
+    payment_type, paid_for, member) to group by. Any dimension but week can
+    also be passed (perhaps repeatedly) to keep only those values, and
+    `start` and `end` dates limit the weeks. Each row has the grouped
+    dimensions, the number of payments (num), and their amount."""
+    try:
+        group, filters, start, end = _pay_stats_cube_params(request.GET)
+    except FailureResponseException as exc:
+        return exc.response
+    rows, totals = gate_cube.query_cube(group, filters, start, end)
+    return JsonResponse(dict(group=group, rows=rows, totals=totals))
+
+# Content types of the analytics export formats
+ANALYTICS_CONTENT_TYPES = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+@user_passes_test(lambda u: u.is_staff)
+@require_GET
+def analytics_export(request, table, fmt):
+    """Stream a table (see gate.export.TABLES) as Parquet or Arrow IPC
+
+    Only rows with PKs above `since` (default 0) are included, so clients can
+    fetch just what's new since their last export."""
+    if table not in gate_export.TABLES or fmt not in ANALYTICS_CONTENT_TYPES:
+        return HttpResponse('Unknown table or format', status=404, content_type='text/plain')
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return HttpResponse('since must be an integer', status=400, content_type='text/plain')
+    try:
+        chunks = gate_export.stream_batches(gate_export.TABLES[table], fmt, since)
+        # Start the export, so a missing pyarrow isn't a broken download
+        first = next(chunks)
+    except gate_export.ExportError as exc:
+        return HttpResponse(str(exc), status=HTTPStatus.NOT_IMPLEMENTED,
+                            content_type='text/plain')
+    filename = f'squaresdb-{table}-{since}.{gate_export.FORMATS[fmt]}'
+    return StreamingHttpResponse(
+        itertools.chain([first], chunks), content_type=ANALYTICS_CONTENT_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 ### (Online) Payments
@@ -977,7 +2109,7 @@ class BaseSubLineItemFormSet(forms.BaseInlineFormSet):
     def __init__(self, *args, **kwargs):
         self.periods = kwargs.pop('periods')
         super().__init__(*args, **kwargs)
-        self.price_matrix = build_price_matrix(None, self.periods)
+        self.price_matrix = gate_prices.price_matrix(None, self.periods)
         self.person_dict = None
 
     def clean(self, ):
@@ -992,9 +2124,7 @@ class BaseSubLineItemFormSet(forms.BaseInlineFormSet):
             person_names.remove("")
         except KeyError:
             pass
-        person_objs = member_models.Person.objects.filter(name__in=person_names)
-        person_objs = person_objs.select_related("fee_cat")
-        self.person_dict = {person.name:person for person in person_objs}
+        self.person_dict = member_search.find_people_by_name(person_names)
         for form in self.forms:
             if not form.cleaned_data:
                 continue
@@ -1002,16 +2132,18 @@ class BaseSubLineItemFormSet(forms.BaseInlineFormSet):
             ignore_warnings = form.cleaned_data.get("ignore_warnings")
             amount = form.cleaned_data.get("amount")
             person_obj = self.person_dict.get(person_name)
-            period_slug = form.cleaned_data["sub_period"].slug
-            period_name = form.cleaned_data["sub_period"].name
+            period = form.cleaned_data["sub_period"]
+            period_slug = period.slug
+            period_name = period.name
 
             if (not ignore_warnings) and person_name and (not person_obj):
                 form.add_error('subscriber_name',
                                ValidationError(self.TS_MEMBER_UNKNOWN,
                                                params=dict(name=person_name)))
 
-            if person_obj:
-                low, high, text = self.price_matrix[person_obj.fee_cat.slug]['prices'][period_slug]
+            price = gate_prices.price_for(person_obj.fee_cat, period) if person_obj else None
+            if price:
+                low, high, text = price
                 if (not ignore_warnings) and (amount < low or high < amount):
                     form.add_error('amount',
                                    ValidationError(self.TS_PRICE_RANGE,
@@ -1066,6 +2198,7 @@ class SubLineItemDesc(money_views.LineItemDescriptor):
         This should be called inside a reversion.create_revision.
         """
         subitems = gate_models.SubscriptionLineItem.objects.filter(transaction=txn)
+        subitems = subitems.select_related('person')
         notes = ''
         for subitem in subitems:
             if not subitem.person:
@@ -1074,13 +2207,16 @@ class SubLineItemDesc(money_views.LineItemDescriptor):
             txn.admin_notes += notes
             return False
         payment_type = gate_models.PaymentMethod(slug='credit')
-        for subitem in subitems:
-            payment = gate_models.SubscriptionPayment(person=subitem.person,
-                                                      at_dance=None,
-                                                      payment_type=payment_type,
-                                                      amount=subitem.amount,
-                                                      fee_cat=subitem.person.fee_cat,
-                                                      notes='', )
-            payment.save()
-            payment.periods.set([subitem.sub_period])
+        payments = gate_bulk.bulk_create_subs([
+            (gate_models.SubscriptionPayment(person=subitem.person,
+                                             at_dance=None,
+                                             payment_type=payment_type,
+                                             amount=subitem.amount,
+                                             fee_cat_id=subitem.person.fee_cat_id,
+                                             notes='', ), [subitem.sub_period_id])
+            for subitem in subitems
+        ])
+        refresh_pay_methods({subitem.person_id for subitem in subitems},
+                            period_ids={subitem.sub_period_id for subitem in subitems})
+        gate_cube.refresh_payment_cube(payment.time for payment in payments)
         return True
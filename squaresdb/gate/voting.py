@@ -0,0 +1,227 @@
+"""Voting membership, from precomputed attendance counts
+
+Voting members are decided by a VotingRule: as of some date, the window is
+the last `window` dances (skipping dances in window_skip_seasons), and
+people who attended at least `threshold` of the dances from the start of the
+window through the date are voting members. Only dances on `weekdays` count
+at all (so, say, a Saturday special doesn't).
+
+For each dance, VotingTally stores how many counted dances each person
+attended in the window ending at that dance. "Who is a voting member as of
+X" is then a single indexed query on the tallies for the last dance before X
+that has any (see voting_people), so a dance nobody has signed in to yet
+doesn't empty the list. Tallies are recomputed for the people and dances
+affected whenever attendees are written (see refresh_voting_tallies), and
+the rebuild_voting_tallies command recomputes all of them -- which is needed
+after editing dances or attendees in the admin, or changing the rule."""
+
+import bisect
+import calendar
+import collections
+import dataclasses
+import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, QuerySet, Subquery
+from django.utils import timezone
+
+import squaresdb.gate.models as gate_models
+import squaresdb.membership.models as member_models
+
+
+@dataclasses.dataclass(frozen=True)
+class VotingRule:
+    """Which dances count towards voting membership, and how many are needed"""
+    # Number of dances (not skipped by window_skip_seasons) in the window
+    window: int = 15
+    # Counted dances someone must attend in the window to vote
+    threshold: int = 8
+    # Dances on other days of the week (in local time; Monday is 0) don't count
+    weekdays: Tuple[int, ...] = (calendar.TUESDAY, )
+    # Periods with these seasons (the end of the period's slug, like
+    # "2019-summer") don't count towards the window, but attending still counts
+    window_skip_seasons: Tuple[str, ...] = ('summer', )
+
+    def counts(self, dance_time: datetime.datetime) -> bool:
+        """Whether attending a dance at dance_time counts at all"""
+        local = dance_time.astimezone(timezone.get_default_timezone())
+        return local.weekday() in self.weekdays
+
+    def in_window(self, dance_time: datetime.datetime, period_id: Optional[str]) -> bool:
+        """Whether a dance counts towards the length of the window"""
+        if not self.counts(dance_time):
+            return False
+        return not (period_id and period_id.endswith(
+            tuple('-' + season for season in self.window_skip_seasons)))
+
+
+def voting_rule() -> VotingRule:
+    """Return the rule, with any overrides from settings.GATE_VOTING_RULE"""
+    overrides = dict(getattr(settings, 'GATE_VOTING_RULE', {}))
+    for field in ('weekdays', 'window_skip_seasons'):
+        if field in overrides:
+            overrides[field] = tuple(overrides[field])
+    return VotingRule(**overrides)
+
+
+def _timeline_dances(rule: VotingRule, dance_ids: Optional[Iterable[int]]) -> List[tuple]:
+    """Load the dances whose windows might include any of dance_ids (or all)
+
+    That's every dance from the earliest of dance_ids on, and enough before
+    it to fill that dance's window, as (pk, time, period_id) in order. This
+    makes two queries, and reads about a window's worth of past dances
+    however long the history is."""
+    dances = gate_models.Dance.objects.order_by('time', 'pk').values_list(
+        'pk', 'time', 'period_id')
+    if dance_ids is None:
+        return list(dances)
+    first = gate_models.Dance.objects.filter(pk__in=list(dance_ids)).order_by('time')
+    later = list(dances.filter(time__gte=Subquery(first.values('time')[:1])))
+    if not later:
+        return []
+    earlier = []
+    num_window = 0
+    before = dances.filter(time__lt=later[0][1]).order_by('-time', '-pk')
+    for dance in before.iterator():
+        if num_window == rule.window:
+            break
+        earlier.append(dance)
+        if rule.in_window(dance[1], dance[2]):
+            num_window += 1
+    return list(reversed(earlier)) + later
+
+
+class _DanceTimeline:
+    """Dances in order (see _timeline_dances), with the window start for each
+
+    A window that would reach back before the first dance loaded starts at
+    the first dance loaded."""
+
+    def __init__(self, rule: VotingRule, dance_ids: Optional[Iterable[int]] = None):
+        self.dances = _timeline_dances(rule, dance_ids)
+        self.index = {pk: index for index, (pk, _time, _period) in enumerate(self.dances)}
+        self.counted = [rule.counts(time) for _pk, time, _period in self.dances]
+        # starts[i] is the index of the first dance in the window ending at i
+        self.starts: List[int] = []
+        window_indexes: List[int] = []
+        for index, (_pk, time, period_id) in enumerate(self.dances):
+            if rule.in_window(time, period_id):
+                window_indexes.append(index)
+            recent = window_indexes[-rule.window:]
+            self.starts.append(recent[0] if len(recent) == rule.window else 0)
+
+    def anchors(self, dance_ids: Optional[Iterable[int]]) -> Set[int]:
+        """Find the dances whose window includes any of dance_ids (or all)"""
+        if dance_ids is None:
+            return set(range(len(self.dances)))
+        anchors = set()
+        for dance_id in dance_ids:
+            if dance_id not in self.index:
+                continue
+            index = self.index[dance_id]
+            for anchor in range(index, len(self.dances)):
+                if self.starts[anchor] > index:
+                    break
+                anchors.add(anchor)
+        return anchors
+
+    def tallies(self, anchors: Set[int],
+                attended: Dict[int, List[int]]) -> List[gate_models.VotingTally]:
+        """Build tallies at anchors, given the sorted dance indexes people attended"""
+        tallies = []
+        for person_id, indexes in attended.items():
+            for anchor in anchors:
+                num = (bisect.bisect_right(indexes, anchor)
+                       - bisect.bisect_left(indexes, self.starts[anchor]))
+                if num:
+                    tallies.append(gate_models.VotingTally(dance_id=self.dances[anchor][0],
+                                                           person_id=person_id, num=num))
+        return tallies
+
+
+def refresh_voting_tallies(person_ids: Optional[Iterable[int]] = None,
+                           dance_ids: Optional[Iterable[int]] = None,
+                           rule: Optional[VotingRule] = None) -> int:
+    """Recompute VotingTally for people after their attendance at dances changed
+
+    person_ids and dance_ids default to everyone and every dance. Returns the
+    number of tally rows written. This uses a fixed number of queries, and
+    for a few dances, reads only the dances near them."""
+    if dance_ids is not None:
+        dance_ids = list(dance_ids)
+    timeline = _DanceTimeline(rule or voting_rule(), dance_ids)
+    anchors = timeline.anchors(dance_ids)
+    if not anchors:
+        return 0
+    first = min(timeline.starts[anchor] for anchor in anchors)
+    span = [timeline.dances[index][0] for index in range(first, max(anchors)+1)
+            if timeline.counted[index]]
+
+    # Indexes of the counted dances each person attended
+    attendees = gate_models.Attendee.objects.filter(dance__in=span)
+    if person_ids is not None:
+        person_ids = list(person_ids)
+        attendees = attendees.filter(person__in=person_ids)
+    attended: Dict[int, List[int]] = collections.defaultdict(list)
+    for person_id, dance_id in attendees.values_list('person_id', 'dance_id'):
+        attended[person_id].append(timeline.index[dance_id])
+    for indexes in attended.values():
+        indexes.sort()
+    tallies = timeline.tallies(anchors, attended)
+
+    # No savepoint: callers write attendees in the same transaction, and if
+    # this fails, so should they
+    with transaction.atomic(savepoint=False):
+        old = gate_models.VotingTally.objects.all()
+        if dance_ids is not None:
+            old = old.filter(dance__in=[timeline.dances[anchor][0] for anchor in anchors])
+        if person_ids is not None:
+            old = old.filter(person__in=person_ids)
+        old.delete()
+        gate_models.VotingTally.objects.bulk_create(tallies, batch_size=1000)
+    return len(tallies)
+
+
+def as_of_time(date: datetime.date) -> datetime.datetime:
+    """Find the end of date, in local time"""
+    end = datetime.datetime.combine(date, datetime.time.max)
+    return timezone.make_aware(end, timezone.get_default_timezone())
+
+
+def window_dances(as_of: datetime.datetime,
+                  rule: Optional[VotingRule] = None) -> List[gate_models.Dance]:
+    """Find the counted dances in the voting window as of a time, in order"""
+    rule = rule or voting_rule()
+    dances = gate_models.Dance.objects.filter(time__lte=as_of).order_by('-time', '-pk')
+    window: List[gate_models.Dance] = []
+    num_window = 0
+    for dance in dances.select_related('period').iterator():
+        if num_window == rule.window:
+            break
+        if rule.counts(dance.time):
+            window.append(dance)
+        if rule.in_window(dance.time, dance.period_id):
+            num_window += 1
+    return list(reversed(window))
+
+
+def voting_people(as_of: datetime.datetime) -> QuerySet[member_models.Person]:
+    """Find the voting members as of a time, in one query
+
+    Voting members must also have a member status. Their `voting_num` is the
+    number of counted dances they attended in the window. The window is the
+    one ending at the last dance with tallies: tallies are only written as
+    people sign in (or by rebuild_voting_tallies), so a later dance without
+    any -- made in the admin, cancelled, or tonight's before anyone arrives
+    -- would otherwise have no voters at all."""
+    rule = voting_rule()
+    tallied = gate_models.VotingTally.objects.filter(dance=OuterRef('pk'))
+    anchor = gate_models.Dance.objects.filter(Exists(tallied), time__lte=as_of)
+    anchor = anchor.order_by('-time', '-pk')
+    people = member_models.Person.objects.filter(
+        status__member=True,
+        votingtally__dance=Subquery(anchor.values('pk')[:1]),
+        votingtally__num__gte=rule.threshold)
+    return people.annotate(voting_num=F('votingtally__num'))
@@ -1,11 +1,14 @@
 from django.contrib import admin
+from django.db.models import Q
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils.html import format_html
+from django.utils.text import smart_split, unescape_string_literal
 
 from reversion.admin import VersionAdmin
 
 import squaresdb.membership.models as member_models
+import squaresdb.membership.search as member_search
 
 @admin.register(member_models.SquareLevel)
 class SquareLevelAdmin(VersionAdmin):
@@ -97,6 +100,25 @@ class PersonAdmin(VersionAdmin):
         url = reverse('membership:person', args=[str(obj.id)])
         return format_html("<a href='{}'>View</a>", url)
 
+    # Most name matches (the best ones) for a search to list
+    name_search_limit = 500
+
+    def get_search_results(self, request, queryset, search_term):
+        """Search names with the search index, rather than scanning them
+
+        Emails are searched as usual (every word must be in the email), and
+        people matching either way are listed. Searches that look like email
+        addresses search the usual way."""
+        if not search_term.strip() or '@' in search_term:
+            return super().get_search_results(request, queryset, search_term)
+        matches = member_search.search_people(search_term, limit=self.name_search_limit)
+        emails = Q()
+        for word in smart_split(search_term):
+            if word.startswith(('"', "'")) and word[0] == word[-1]:
+                word = unescape_string_literal(word)
+            emails &= Q(email__icontains=word)
+        return queryset.filter(Q(pk__in=[person.pk for person in matches]) | emails), False
+
 @admin.register(member_models.PersonAuthLink)
 class PersonAuthLinkAdmin(VersionAdmin):
     list_display = [
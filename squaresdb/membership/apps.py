@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save
 
 
 class MembershipConfig(AppConfig):
     name = 'squaresdb.membership'
     default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        # pylint:disable=import-outside-toplevel
+        import squaresdb.membership.search as member_search
+        post_save.connect(member_search.person_saved, sender='membership.Person',
+                          dispatch_uid='membership_person_search')
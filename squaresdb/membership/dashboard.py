@@ -0,0 +1,101 @@
+"""Everything the person self-service page shows about someone
+
+person_dashboard loads a person's details, classes, recent subscriptions,
+recent attendance (and how they paid), and mailing lists in a fixed number
+of queries (DASHBOARD_QUERIES), however long their history is."""
+
+import dataclasses
+import datetime
+from typing import Dict, List
+
+from django.db.models import Exists, OuterRef, prefetch_related_objects
+from django.utils import timezone
+
+import squaresdb.gate.attendance as gate_attendance
+import squaresdb.gate.models as gate_models
+import squaresdb.mailinglist.models as mail_models
+import squaresdb.membership.models as member_models
+
+# Queries person_dashboard makes
+DASHBOARD_QUERIES = 11
+
+# Subscriptions to list
+RECENT_SUBS = 8
+
+# How far back to list attendance
+RECENT_ATTENDANCE = datetime.timedelta(weeks=26)
+
+
+@dataclasses.dataclass
+class PersonDashboard:
+    """A person's details and history, for their self-service page"""
+    # With their status, MIT affiliation, and fee category
+    person: member_models.Person
+    classes_taken: List[member_models.TSClass]
+    classes_coordinated: List[member_models.TSClass]
+    classes_assisted: List[member_models.TSClass]
+    # Periods of their recent subscriptions, latest first
+    sub_periods: List[gate_models.SubscriptionPeriod]
+    # Recent dances they attended, latest first, as dicts of dance and paid
+    attendees: List[Dict]
+    # All mailing lists, with is_member set
+    mail_lists: List[mail_models.MailingList]
+
+
+def _attendees(person: member_models.Person) -> List[Dict]:
+    """Find the person's recent attendance, and how they paid (four queries)"""
+    dance_cutoff = timezone.now() - RECENT_ATTENDANCE
+    dances = list(gate_models.Dance.objects.filter(time__gte=dance_cutoff)
+                  .select_related('price_scheme', 'period').order_by('-time'))
+    people = member_models.Person.objects.filter(pk=person.pk)
+    matrix = gate_attendance.AttendanceMatrix(dances).load(people)
+
+    attendees = []
+    for dance in dances:
+        if not matrix.is_present(person.pk, dance.pk):
+            continue
+        if person.fee_cat_id in gate_models.FREE_FEE_CATS:
+            paid = 'MIT student'
+        elif dance.price_scheme.name == 'free':
+            paid = 'free dance'
+        elif matrix.is_paid(person.pk, dance.pk):
+            paid = 'paid at dance'
+        elif matrix.is_covered(person.pk, dance.pk):
+            paid = 'subscription'
+        else:
+            paid = 'not paid'
+        attendees.append(dict(dance=dance, paid=paid))
+    return attendees
+
+
+def _sub_periods(person: member_models.Person) -> List[gate_models.SubscriptionPeriod]:
+    """Find the periods of the person's recent subscriptions (two queries)"""
+    subs = list(gate_models.SubscriptionPayment.objects.filter(person=person)
+                .order_by('-time')[:RECENT_SUBS])
+    prefetch_related_objects(subs, 'periods')
+    return sorted([period for sub in subs for period in sub.periods.all()],
+                  key=lambda period: period.start_date, reverse=True)
+
+
+def _mail_lists(person: member_models.Person) -> List[mail_models.MailingList]:
+    """Find every mailing list, and whether the person is on it (one query)"""
+    members = mail_models.ListMember.objects.filter(mail_list=OuterRef('pk'), email=person.email)
+    return list(mail_models.MailingList.objects.select_related('category')
+                .annotate(is_member=Exists(members)).order_by('category__order', 'order'))
+
+
+def person_dashboard(person: member_models.Person) -> PersonDashboard:
+    """Load what the self-service page shows about person"""
+    person = member_models.Person.objects.select_related(
+        'status', 'mit_affil', 'fee_cat').get(pk=person.pk)
+    return PersonDashboard(
+        person=person,
+        classes_taken=list(member_models.TSClass.objects.filter(tsclassmember__student=person)
+                           .order_by('start_date')),
+        classes_coordinated=list(person.class_coord.order_by('start_date')),
+        classes_assisted=list(member_models.TSClass.objects.filter(
+            tsclassassist__assistant=person).order_by('start_date')),
+        sub_periods=_sub_periods(person),
+        attendees=_attendees(person),
+        mail_lists=_mail_lists(person),
+    )
@@ -0,0 +1,105 @@
+"""A person's full attendance and payment history, a page at a time
+
+Pages are found by keyset ("seek") pagination: each page ends with a cursor
+of the (time, id) of its last row, and the next page is the rows before
+that, newest first. Unlike OFFSET, that doesn't read and discard the pages
+before it.
+
+Payments are sought on the (person, time) index, so a page of them reads
+only the rows on it. Attendance is ordered by the dance's time, which the
+(person, dance) index on Attendee doesn't cover: it finds the person's
+rows, and the database sorts those by joined dance time for each page.
+That's one person's attendance (a few hundred rows, even over decades),
+not the whole table."""
+
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+
+import squaresdb.gate.models as gate_models
+import squaresdb.membership.models as member_models
+
+# Rows per page, by default and at most
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+Cursor = Tuple[datetime.datetime, int]
+
+
+def format_cursor(time: datetime.datetime, pk: int) -> str:
+    return f"{time.isoformat()},{pk}"
+
+
+def parse_cursor(cursor: str) -> Cursor:
+    """Parse a cursor from format_cursor, raising ValueError if it's bad"""
+    time_str, _comma, pk_str = cursor.rpartition(',')
+    time = parse_datetime(time_str)
+    if time is None:
+        raise ValueError(f"bad cursor {cursor!r}")
+    return time, int(pk_str)
+
+
+def _page(rows: QuerySet, time_field: str, cursor: Optional[Cursor],
+          limit: int) -> Tuple[List, bool]:
+    """Find the rows before cursor, newest first, and if there are more"""
+    rows = rows.order_by('-'+time_field, '-pk')
+    if cursor:
+        time, pk = cursor
+        rows = rows.filter(Q(**{time_field+'__lt': time}) | Q(**{time_field: time, 'pk__lt': pk}))
+    # One extra, to see if there's another page
+    page = list(rows[:limit+1])
+    return page[:limit], len(page) > limit
+
+
+def attendance_page(person: member_models.Person, cursor: Optional[Cursor] = None,
+                    limit: int = PAGE_SIZE) -> Tuple[List[Dict], Optional[str]]:
+    """Find a page of the dances person attended, latest dance first
+
+    Returns the page's rows (as JSON-able dicts) and the next page's cursor
+    (or None if this is the last page). This makes one query, which sorts
+    all of person's attendance (see the module docstring)."""
+    attendees = gate_models.Attendee.objects.filter(person=person).select_related('dance')
+    page, more = _page(attendees, 'dance__time', cursor, limit)
+    next_cursor = format_cursor(page[-1].dance.time, page[-1].pk) if more else None
+    return [dict(
+        id=attendee.pk,
+        dance=attendee.dance_id,
+        dance_time=attendee.dance.time,
+        period=attendee.dance.period_id,
+        pay_method=attendee.pay_method,
+        paid=attendee.get_pay_method_display(),
+        fee_cat=attendee.fee_cat_id,
+    ) for attendee in page], next_cursor
+
+
+def payment_page(person: member_models.Person, cursor: Optional[Cursor] = None,
+                 limit: int = PAGE_SIZE) -> Tuple[List[Dict], Optional[str]]:
+    """Find a page of person's payments, latest first
+
+    Returns the page's rows (as JSON-able dicts) and the next page's cursor
+    (or None if this is the last page). This makes two queries."""
+    payments = gate_models.Payment.objects.filter(person=person).select_related(
+        'dancepayment__for_dance', 'subscriptionpayment').prefetch_related(
+            'subscriptionpayment__periods')
+    page, more = _page(payments, 'time', cursor, limit)
+    next_cursor = format_cursor(page[-1].time, page[-1].pk) if more else None
+    rows = []
+    for payment in page:
+        row = dict(id=payment.pk, time=payment.time, amount=payment.amount,
+                   payment_type=payment.payment_type_id, fee_cat=payment.fee_cat_id)
+        if hasattr(payment, 'dancepayment'):
+            row.update(paid_for='dance', for_dance=payment.dancepayment.for_dance_id,
+                       for_dance_time=payment.dancepayment.for_dance.time)
+        elif hasattr(payment, 'subscriptionpayment'):
+            row.update(paid_for='sub', periods=sorted(
+                period.pk for period in payment.subscriptionpayment.periods.all()))
+        rows.append(row)
+    return rows, next_cursor
+
+
+PAGES = {
+    'attendance': attendance_page,
+    'payments': payment_page,
+}
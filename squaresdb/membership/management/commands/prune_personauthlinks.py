@@ -0,0 +1,38 @@
+import contextlib
+import datetime
+
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from squaresdb.membership.models import PersonAuthLink
+
+
+class Command(BaseCommand):
+    help = 'Deletes PersonAuthLinks that expired a while ago'
+
+    def add_arguments(self, parser):
+        # Expired links still let people ask for a new one, so keep them a while
+        parser.add_argument('--days', type=int, default=90,
+                            help='Delete links that expired more than this many days ago')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of links to delete per query')
+        parser.add_argument('--archive', metavar='FILE',
+                            help='Append the deleted links to FILE (as JSON lines) first')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        expired = PersonAuthLink.objects.filter(expire_time__lt=cutoff).order_by('expire_time')
+        archive_path = options['archive']
+        num_deleted = 0
+        with (open(archive_path, 'a', encoding='utf-8') if archive_path
+              else contextlib.nullcontext()) as archive:
+            while pks := list(expired.values_list('pk', flat=True)[:options['batch_size']]):
+                links = PersonAuthLink.objects.filter(pk__in=pks)
+                if archive:
+                    serializers.serialize('jsonl', links, stream=archive)
+                    archive.flush()
+                num_deleted += links.delete()[0]
+
+        msg = 'Deleted %d links that expired before %s' % (num_deleted, cutoff)
+        self.stdout.write(self.style.SUCCESS(msg))
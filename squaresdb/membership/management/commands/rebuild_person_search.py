@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from squaresdb.membership.models import Person, PersonSearchTerm
+from squaresdb.membership.search import index_people
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the index for searching people by name'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            # Also drops terms for people who no longer exist (which the
+            # foreign key should prevent, but this is the repair tool)
+            PersonSearchTerm.objects.all().delete()
+            last_pk = 0
+            num_people = 0
+            while True:
+                people = list(Person.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+                if not people:
+                    break
+                index_people(people)
+                last_pk = people[-1].pk
+                num_people += len(people)
+
+        msg = 'Indexed %d people (%d search terms)' % (num_people,
+                                                       PersonSearchTerm.objects.count())
+        self.stdout.write(self.style.SUCCESS(msg))
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:30
+
+import re
+import unicodedata
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# A frozen copy of squaresdb.membership.search's tokenizer, as of this
+# migration, so later changes to it (or the model) don't change what this does
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _NON_ALNUM.sub(' ', text.lower()).strip()
+
+def search_terms(name):
+    words = normalize(name).split()
+    tokens = list(dict.fromkeys(words + [first + second
+                                         for first, second in zip(words, words[1:])]))
+    trigrams = set()
+    for token in tokens:
+        trigrams.update(token[i:i+3] for i in range(len(token) - 2))
+    terms = [('name', normalize(name))]
+    terms += [('token', token) for token in tokens]
+    terms += [('trigram', trigram) for trigram in sorted(trigrams)]
+    return list(dict.fromkeys((kind, term[:100]) for kind, term in terms))
+
+def index_people(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+
+    person_model = apps.get_model('membership', 'Person')
+    term_model = apps.get_model('membership', 'PersonSearchTerm')
+    term_model.objects.using(db_alias).bulk_create([
+        term_model(person_id=person_id, kind=kind, term=term)
+        for person_id, name in person_model.objects.using(db_alias).values_list('pk', 'name')
+        for kind, term in search_terms(name)
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0010_autofield'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PersonSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('name', 'Name'), ('token', 'Token'), ('trigram', 'Trigram')], max_length=7)),
+                ('term', models.CharField(max_length=100)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='membership.person')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'term', 'person'], name='person_search_term')],
+            },
+        ),
+        migrations.RunPython(index_people, migrations.RunPython.noop),
+    ]
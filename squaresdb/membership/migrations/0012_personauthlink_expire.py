@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0011_personsearchterm'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='personauthlink',
+            index=models.Index(fields=['expire_time'], name='personauthlink_expire'),
+        ),
+    ]
@@ -120,6 +120,28 @@ class Person(models.Model):
         verbose_name_plural = "people"
 
 
+class PersonSearchTerm(models.Model):
+    """Index for searching people by name (see squaresdb.membership.search)"""
+
+    class Kind(models.TextChoices): # pylint:disable=too-many-ancestors
+        NAME = 'name'       # the whole normalized name
+        TOKEN = 'token'     # a word (or adjacent words joined)
+        TRIGRAM = 'trigram' # three characters from some token
+
+    person = models.ForeignKey(Person, on_delete=models.CASCADE, related_name='search_terms')
+    kind = models.CharField(max_length=7, choices=Kind)
+    term = models.CharField(max_length=100)
+
+    class Meta:
+        indexes = [
+            # Includes person, so searches only need to read the index
+            models.Index(fields=['kind', 'term', 'person'], name='person_search_term'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.term} for {self.person_id}"
+
+
 @reversion.register
 class PersonComment(models.Model):
     author = models.ForeignKey(get_user_model(), on_delete=models.PROTECT,
@@ -195,7 +217,8 @@ class PersonAuthLink(models.Model):
         call send_new_auth_link to generate a replacement.
         """
         try:
-            link = cls.objects.get(secret=secret)
+            # The state hash needs the person, so fetch them together
+            link = cls.objects.select_related('person').get(secret=secret)
             # Got an object, so the secret matches. Now we just need to check
             # the other restrictions.
             if not link.verify_state_hash():
@@ -227,6 +250,10 @@ class PersonAuthLink(models.Model):
         permissions = (
             ("bulk_create_personauthlink", "Can bulk create PersonAuthLinks"),
         )
+        indexes = [
+            # For prune_personauthlinks
+            models.Index(fields=['expire_time'], name='personauthlink_expire'),
+        ]
 
 
 @reversion.register
@@ -0,0 +1,197 @@
+"""Searching people by name
+
+Names are normalized and split into tokens and trigrams here. Those are
+stored in the PersonSearchTerm table, which is kept in sync with Person
+saves (see MembershipConfig.ready), rebuilt by the rebuild_person_search
+command (eg, after a bulk update), and searched by search_people. They
+also make up the signin page's roster search index. The normalization in
+that page's JavaScript (normalizeSearch in gate/signin.html) matches
+normalize, so the two must be changed together.
+
+The table is plain rows with a B-tree index, rather than a database's own
+full-text search, so it works the same on SQLite and MySQL."""
+
+import collections
+import difflib
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from django.db.models import Count, QuerySet
+
+import squaresdb.membership.models as member_models
+
+Kind = member_models.PersonSearchTerm.Kind
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text: str) -> str:
+    """Strip accents, lowercase, and turn everything else into single spaces"""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _NON_ALNUM.sub(' ', text.lower()).strip()
+
+
+def name_tokens(name: str) -> List[str]:
+    """Split a name into search tokens, without duplicates
+
+    Every word is a token, including nicknames (which are usually in quotes
+    or parentheses, and so separate words). Adjacent words are also joined,
+    so "Mary Ann" and "Van der Berg" match "maryann" and "vanderberg"."""
+    words = normalize(name).split()
+    tokens = words + [first + second for first, second in zip(words, words[1:])]
+    return list(dict.fromkeys(tokens))
+
+
+def trigrams(token: str) -> Set[str]:
+    """Find the three-character substrings of a token"""
+    return {token[i:i+3] for i in range(len(token) - 2)}
+
+
+def search_terms(name: str) -> List[Tuple[str, str]]:
+    """Find the (kind, term) pairs to index for a name"""
+    max_length = member_models.PersonSearchTerm._meta.get_field('term').max_length
+    tokens = name_tokens(name)
+    terms = [(Kind.NAME, normalize(name))]
+    terms += [(Kind.TOKEN, token) for token in tokens]
+    terms += [(Kind.TRIGRAM, trigram)
+              for trigram in sorted(set().union(*map(trigrams, tokens)))]
+    return list(dict.fromkeys((kind, term[:max_length]) for kind, term in terms))
+
+
+def index_people(people: Iterable[member_models.Person]):
+    """(Re)build the search terms for some people"""
+    people = list(people)
+    member_models.PersonSearchTerm.objects.filter(person__in=people).delete()
+    member_models.PersonSearchTerm.objects.bulk_create([
+        member_models.PersonSearchTerm(person=person, kind=kind, term=term)
+        for person in people for kind, term in search_terms(person.name)
+    ], batch_size=1000)
+
+
+def person_saved(instance, update_fields=None, **kwargs): # pylint:disable=unused-argument
+    """Signal receiver to keep the search terms up to date"""
+    if update_fields is None or 'name' in update_fields:
+        index_people([instance])
+
+
+# Most words of a query to consider
+MAX_QUERY_TERMS = 5
+
+def _term_scores(term: str) -> Dict[int, int]:
+    """Find the people matching one search term, by pk
+
+    Scores are 0 if term is a whole word of their name, 1 if it starts a
+    word, and 2 if it's inside one (only checked for terms of 3+ letters)."""
+    search = member_models.PersonSearchTerm.objects
+    scores: Dict[int, int] = {}
+    # Tokens are [0-9a-z]+, and '{' sorts after 'z', so this range is the
+    # tokens starting with term -- and, unlike LIKE, it can use the index
+    words = search.filter(kind=Kind.TOKEN, term__gte=term, term__lt=term+'{')
+    for person_id, token in words.values_list('person_id', 'term'):
+        score = 0 if token == term else 1
+        scores[person_id] = min(score, scores.get(person_id, score))
+    if len(term) >= 3:
+        term_trigrams = trigrams(term)
+        # People with every trigram of term are candidates
+        have_trigrams = search.filter(kind=Kind.TRIGRAM, term__in=term_trigrams).values('person')
+        candidates = have_trigrams.annotate(num=Count('pk')).filter(num=len(term_trigrams))
+        tokens = search.filter(kind=Kind.TOKEN, person__in=candidates.values('person'))
+        for person_id, token in tokens.values_list('person_id', 'term'):
+            if person_id not in scores and term in token:
+                scores[person_id] = 2
+    return scores
+
+
+def search_people(query: str, limit: Optional[int] = 10,
+                  people: Optional[QuerySet[member_models.Person]] = None,
+                  ) -> List[member_models.Person]:
+    """Find people whose names match every word of query, best first
+
+    Each word may match anywhere in the name (see _term_scores), and better
+    matches rank first. Ties go to more frequent attendees, and then by name.
+    Pass people to search within a subset of people."""
+    total: Optional[Dict[int, int]] = None
+    for term in normalize(query).split()[:MAX_QUERY_TERMS]:
+        scores = _term_scores(term)
+        if total is None:
+            total = scores
+        else:
+            total = {pk: score + scores[pk] for pk, score in total.items() if pk in scores}
+        if not total:
+            return []
+    if total is None:
+        return []
+
+    if people is None:
+        people = member_models.Person.objects.all()
+    matches = list(people.filter(pk__in=total).select_related('frequency', 'fee_cat'))
+    matches.sort(key=lambda person: (total[person.pk], person.frequency.order, person.name))
+    return matches[:limit]
+
+
+def find_people_by_name(names: Iterable[str]) -> Dict[str, member_models.Person]:
+    """Look up people by name, ignoring case, accents, and punctuation
+
+    Returns a dict mapping each name that was found to the person. A name
+    matches if exactly one person has it exactly, or else if exactly one
+    person has the same normalized name. Names that several people share
+    are left out, like names nobody has, so the caller asks rather than
+    guessing."""
+    names = set(names)
+    exact = member_models.Person.objects.filter(name__in=names).select_related('fee_cat')
+    exact_people = collections.defaultdict(list)
+    for person in exact:
+        exact_people[person.name].append(person)
+    found = {name: people[0] for name, people in exact_people.items() if len(people) == 1}
+
+    missing = collections.defaultdict(list)
+    for name in names - set(exact_people):
+        missing[normalize(name)].append(name)
+    rows = member_models.PersonSearchTerm.objects.filter(kind=Kind.NAME, term__in=missing)
+    normalized = collections.defaultdict(list)
+    for row in rows.select_related('person__fee_cat'):
+        normalized[row.term].append(row.person)
+    for term, people in normalized.items():
+        if len(people) == 1:
+            for name in missing[term]:
+                found[name] = people[0]
+    return found
+
+
+def _token_sort(normalized: str) -> str:
+    return ' '.join(sorted(normalized.split()))
+
+
+# Least similarity (from 0 to 1) for suggest_people to suggest someone
+SUGGEST_CUTOFF = 0.75
+
+def suggest_people(names: Iterable[str], limit: int = 3,
+                   cutoff: float = SUGGEST_CUTOFF) -> Dict[str, List[member_models.Person]]:
+    """Suggest people for names that find_people_by_name couldn't find
+
+    Names are compared with their words sorted (so "Smith Bob" is as close to
+    "Bob Smith" as can be), by difflib similarity, against everyone's normalized name.
+    Returns a dict mapping each name with suggestions to up to limit
+    people, most similar first. This makes two queries, however many names
+    there are."""
+    keys = {name: _token_sort(normalize(name)) for name in names}
+    if not keys:
+        return {}
+    rows = member_models.PersonSearchTerm.objects.filter(kind=Kind.NAME)
+    roster = collections.defaultdict(list)
+    for person_id, term in rows.values_list('person_id', 'term'):
+        roster[_token_sort(term)].append(person_id)
+
+    suggested: Dict[str, List[int]] = {}
+    for name, key in keys.items():
+        close = difflib.get_close_matches(key, roster, n=limit, cutoff=cutoff)
+        person_ids = [person_id for match in close for person_id in roster[match]]
+        if person_ids:
+            suggested[name] = person_ids[:limit]
+    people = member_models.Person.objects.filter(
+        pk__in={pk for person_ids in suggested.values() for pk in person_ids})
+    people_by_pk = people.select_related('fee_cat').in_bulk()
+    return {name: [people_by_pk[pk] for pk in person_ids]
+            for name, person_ids in suggested.items()}
@@ -1,9 +1,26 @@
+import datetime
+import io
+import json
 import logging
+import os
+import tempfile
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.contrib.auth.models import Permission
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
 
+import squaresdb.gate.models as gate_models
+import squaresdb.mailinglist.models as mail_models
+import squaresdb.membership.dashboard as member_dashboard
 import squaresdb.membership.models as member_models
+import squaresdb.membership.search as member_search
+import squaresdb.outbox.models as outbox_models
+import squaresdb.outbox.send as outbox_send
 
 logger = logging.getLogger(__name__)
 
@@ -32,8 +49,268 @@ class PersonAuthLinkTestCase(TestCase):
             creator=creator,
         )
         link.save()
-        valid, obj = member_models.PersonAuthLink.get_link(link.secret, None)
+        # One query, for the link and person both
+        with self.assertNumQueries(1):
+            valid, obj = member_models.PersonAuthLink.get_link(link.secret, None)
+            self.assertEqual(obj.person.name, "John Doe")
         self.assertTrue(valid)
         valid, obj = member_models.PersonAuthLink.get_link("asdf", None)
         self.assertFalse(valid)
         self.assertEqual(obj, None)
+
+    def test_prune(self):
+        now = timezone.now()
+        links = {}
+        for days in (1, 89, 91, 365, 400):
+            link = member_models.PersonAuthLink.create_auth_link(
+                self.person, reason="testing", detail=f"{days} days",
+                creator=get_user_model().objects.get(username="importer@SYSTEM"))
+            link.expire_time = now - datetime.timedelta(days=days)
+            link.save()
+            links[days] = link
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = os.path.join(tmpdir, 'links.jsonl')
+            out = io.StringIO()
+            call_command('prune_personauthlinks', '--batch-size=2', f'--archive={archive}',
+                         stdout=out)
+            self.assertIn('Deleted 3 links', out.getvalue())
+            with open(archive, encoding='utf-8') as archive_file:
+                archived = [json.loads(line) for line in archive_file]
+        self.assertEqual(sorted(row['pk'] for row in archived),
+                         sorted(links[days].pk for days in (91, 365, 400)))
+        self.assertEqual({row['fields']['create_reason_detail'] for row in archived},
+                         {'91 days', '365 days', '400 days'})
+        remaining = member_models.PersonAuthLink.objects.values_list('pk', flat=True)
+        self.assertEqual(sorted(remaining), [links[1].pk, links[89].pk])
+
+    def test_bulk_create(self):
+        user = get_user_model().objects.create_user(username='user', password='pass')
+        user.user_permissions.add(Permission.objects.get(codename='bulk_create_personauthlink'))
+        client = Client()
+        client.force_login(user)
+        path = reverse('membership:personauthlink-bulkcreate')
+        no_email = make_person("No Email")
+        no_email.email = ''
+        no_email.save()
+
+        def mail_merge(people):
+            data = dict(reason='testing', expire_in=60*24, subject='Hi',
+                        template='Hi %(person_name)s (%(person_level)s): %(link)s',
+                        people=[person.pk for person in people])
+            with CaptureQueriesContext(connection) as queries:
+                response = client.post(path, data)
+            self.assertEqual(response.status_code, 200)
+            return response, len(queries)
+
+        people = [self.person, no_email] + [make_person(f"Person {i}") for i in range(2)]
+        response, _num_queries = mail_merge(people)
+        self.assertContains(response, "Mail merged 3 messages")
+        self.assertContains(response, "0 of 3 sent, 3 waiting")
+        batch = response.context['batch']
+        email = batch.emails.get(body__startswith='Hi John Doe')
+        link = member_models.PersonAuthLink.objects.get(person=self.person)
+        self.assertEqual(email.body, 'Hi John Doe (Unknown): http://testserver%s'
+                         % (reverse('membership:person-link', args=[link.secret]), ))
+        self.assertTrue(member_models.PersonAuthLink.get_link(link.secret, None)[0])
+        self.assertFalse(member_models.PersonAuthLink.objects.filter(person=no_email))
+
+        # The same queries, however many people there are (once caches,
+        # like reversion's content types, are warm)
+        num_queries = mail_merge(people)[1]
+        people += [make_person(f"More {i}") for i in range(5)]
+        self.assertEqual(mail_merge(people)[1], num_queries)
+        self.assertEqual(outbox_models.OutgoingEmail.objects.count(), 3+3+8)
+
+        outbox_send.send_queued()
+        response = client.get(path, dict(batch=batch.pk))
+        self.assertContains(response, "3 of 3 sent.")
+        self.assertEqual(client.get(path, dict(batch='abc')).status_code, 404)
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.bob = make_person('Robert "Bob" Smith')
+        self.bobby = make_person('Bobby Jones')
+        self.jose = make_person('José Smithers')
+
+    def test_search_people(self):
+        def search(query):
+            return [person.name for person in member_search.search_people(query)]
+        # Whole words, then prefixes, then matches inside words
+        self.assertEqual(search('bob'), ['Robert "Bob" Smith', 'Bobby Jones'])
+        self.assertEqual(search('smith'), ['Robert "Bob" Smith', 'José Smithers'])
+        self.assertEqual(search('mither'), ['José Smithers'])
+        self.assertEqual(search('smith jose'), ['José Smithers'])
+        self.assertEqual(search('jo'), ['Bobby Jones', 'José Smithers'])
+        self.assertEqual(search(''), [])
+        self.assertEqual(search('nobody'), [])
+
+        # The index follows changes to names
+        self.bobby.name = 'Roberta Jones'
+        self.bobby.save()
+        self.assertEqual(search('bob'), ['Robert "Bob" Smith'])
+        self.assertEqual(search('berta'), ['Roberta Jones'])
+
+    def test_find_people_by_name(self):
+        found = member_search.find_people_by_name(['Bobby Jones', 'jose smithers', 'Nobody'])
+        self.assertEqual(found, {'Bobby Jones': self.bobby, 'jose smithers': self.jose})
+
+        # Names that several people have aren't found, even exactly
+        make_person('Bobby Jones')
+        found = member_search.find_people_by_name(['Bobby Jones', 'bobby jones'])
+        self.assertEqual(found, {})
+
+    def test_suggest_people(self):
+        suggestions = member_search.suggest_people(['Smith Bob Robert', 'Bobbie Jones',
+                                                    'Jose Smithers', 'Nobody'])
+        self.assertEqual(suggestions, {'Smith Bob Robert': [self.bob],
+                                       'Bobbie Jones': [self.bobby],
+                                       'Jose Smithers': [self.jose]})
+        self.assertEqual(member_search.suggest_people([]), {})
+
+    def test_person_search_view(self):
+        user = get_user_model().objects.create_user(username='user', password='pass')
+        user.user_permissions.add(Permission.objects.get(codename='view_person'))
+        client = Client()
+        client.force_login(user)
+        response = client.get(reverse('membership:person-search'), dict(q='smith', limit=1))
+        self.assertEqual([result['name'] for result in response.json()['results']],
+                         ['Robert "Bob" Smith'])
+
+    def test_admin_search(self):
+        user = get_user_model().objects.create_superuser(username='admin', password='pass')
+        client = Client()
+        client.force_login(user)
+        self.jose.email = 'jsmith@example.com'
+        self.jose.save()
+        path = reverse('admin:membership_person_changelist')
+        def search(query):
+            response = client.get(path, dict(q=query))
+            return sorted(person.name for person in response.context['cl'].result_list)
+        self.assertEqual(search('bob'), ['Bobby Jones', 'Robert "Bob" Smith'])
+        # Emails still match, alongside names
+        self.assertEqual(search('jsmith'), ['José Smithers'])
+        self.assertEqual(search('testing'), ['Bobby Jones', 'Robert "Bob" Smith'])
+        self.assertEqual(search('@example.com'), ['José Smithers'])
+
+    def test_name_tokens(self):
+        self.assertEqual(member_search.normalize(" Zoë  O'Brien-Smith "), 'zoe o brien smith')
+        self.assertEqual(member_search.name_tokens('Robert "Bob" van Dyke'),
+                         ['robert', 'bob', 'van', 'dyke', 'robertbob', 'bobvan', 'vandyke'])
+        self.assertEqual(member_search.trigrams('bob'), {'bob'})
+        self.assertEqual(member_search.trigrams('bo'), set())
+
+
+class DashboardTestCase(TestCase):
+    fixtures = ['people.json', 'sample.json', 'squares.json', ]
+
+    def setUp(self):
+        self.person = make_person("John Doe")
+        self.period = gate_models.SubscriptionPeriod.objects.get(slug='2019-spring')
+        self.scheme = gate_models.DancePriceScheme.objects.first()
+        self.creator = get_user_model().objects.get(username="importer@SYSTEM")
+
+    def add_history(self, num):
+        """Give the person num more classes, subscriptions, and dances"""
+        now = timezone.now()
+        start = gate_models.Dance.objects.filter(time__gte=now - datetime.timedelta(weeks=26))
+        start = start.count()
+        for i in range(num):
+            clas = member_models.TSClass.objects.create(label=f"Class {start+i}",
+                                                        coordinator=self.person)
+            member_models.TSClassMember.objects.create(student=self.person, clas=clas, pe=False)
+            member_models.TSClassAssist.objects.create(assistant=self.person, clas=clas)
+            dance = gate_models.Dance.objects.create(
+                time=now - datetime.timedelta(days=start+i+1), period=self.period,
+                price_scheme=self.scheme)
+            gate_models.Attendee.objects.create(person=self.person, dance=dance)
+            sub = gate_models.SubscriptionPayment.objects.create(
+                person=self.person, payment_type_id='cash', amount=10)
+            sub.periods.add(self.period)
+        for mail_list in mail_models.MailingList.objects.all()[:num]:
+            mail_models.ListMember.objects.get_or_create(mail_list=mail_list,
+                                                         email=self.person.email)
+
+    def test_dashboard(self):
+        link = member_models.PersonAuthLink.create_auth_link(
+            self.person, reason="testing", detail="testing", creator=self.creator)
+        link.save()
+        path = reverse('membership:person-link', args=[link.secret])
+
+        def page_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = Client().get(path)
+            self.assertEqual(response.status_code, 200)
+            return response, len(queries)
+
+        self.add_history(1)
+        _response, num_queries = page_queries()
+        self.add_history(10)
+        with self.assertNumQueries(member_dashboard.DASHBOARD_QUERIES):
+            dashboard = member_dashboard.person_dashboard(self.person)
+        response, more_queries = page_queries()
+        self.assertEqual(more_queries, num_queries)
+
+        self.assertEqual(len(dashboard.classes_taken), 11)
+        self.assertEqual(len(dashboard.classes_coordinated), 11)
+        self.assertEqual(len(dashboard.classes_assisted), 11)
+        self.assertEqual(len(dashboard.sub_periods), member_dashboard.RECENT_SUBS)
+        self.assertEqual(len(dashboard.attendees), 11)
+        self.assertEqual({attendee['paid'] for attendee in dashboard.attendees}, {'subscription'})
+        members = [mail_list for mail_list in dashboard.mail_lists if mail_list.is_member]
+        self.assertTrue(members)
+        self.assertEqual(len(members), min(len(dashboard.mail_lists), 10))
+        self.assertContains(response, "<li>Class 10</li>", count=3)
+        self.assertContains(response, "(subscription)", count=11)
+
+    def test_history(self):
+        self.add_history(5)
+        # Some ties on time, to check paging breaks them by id
+        sub_time = timezone.now() - datetime.timedelta(days=400)
+        gate_models.SubscriptionPayment.objects.filter(person=self.person).update(time=sub_time)
+        user = get_user_model().objects.create_user(username='user', password='pass')
+        user.user_permissions.add(Permission.objects.get(codename='view_person'))
+        client = Client()
+        client.force_login(user)
+
+        def history(path, num_queries):
+            results = []
+            while path:
+                with self.assertNumQueries(num_queries):
+                    response = client.get(path)
+                self.assertEqual(response.status_code, 200)
+                results += response.json()['results']
+                path = response.json()['next']
+            return results
+
+        path = reverse('membership:person-history', args=[self.person.pk, 'attendance'])
+        # Session, user, and permissions (four), person, then the page
+        attendance = history(path + '?limit=2', 6)
+        attendees = gate_models.Attendee.objects.filter(person=self.person)
+        self.assertEqual([row['id'] for row in attendance],
+                         list(attendees.order_by('-dance__time').values_list('pk', flat=True)))
+        self.assertEqual(attendance[0]['paid'], 'Not paid')
+
+        path = reverse('membership:person-history', args=[self.person.pk, 'payments'])
+        payments = history(path + '?limit=2', 7)
+        subs = gate_models.SubscriptionPayment.objects.filter(person=self.person)
+        self.assertEqual([row['id'] for row in payments],
+                         list(subs.order_by('-id').values_list('pk', flat=True)))
+        self.assertEqual(payments[0]['periods'], ['2019-spring'])
+        self.assertEqual(payments[0]['paid_for'], 'sub')
+
+        response = client.get(path, dict(cursor='bogus'))
+        self.assertEqual(response.status_code, 400)
+        response = client.get(reverse('membership:person-history',
+                                      args=[self.person.pk, 'bogus']))
+        self.assertEqual(response.status_code, 404)
+
+        # Self-service, with a link
+        link = member_models.PersonAuthLink.create_auth_link(
+            self.person, reason="testing", detail="testing", creator=self.creator)
+        link.save()
+        path = reverse('membership:person-link-history', args=[link.secret, 'attendance'])
+        # The link (and person), then the page
+        self.assertEqual(history(path, 2), attendance)
+        path = reverse('membership:person-link-history', args=['bogus', 'attendance'])
+        self.assertEqual(Client().get(path).status_code, 403)
@@ -4,9 +4,13 @@ from squaresdb.membership import views
 
 membership_patterns = [ # pylint:disable=invalid-name
     path('person/<int:pk>/', views.view_person, name='person'),
+    path('person/<int:pk>/history/<slug:kind>/', views.person_history, name='person-history'),
+    path('person/search/', views.person_search, name='person-search'),
     path('person/edit/', views.edit_user_person, name='person-user-edit'),
     path('person/edit/<int:pk>/', views.edit_user_person, name='person-user-edit-id'),
     path('person/link/<slug:secret>/', views.edit_person_personauthlink, name='person-link'),
+    path('person/link/<slug:secret>/history/<slug:kind>/', views.person_link_history,
+         name='person-link-history'),
     path('link/bulk_create/', views.create_personauthlinks, name='personauthlink-bulkcreate'),
     path('class/', views.ClassList.as_view(), name='class-list'),
     path(r'class/<int:pk>/', views.ClassDetail.as_view(), name='class-detail'),
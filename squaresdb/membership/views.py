@@ -5,15 +5,19 @@ Views for Tech Squares DB membership functionality
 import csv
 import datetime
 import io
+import itertools
 import logging
 
 from django import forms
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.core import mail
+from django.db import transaction
 from django.db.models import Count
+from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils.http import urlencode
 from django.utils import timezone
 from django.views.generic import DetailView, ListView
 
@@ -21,10 +25,13 @@ from django_select2.forms import Select2Widget, Select2MultipleWidget
 import reversion
 from social_django.models import UserSocialAuth
 
-import squaresdb.gate.models as gate_models
-import squaresdb.gate.views as gate_views
-import squaresdb.mailinglist.models as mail_models
+import squaresdb.membership.dashboard as member_dashboard
+import squaresdb.membership.history as member_history
 import squaresdb.membership.models
+import squaresdb.membership.search as member_search
+import squaresdb.outbox.models as outbox_models
+import squaresdb.outbox.send as outbox_send
+import squaresdb.utils.bulk as utils_bulk
 mem_models = squaresdb.membership.models
 
 logger = logging.getLogger(__name__)
@@ -42,6 +49,71 @@ def view_person(request, pk):
     return render(request, 'membership/person_detail.html', dict(person=person))
 
 
+# Most results to return from person_search
+PERSON_SEARCH_MAX_LIMIT = 50
+
+@permission_required('membership.view_person')
+def person_search(request):
+    """Typeahead search for people by name, returning JSON
+
+    Parameters are `q`, the search, and optionally `limit` (default 10).
+    Results are ranked, best first (see member_search.search_people)."""
+    query = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('limit', 10)), PERSON_SEARCH_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse(dict(msg='limit must be an integer'), status=400)
+    people = member_search.search_people(query, limit=limit)
+    results = [
+        dict(id=person.pk, name=person.name, url=person.get_absolute_url(),
+             fee_cat=person.fee_cat.name, frequency=person.frequency.name)
+        for person in people
+    ]
+    return JsonResponse(dict(results=results))
+
+
+def _history_response(request, person, kind, path):
+    """Return a page of a person's history as JSON
+
+    kind is a key of member_history.PAGES. Parameters are `limit` and
+    `cursor` (from the previous page's `next`)."""
+    if kind not in member_history.PAGES:
+        return JsonResponse(dict(msg='unknown history %s' % (kind, )), status=404)
+    try:
+        limit = min(int(request.GET.get('limit', member_history.PAGE_SIZE)),
+                    member_history.MAX_PAGE_SIZE)
+        cursor = request.GET.get('cursor')
+        cursor = member_history.parse_cursor(cursor) if cursor else None
+    except ValueError:
+        return JsonResponse(dict(msg='limit must be an integer, and cursor from next'),
+                            status=400)
+    if limit < 1:
+        return JsonResponse(dict(msg='limit must be positive'), status=400)
+    results, next_cursor = member_history.PAGES[kind](person, cursor, limit)
+    next_url = None
+    if next_cursor:
+        next_url = path + '?' + urlencode(dict(cursor=next_cursor, limit=limit))
+    return JsonResponse(dict(results=results, next=next_url))
+
+
+@permission_required('membership.view_person')
+def person_history(request, pk, kind):
+    """A person's attendance or payment history, for officers"""
+    person = get_object_or_404(squaresdb.membership.models.Person, pk=pk)
+    path = reverse('membership:person-history', args=[pk, kind])
+    return _history_response(request, person, kind, path)
+
+
+def person_link_history(request, secret, kind):
+    """A person's attendance or payment history, with a PersonAuthLink"""
+    request_ip = request.META['REMOTE_ADDR']
+    valid, link = squaresdb.membership.models.PersonAuthLink.get_link(secret, request_ip)
+    if not valid:
+        return JsonResponse(dict(msg='link is invalid or expired'), status=403)
+    path = reverse('membership:person-link-history', args=[secret, kind])
+    return _history_response(request, link.person, kind, path)
+
+
 def format_date(date):
     """Format a possible date for end users"""
     if date:
@@ -128,40 +200,6 @@ Thanks,
 Tech Squares
 """
 
-def _edit_person_attendee(person, subs):
-    sub_ids = set()
-    for sub in subs:
-        sub_ids.update(per.slug for per in sub.periods.all())
-
-    # Attendance
-    anno_people = gate_views.AnnoPerson.objects.filter(pk=person.pk)
-    dance_cutoff = timezone.now() - datetime.timedelta(weeks=26)
-    dances = gate_models.Dance.objects.filter(time__gte=dance_cutoff)
-    dances = dances.select_related('price_scheme', 'period')
-    dances = dances.order_by('-time')
-    dance_ids = [dance.pk for dance in dances]
-    anno_people = gate_views.person_table_annotate_people(anno_people,
-                                                          dance_ids, sub_ids)
-    # Populate attendee list
-    anno_person = anno_people[0]
-    attendees = []
-    for dance in dances:
-        attendee = anno_person.attend.get(dance.pk)
-        if attendee:
-            attendees.append(attendee)
-            if person.fee_cat.slug == 'mit-student':
-                attendee.paid = 'MIT student'
-            elif attendee.dance.price_scheme.name == 'free':
-                attendee.paid = 'free dance'
-            elif dance.pk in anno_person.dance_pays:
-                attendee.paid = 'paid at dance'
-            elif attendee.dance.period and attendee.dance.period.slug in sub_ids:
-                attendee.paid = 'subscription'
-            else:
-                attendee.paid = 'not paid'
-
-    return attendees
-
 def _edit_person_form(request, person):
     initial = {}
     msg = None
@@ -183,7 +221,7 @@ def _edit_person_form(request, person):
             email = mail.EmailMessage(subject="Tech Squares MemberDB update",
                                       body=email_body,
                                       to=set([request_obj.email, old_email]))
-            mail.get_connection().send_messages([email])
+            outbox_send.queue_messages([email], reason='person update')
 
             # Actually save the object
             request_obj.save()
@@ -206,27 +244,11 @@ def edit_person_obj(request, person):
     # General info
     form, msg = _edit_person_form(request, person)
 
-    # Subscriptions and attendance
-    subs = gate_models.SubscriptionPayment.objects.filter(person=person)
-    subs = subs.order_by('-time')[:8]
-    sub_periods = sorted([per for sub in subs for per in sub.periods.all()],
-                         key=lambda per: per.start_date, reverse=True)
-    attendees = _edit_person_attendee(person, subs)
-
-    # Mailing lists
-    mail_lists = (mail_models.MailingList.objects.select_related('category')
-                             .order_by('category__order', 'order'))
-    member_objs = mail_models.ListMember.objects.filter(email=person.email)
-    member_lists = set(obj.mail_list_id for obj in member_objs)
-    for mail_list in mail_lists:
-        mail_list.is_member = mail_list.pk in member_lists
-
     context = dict(
         person=person,
         form=form,
-        mail_lists=mail_lists,
-        sub_periods=sub_periods,
-        attendees=attendees,
+        # Classes, subscriptions, attendance, and mailing lists
+        dashboard=member_dashboard.person_dashboard(person),
         msg=msg,
         pagename='person-edit',
     )
@@ -299,8 +321,7 @@ def resend_personauthlink(request, old_link):
     email_subj = "New link to update Tech Squares Membership DB"
     email = mail.EmailMessage(subject=email_subj, body=email_body,
                               to=[new_link.person.email])
-    connection = mail.get_connection()
-    connection.send_messages([email])
+    outbox_send.queue_messages([email], reason='resend auth link')
 
 
 def edit_person_personauthlink(request, secret):
@@ -332,6 +353,9 @@ def edit_person_personauthlink(request, secret):
             return render(request, 'membership/PersonAuthLink/unknown.html')
 
 
+# People to mail merge per chunk (of queries)
+MAIL_MERGE_CHUNK = 500
+
 class BulkPersonAuthLinkCreationForm(forms.Form):
     """Form to mail-merge out a bunch of PersonAuthLinks"""
     # Ideally, we'd use a Django template, but the security story there seems
@@ -384,58 +408,89 @@ Tech Squares
         self.fields['template'].widget.attrs['rows'] = 20
         self.fields['template'].widget.attrs['cols'] = 80
 
+    def _make_link(self, request, person, expire_time) -> mem_models.PersonAuthLink:
+        """Make (without saving) a link for person"""
+        link = mem_models.PersonAuthLink.create_auth_link(
+            person, reason='BulkPersonAuthLinkCreation',
+            detail=self.cleaned_data['reason'], creator=request.user,
+        )
+        link.expire_time = expire_time
+        link.create_ip = request.META['REMOTE_ADDR']
+        return link
+
+    def _message(self, person, link_url) -> mail.EmailMessage:
+        data = person_context_dict(person)
+        if link_url:
+            data['link'] = link_url
+        # TODO: Better error if no link was created but %(link)s or similar is used
+        email_body = self.cleaned_data['template'] % data
+        emails = [email.strip() for email in person.email.split(',')]
+        msg = mail.EmailMessage(subject=self.cleaned_data['subject'],
+                                body=email_body, to=emails)
+        if self.cleaned_data['reply_to']:
+            msg.reply_to = [self.cleaned_data['reply_to']]
+        return msg
+
     def send_emails(self, request):
-        """Format and send the PersonAuthLink emails"""
-        msgs = []
+        """Create the PersonAuthLinks, and queue the emails to send
+
+        People are read (with everything the template can use), and their
+        links created and emails queued, MAIL_MERGE_CHUNK at a time, so
+        mailing the whole membership is a few queries per chunk rather than
+        several per person. Returns the EmailBatch of the emails, and the
+        people without email addresses."""
+        expire_minutes = int(self.cleaned_data['expire_in'])
+        expire_time = timezone.now() + datetime.timedelta(minutes=expire_minutes)
+        people = self.cleaned_data['people'].select_related(
+            'level', 'frequency', 'status', 'mit_affil', 'fee_cat').order_by('pk')
         no_email = []
-        for person in self.cleaned_data['people']:
-            if not person.email:
-                no_email.append(person)
-                continue
-            data = person_context_dict(person)
-
-            if int(self.cleaned_data['expire_in']) > 0:
-                # Create the link
-                link = squaresdb.membership.models.PersonAuthLink.create_auth_link(
-                    person, reason='BulkPersonAuthLinkCreation',
-                    detail=self.cleaned_data['reason'], creator=request.user,
-                )
-                expire_minutes = int(self.cleaned_data['expire_in'])
-                expire_interval = datetime.timedelta(minutes=expire_minutes)
-                link.expire_time = timezone.now() + expire_interval
-                link.create_ip = request.META['REMOTE_ADDR']
-                link.save()
-                link_url = reverse('membership:person-link', args=[link.secret])
-                data['link'] = request.build_absolute_uri(link_url)
-
-            # Create the email
-            # TODO: Better error if no link was created but %(link)s or similar is used
-            email_body = self.cleaned_data['template'] % data
-            emails = [email.strip() for email in person.email.split(',')]
-            msg = mail.EmailMessage(subject=self.cleaned_data['subject'],
-                                    body=email_body, to=emails)
-            if self.cleaned_data['reply_to']:
-                msg.reply_to = [self.cleaned_data['reply_to']]
-            msgs.append(msg)
-        connection = mail.get_connection()
-        connection.send_messages(msgs)
-        return no_email
+        with transaction.atomic():
+            batch = outbox_models.EmailBatch.objects.create(
+                reason='Mail merge: %s' % (self.cleaned_data['reason'], ),
+                user=request.user if request.user.is_authenticated else None)
+            people_iter = people.iterator(chunk_size=MAIL_MERGE_CHUNK)
+            while chunk := list(itertools.islice(people_iter, MAIL_MERGE_CHUNK)):
+                no_email += [person for person in chunk if not person.email]
+                chunk = [person for person in chunk if person.email]
+                links = {}
+                if expire_minutes > 0:
+                    links = {person.pk: self._make_link(request, person, expire_time)
+                             for person in chunk}
+                    utils_bulk.bulk_create_with_pks(mem_models.PersonAuthLink,
+                                                   list(links.values()))
+                    if reversion.is_active():
+                        for link in links.values():
+                            reversion.add_to_revision(link)
+                msgs = []
+                for person in chunk:
+                    link_url = None
+                    if person.pk in links:
+                        link_path = reverse('membership:person-link',
+                                            args=[links[person.pk].secret])
+                        link_url = request.build_absolute_uri(link_path)
+                    msgs.append(self._message(person, link_url))
+                outbox_send.queue_messages(msgs, reason='bulk auth links', batch=batch)
+        return batch, no_email
 
 
 @permission_required('membership.bulk_create_personauthlink')
 def create_personauthlinks(request):
-    """View to bulk create and mail merge out PersonAuthLinks"""
+    """View to bulk create and mail merge out PersonAuthLinks
+
+    The emails are sent later, by send_outbox. After a mail merge, this
+    shows how far sending them has got (as does ?batch=, to check again)."""
     msg = ''
     people = None
     no_email = None
+    batch = None
     if request.method == 'POST': # If the form has been submitted...
         form = BulkPersonAuthLinkCreationForm(
             request.POST,
         )
 
         if form.is_valid(): # All validation rules pass
-            no_email = form.send_emails(request)
-            msg = "Mail merged %d messages" % (len(form.cleaned_data['people']), )
+            batch, no_email = form.send_emails(request)
+            msg = "Mail merged %d messages" % (len(form.cleaned_data['people']) - len(no_email), )
             people = form.cleaned_data['people']
     else:
         initial = {}
@@ -444,12 +499,20 @@ def create_personauthlinks(request):
             initial['people'] = people
         if request.GET.get('link') == '0':
             initial['expire_in'] = -1
+        if 'batch' in request.GET:
+            try:
+                batch_id = int(request.GET['batch'])
+            except ValueError as exc:
+                raise Http404("No such batch") from exc
+            batch = get_object_or_404(outbox_models.EmailBatch, pk=batch_id)
         form = BulkPersonAuthLinkCreationForm(initial=initial) # An unbound form
     context = dict(
         form=form,
         msg=msg,
         people=people,
         no_email=no_email,
+        batch=batch,
+        progress=batch.progress() if batch else None,
         pagename='personauthlink-bulkcreate',
     )
     return render(request, 'membership/personauthlink_bulkcreate.html', context)
@@ -18,6 +18,7 @@ from django.views.generic import ListView
 import reversion
 
 import squaresdb.money.models as money_models
+import squaresdb.outbox.send as outbox_send
 
 logger = logging.getLogger(__name__)
 
@@ -259,7 +260,7 @@ def pay_post_cybersource(request, pk, nonce, ):
         email = mail.EmailMessage(subject="Tech Squares Receipt",
                                   body=email_body,
                                   to=addrs)
-        mail.get_connection().send_messages([email])
+        outbox_send.queue_messages([email], reason='pay receipt')
 
     if error:
         return redirect('pay:error-cybersource')
@@ -0,0 +1,32 @@
+from django.contrib import admin
+from django.utils import timezone
+
+from . import models as outbox_models
+
+# Admins are easier to copy/paste if they're all Admin_ModelName
+# pylint:disable=invalid-name
+
+@admin.register(outbox_models.EmailBatch)
+class Admin_EmailBatch(admin.ModelAdmin):
+    list_display = ['pk', 'created', 'reason', 'user']
+    list_display_links = ['pk', 'reason']
+    date_hierarchy = 'created'
+
+@admin.register(outbox_models.OutgoingEmail)
+class Admin_OutgoingEmail(admin.ModelAdmin):
+    list_display = ['pk', 'created', 'reason', 'subject', 'to', 'status', 'attempts',
+                    'next_attempt', 'sent_time']
+    list_display_links = ['pk', 'subject']
+    list_filter = ['status', 'reason']
+    raw_id_fields = ['batch']
+    search_fields = ['subject', 'to']
+    date_hierarchy = 'created'
+    readonly_fields = ['created', 'sent_time', 'last_error']
+    actions = ['retry_now']
+
+    @admin.action(description="Retry now")
+    def retry_now(self, request, queryset):
+        status = outbox_models.OutgoingEmail.Status
+        # Not ones being (or already) sent
+        queryset.filter(status__in=[status.QUEUED, status.FAILED]).update(
+            status=status.QUEUED, next_attempt=timezone.now())
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from squaresdb.outbox import send
+
+
+class Command(BaseCommand):
+    help = 'Sends the queued email that is due'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=send.BATCH_SIZE,
+                            help='Number of emails to send per connection')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, checking for email every --interval seconds')
+        parser.add_argument('--interval', type=float, default=10,
+                            help='Seconds to wait between checks with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            counts = send.send_queued(options['batch_size'])
+            if counts['sent'] or counts['failed'] or not options['loop']:
+                msg = 'Sent %(sent)d emails (%(failed)d failed, to retry later)' % counts
+                self.stdout.write(self.style.SUCCESS(msg))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
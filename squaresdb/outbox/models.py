@@ -0,0 +1,72 @@
+from django.contrib.auth import get_user_model
+from django.db import models
+from django.utils import timezone
+
+# Create your models here.
+
+class EmailBatch(models.Model):
+    """A group of emails queued together (e.g., a mail merge), to track
+    how far sending them has got"""
+    created = models.DateTimeField(default=timezone.now)
+    reason = models.CharField(max_length=100)
+    user = models.ForeignKey(get_user_model(), on_delete=models.PROTECT, blank=True, null=True)
+
+    def progress(self):
+        """Count the batch's emails by status"""
+        counts = {status: 0 for status in OutgoingEmail.Status.values}
+        rows = self.emails.order_by().values_list('status').annotate(num=models.Count('pk'))
+        counts.update(rows)
+        counts['total'] = sum(counts.values())
+        counts['waiting'] = counts['queued'] + counts['sending']
+        return counts
+
+    def __str__(self):
+        return f"{self.reason} at {self.created}"
+
+
+class OutgoingEmail(models.Model):
+    """An email waiting to be (or that was) sent by the send_outbox command
+
+    Only what EmailMessage needs to rebuild the message is stored;
+    attachments aren't supported."""
+
+    class Status(models.TextChoices): # pylint:disable=too-many-ancestors
+        QUEUED = 'queued'
+        # Claimed by a send_outbox run, until claimed_until
+        SENDING = 'sending'
+        SENT = 'sent'
+        FAILED = 'failed'
+
+    created = models.DateTimeField(default=timezone.now)
+    batch = models.ForeignKey(EmailBatch, on_delete=models.CASCADE, blank=True, null=True,
+                              related_name='emails')
+    # Where the email came from (e.g., "pay receipt"), for the admin
+    reason = models.CharField(max_length=100, blank=True)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    # Lists of addresses
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list)
+    bcc = models.JSONField(default=list)
+    reply_to = models.JSONField(default=list)
+    headers = models.JSONField(default=dict)
+
+    status = models.CharField(max_length=10, choices=Status, default=Status.QUEUED)
+    # Queued emails are sent once this has passed
+    next_attempt = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+    # The send_outbox run sending it, and when its claim lapses (if that
+    # run dies, a later one sends it instead)
+    claim = models.CharField(max_length=32, blank=True)
+    claimed_until = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    sent_time = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt', 'id'], name='outbox_due'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)} ({self.status})"
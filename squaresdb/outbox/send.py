@@ -0,0 +1,161 @@
+"""Queueing email, and sending it later from the send_outbox command
+
+Views queue email (queue_messages) rather than sending it themselves, so a
+slow or broken mail relay doesn't slow down (or break) the request. The
+send_outbox command (run from cron) sends what's queued in batches, each
+over one connection from mail.get_connection(), so EMAIL_BACKEND (say,
+ForcedRecipientEmailBackend or AutoBccEmailBackend) applies as it always
+has.
+
+Each run claims the emails it sends (see claim_batch), so overlapping runs
+send different emails, and sends them outside any transaction, so a slow
+relay doesn't keep the database locked. An email that fails to send is
+retried later, waiting longer each time, and given up on after MAX_ATTEMPTS
+tries."""
+
+import datetime
+import logging
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+from django.core import mail
+from django.db.models import Q
+from django.utils import timezone
+
+import squaresdb.outbox.models as outbox_models
+
+logger = logging.getLogger(__name__)
+
+Status = outbox_models.OutgoingEmail.Status
+
+# Emails to send per batch (and connection)
+BATCH_SIZE = 100
+
+# Tries before giving up on an email
+MAX_ATTEMPTS = 8
+
+# Wait before the first retry; each later retry waits four times as long
+RETRY_DELAY = datetime.timedelta(minutes=1)
+MAX_RETRY_DELAY = datetime.timedelta(days=1)
+
+# How long a run has to send the emails it claims, before another may
+CLAIM_TIME = datetime.timedelta(minutes=30)
+
+
+def queue_messages(messages: Iterable[mail.EmailMessage], reason: str = '',
+                   batch: Optional[outbox_models.EmailBatch] = None,
+                   ) -> List[outbox_models.OutgoingEmail]:
+    """Queue EmailMessages to be sent by send_outbox
+
+    Pass batch to track the messages' progress along with others. Messages
+    with attachments or alternatives can't be queued."""
+    emails = []
+    for message in messages:
+        if message.attachments or getattr(message, 'alternatives', None):
+            raise ValueError("Can't queue messages with attachments")
+        emails.append(outbox_models.OutgoingEmail(
+            batch=batch, reason=reason, subject=str(message.subject), body=str(message.body),
+            from_email=message.from_email,
+            to=list(message.to), cc=list(message.cc), bcc=list(message.bcc),
+            reply_to=list(message.reply_to), headers=dict(message.extra_headers),
+        ))
+    return outbox_models.OutgoingEmail.objects.bulk_create(emails, batch_size=1000)
+
+
+def to_message(email: outbox_models.OutgoingEmail, conn=None) -> mail.EmailMessage:
+    """Rebuild the EmailMessage for a queued email"""
+    return mail.EmailMessage(subject=email.subject, body=email.body,
+                             from_email=email.from_email, to=email.to, cc=email.cc,
+                             bcc=email.bcc, reply_to=email.reply_to,
+                             headers=email.headers, connection=conn)
+
+
+def retry_delay(attempts: int) -> datetime.timedelta:
+    """Find how long to wait before retrying an email that's failed attempts times"""
+    return min(RETRY_DELAY * 4**(attempts-1), MAX_RETRY_DELAY)
+
+
+def _send_one(email: outbox_models.OutgoingEmail, conn, now: datetime.datetime) -> bool:
+    """Try to send an email, and save how it went"""
+    email.attempts += 1
+    try:
+        # Opens the connection if it isn't already, so send_messages won't
+        # open (and close) one just for this email
+        conn.open()
+        conn.send_messages([to_message(email, conn)])
+    except Exception as exc: # pylint:disable=broad-exception-caught
+        logger.warning("Failed to send outbox email %d: %r", email.pk, exc)
+        email.last_error = repr(exc)
+        if email.attempts >= MAX_ATTEMPTS:
+            email.status = Status.FAILED
+        else:
+            email.status = Status.QUEUED
+            email.next_attempt = now + retry_delay(email.attempts)
+        # The connection may be broken, so start a fresh one for the next
+        conn.close()
+        sent = False
+    else:
+        email.status = Status.SENT
+        email.sent_time = now
+        sent = True
+    # Only if the claim is still ours -- if it lapsed, another run has it
+    outbox_models.OutgoingEmail.objects.filter(pk=email.pk, claim=email.claim).update(
+        status=email.status, attempts=email.attempts, next_attempt=email.next_attempt,
+        last_error=email.last_error, sent_time=email.sent_time, claimed_until=None)
+    return sent
+
+
+def claim_batch(batch_size: int = BATCH_SIZE,
+                now: Optional[datetime.datetime] = None) -> List[outbox_models.OutgoingEmail]:
+    """Claim up to batch_size emails that are due, for this run to send
+
+    Emails are due if they're queued and their next attempt has passed, or
+    if another run's claim on them has lapsed. The claim is a conditional
+    UPDATE, so two runs never claim the same email, without holding a
+    transaction (or locks) open while sending."""
+    now = now or timezone.now()
+    due = (Q(status=Status.QUEUED, next_attempt__lte=now)
+           | Q(status=Status.SENDING, claimed_until__lt=now))
+    emails = outbox_models.OutgoingEmail.objects
+    pks = list(emails.filter(due).order_by('next_attempt', 'id')
+               .values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return []
+    claim = uuid.uuid4().hex
+    emails.filter(due, pk__in=pks).update(status=Status.SENDING, claim=claim,
+                                          claimed_until=now + CLAIM_TIME)
+    return list(emails.filter(claim=claim, status=Status.SENDING).order_by('next_attempt', 'id'))
+
+
+def send_batch(batch_size: int = BATCH_SIZE,
+               now: Optional[datetime.datetime] = None) -> Dict[str, int]:
+    """Send up to batch_size queued emails that are due, over one connection
+
+    Returns counts of emails sent and failed. Each email's result is saved
+    as soon as it's sent, so if the run dies partway through, only the
+    email it was sending can be sent twice."""
+    now = now or timezone.now()
+    counts = dict(sent=0, failed=0)
+    emails = claim_batch(batch_size, now)
+    if not emails:
+        return counts
+    conn = mail.get_connection()
+    try:
+        for email in emails:
+            counts['sent' if _send_one(email, conn, now) else 'failed'] += 1
+    finally:
+        conn.close()
+    return counts
+
+
+def send_queued(batch_size: int = BATCH_SIZE,
+                now: Optional[datetime.datetime] = None) -> Dict[str, int]:
+    """Send every queued email that's due, a batch at a time"""
+    total = dict(sent=0, failed=0)
+    while True:
+        counts = send_batch(batch_size, now)
+        for key, num in counts.items():
+            total[key] += num
+        # Failed emails are rescheduled, so they won't come up again
+        if sum(counts.values()) < batch_size:
+            return total
@@ -0,0 +1,175 @@
+import datetime
+import io
+import socketserver
+import threading
+
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+import squaresdb.outbox.models as outbox_models
+import squaresdb.outbox.send as outbox_send
+
+Status = outbox_models.OutgoingEmail.Status
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough of SMTP for smtplib to send through"""
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost test SMTP')
+        recipients = []
+        for line in self.rfile:
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO', 'NOOP', 'RSET'):
+                self.reply('250 OK')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                addr = command.split(':', 1)[1].strip().strip('<>')
+                if addr in self.server.reject:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(addr)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                self.server.messages.append((recipients, data))
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    """Local SMTP server standing in for the real relay"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.connections = 0
+        self.messages = []
+        self.reject = set()
+
+    def settings(self, backend='django.core.mail.backends.smtp.EmailBackend'):
+        return override_settings(EMAIL_BACKEND=backend, EMAIL_HOST='127.0.0.1',
+                                 EMAIL_PORT=self.server_address[1], EMAIL_HOST_USER='',
+                                 EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False,
+                                 EMAIL_USE_SSL=False)
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.server = _SMTPServer()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    @staticmethod
+    def queue(*addrs):
+        return outbox_send.queue_messages(
+            [mail.EmailMessage(subject=f'Hi {addr}', body='Hello', to=[addr]) for addr in addrs],
+            reason='test')
+
+    def test_queue(self):
+        self.queue('a@example.com', 'b@example.com')
+        self.assertEqual(len(mail.outbox), 0)
+        email = outbox_models.OutgoingEmail.objects.get(to=['a@example.com'])
+        self.assertEqual(email.status, Status.QUEUED)
+        self.assertEqual(email.subject, 'Hi a@example.com')
+
+        # The test backend (locmem)
+        self.assertEqual(outbox_send.send_queued(), dict(sent=2, failed=0))
+        self.assertEqual(sorted(msg.to[0] for msg in mail.outbox),
+                         ['a@example.com', 'b@example.com'])
+        email.refresh_from_db()
+        self.assertEqual(email.status, Status.SENT)
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(outbox_send.send_queued(), dict(sent=0, failed=0))
+
+    def test_smtp_one_connection(self):
+        self.queue('a@example.com', 'b@example.com', 'c@example.com')
+        with self.server.settings('squaresdb.utils.email.ForcedRecipientEmailBackend'), \
+                override_settings(EMAIL_FORCED_RECIPIENTS=['forced@example.com']):
+            call_command('send_outbox', '--batch-size=2', stdout=io.StringIO())
+        # Two batches, of two and one emails
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 3)
+        for recipients, data in self.server.messages:
+            self.assertEqual(recipients, ['forced@example.com'])
+            self.assertIn(b'squares-db-forced-recipient@mit.edu', data)
+        self.assertFalse(outbox_models.OutgoingEmail.objects.exclude(status=Status.SENT))
+
+    def test_retry(self):
+        self.queue('bounce@example.com', 'a@example.com')
+        self.server.reject.add('bounce@example.com')
+        now = timezone.now()
+        with self.server.settings(), self.assertLogs('squaresdb.outbox.send', 'WARNING'):
+            self.assertEqual(outbox_send.send_queued(now=now), dict(sent=1, failed=1))
+            self.assertEqual(len(self.server.messages), 1)
+            bounce = outbox_models.OutgoingEmail.objects.get(to=['bounce@example.com'])
+            self.assertEqual(bounce.status, Status.QUEUED)
+            self.assertEqual(bounce.attempts, 1)
+            self.assertIn('SMTPRecipientsRefused', bounce.last_error)
+            self.assertEqual(bounce.next_attempt, now + outbox_send.RETRY_DELAY)
+
+            # Not due yet
+            self.assertEqual(outbox_send.send_queued(now=now), dict(sent=0, failed=0))
+
+            # Give up eventually
+            for _attempt in range(2, outbox_send.MAX_ATTEMPTS+1):
+                now += datetime.timedelta(days=1)
+                self.assertEqual(outbox_send.send_queued(now=now), dict(sent=0, failed=1))
+            bounce.refresh_from_db()
+            self.assertEqual(bounce.status, Status.FAILED)
+            self.assertEqual(bounce.attempts, outbox_send.MAX_ATTEMPTS)
+
+            # ...unless the admin retries it
+            self.server.reject.clear()
+            outbox_models.OutgoingEmail.objects.filter(pk=bounce.pk).update(
+                status=Status.QUEUED)
+            self.assertEqual(outbox_send.send_queued(now=now), dict(sent=1, failed=0))
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_claims(self):
+        self.queue('a@example.com', 'b@example.com', 'c@example.com')
+        now = timezone.now()
+        # Another run has claimed two, and is sending them
+        claimed = outbox_send.claim_batch(2, now)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(outbox_send.send_queued(now=now), dict(sent=1, failed=0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(outbox_models.OutgoingEmail.objects.filter(
+            status=Status.SENDING).count(), 2)
+
+        # The other run finishing one
+        conn = mail.get_connection()
+        self.assertTrue(outbox_send._send_one(claimed[0], conn, now)) # pylint:disable=protected-access
+        self.assertEqual(len(mail.outbox), 2)
+
+        # ...and then dying, so its claim on the other lapses
+        self.assertEqual(outbox_send.send_queued(now=now), dict(sent=0, failed=0))
+        later = now + outbox_send.CLAIM_TIME + datetime.timedelta(seconds=1)
+        self.assertEqual(outbox_send.send_queued(now=later), dict(sent=1, failed=0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(outbox_models.OutgoingEmail.objects.exclude(status=Status.SENT))
+
+        # A late result from the lapsed claim doesn't overwrite the new one
+        outbox_send._send_one(claimed[1], conn, now) # pylint:disable=protected-access
+        email = outbox_models.OutgoingEmail.objects.get(pk=claimed[1].pk)
+        self.assertEqual((email.sent_time, email.attempts), (later, 1))
+
+    def test_retry_delay(self):
+        self.assertEqual(outbox_send.retry_delay(1), datetime.timedelta(minutes=1))
+        self.assertEqual(outbox_send.retry_delay(3), datetime.timedelta(minutes=16))
+        self.assertEqual(outbox_send.retry_delay(20), outbox_send.MAX_RETRY_DELAY)
@@ -78,9 +78,16 @@ INSTALLED_APPS = (
     'squaresdb.gate',
     'squaresdb.mailinglist',
     'squaresdb.money',
+    'squaresdb.outbox',
 )
 
 MIDDLEWARE = (
+    # Saves a revision of each request's changes to models registered with
+    # reversion (@reversion.register): the ones people edit, whose history
+    # can be seen and reverted in the admin. Tables derived from those
+    # (ledgers, tallies, search terms), logs, queues, and working data
+    # aren't registered -- they're rebuilt from the registered models, or
+    # not worth a history.
     'reversion.middleware.RevisionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -181,6 +188,24 @@ CYBERSOURCE_CONFIGS = dict(
 
 CYBERSOURCE_CONFIG_NAME = 'test'
 
+# Whether the signin and books pages get live updates over server-sent events
+# (gate.views.signin_api_events and books_events). Each open page holds a
+# server thread for minutes at a time, so only turn this on with threads to
+# spare (the vhost's WSGIDaemonProcess threads=) or an async server;
+# otherwise signin polls the change log every few seconds, and books doesn't
+# update.
+GATE_EVENTS_STREAMS = False
+
+# Broker for live gate updates (see squaresdb.gate.events): "local" only
+# reaches pages served by the same process, while a redis:// URL reaches all
+# processes (and needs the redis extra)
+GATE_EVENTS_BROKER = 'local'
+
+# Overrides for the voting membership rule (see squaresdb.gate.voting.VotingRule),
+# such as {'threshold': 8}. Run the rebuild_voting_tallies command after
+# changing it.
+GATE_VOTING_RULE: dict = {}
+
 from .local import * # pylint: disable=wrong-import-position
 
 CYBERSOURCE_CONFIG = CYBERSOURCE_CONFIGS[CYBERSOURCE_CONFIG_NAME]
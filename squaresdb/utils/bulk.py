@@ -0,0 +1,14 @@
+"""Bulk insert helpers that aren't specific to any one app"""
+
+from django.db import connection
+
+def bulk_create_with_pks(model, objs):
+    """bulk_create objs, making sure they get their pks
+
+    Not all databases (notably MySQL) return pks from a bulk insert, so fall
+    back to saving one at a time there."""
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objs)
+    else:
+        for obj in objs:
+            obj.save()